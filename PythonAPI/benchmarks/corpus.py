@@ -0,0 +1,215 @@
+"""
+Synthetic certificate corpus for the benchmarks.
+
+    python benchmarks/corpus.py bench_corpus --count 12 --seed 0
+
+Writes, per certificate, with the fields that were printed on it:
+  text_pdf       digital PDF with a text layer, photo and signature
+  scanned_image  the same certificate rendered, tilted, noised and saved as JPEG
+  scanned_pdf    that scan wrapped in a PDF without a text layer
+  multipage_pdf  the certificate followed by transcript pages (every third one)
+plus manifest.json listing each file's kind, page count and fields.
+Everything is deterministic for a given seed.
+"""
+import argparse
+import io
+import json
+import os
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+from PIL import Image
+
+FIRST_NAMES = ["Aarav", "Priya", "Rohan", "Ananya", "Vikram", "Sneha", "Arjun", "Kavya", "Rahul", "Meera"]
+LAST_NAMES = ["Sharma", "Verma", "Iyer", "Patel", "Reddy", "Nair", "Gupta", "Singh", "Das", "Menon"]
+DEGREES = ["Bachelor of Technology", "Bachelor of Science", "Master of Business Administration",
+           "Bachelor of Commerce", "Master of Science", "Bachelor of Arts"]
+ORGANISATIONS = ["National Institute of Technology", "State University of Engineering",
+                 "Institute of Management Studies", "College of Arts and Science"]
+GRADES = ["A+", "A", "B+", "B", "First Division", "Distinction"]
+SUBJECTS = ["Mathematics", "Physics", "Chemistry", "Programming", "Economics", "Statistics",
+            "Data Structures", "Linear Algebra", "Accounting", "Communication Skills"]
+
+PAGE_WIDTH, PAGE_HEIGHT = 842, 595  # A4 landscape, points
+PHOTO_RECT = fitz.Rect(660, 150, 770, 290)
+SIGNATURE_RECT = fitz.Rect(560, 470, 760, 530)
+
+
+def random_fields(rng):
+    return {
+        "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "degree": str(rng.choice(DEGREES)),
+        "year": str(int(rng.integers(2005, 2025))),
+        "grade": str(rng.choice(GRADES)),
+        "roll_number": str(int(rng.integers(10 ** 7, 10 ** 8))),
+        "organisation": str(rng.choice(ORGANISATIONS)),
+        "certificate_id": f"CERT-{int(rng.integers(10 ** 5, 10 ** 6))}",
+    }
+
+
+# ---------------- Images ----------------
+def synthetic_photo(rng, size=(220, 280)):
+    """Passport-style photo: plain background, head and shoulders."""
+    width, height = size
+    background = rng.integers(150, 230, 3)
+    img = np.empty((height, width, 3), np.uint8)
+    img[:] = background
+    skin = tuple(int(c) for c in rng.integers(120, 220, 3))
+    cloth = tuple(int(c) for c in rng.integers(0, 120, 3))
+    cv2.ellipse(img, (width // 2, height + 20), (width // 2, height // 3), 0, 180, 360, cloth, -1)
+    cv2.ellipse(img, (width // 2, height * 2 // 5), (width // 5, height // 4), 0, 0, 360, skin, -1)
+    img = cv2.add(img, rng.integers(0, 20, img.shape, dtype=np.uint8))
+    return cv2.GaussianBlur(img, (3, 3), 0)
+
+
+def synthetic_signature(rng, size=(400, 120)):
+    """A few connected pen strokes in dark blue on white."""
+    width, height = size
+    img = np.full((height, width, 3), 255, np.uint8)
+    for _ in range(int(rng.integers(2, 5))):
+        points = np.cumsum(rng.normal(0, 10, size=(30, 2)), axis=0)
+        points += (rng.integers(40, width - 40), rng.integers(30, height - 30))
+        cv2.polylines(img, [points.astype(np.int32)], False, (20, 30, 120), int(rng.integers(1, 3)), cv2.LINE_AA)
+    return img
+
+
+def _png(img):
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _jpeg(img, quality):
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+# ---------------- Documents ----------------
+def _certificate_page(doc, fields, photo, signature):
+    page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+    page.draw_rect(fitz.Rect(20, 20, PAGE_WIDTH - 20, PAGE_HEIGHT - 20), color=(0.1, 0.2, 0.5), width=6)
+    page.draw_rect(fitz.Rect(32, 32, PAGE_WIDTH - 32, PAGE_HEIGHT - 32), color=(0.7, 0.6, 0.2), width=2)
+    page.draw_circle(fitz.Point(140, 480), 50, color=(0.6, 0.1, 0.1), width=3)
+
+    lines = [
+        (90, 26, fields["organisation"].upper()),
+        (140, 16, f"Certificate No: {fields['certificate_id']}"),
+        (200, 18, "This is to certify that"),
+        (245, 26, fields["name"]),
+        (290, 16, f"Roll No: {fields['roll_number']}"),
+        (330, 18, "has been awarded the degree of"),
+        (370, 22, fields["degree"]),
+        (410, 16, f"in the year {fields['year']} with Grade: {fields['grade']}"),
+    ]
+    for y, size, text in lines:
+        page.insert_text(fitz.Point(80, y), text, fontsize=size, fontname="tiro")
+    page.insert_text(fitz.Point(600, 550), "Registrar", fontsize=14, fontname="tiro")
+    page.insert_image(PHOTO_RECT, stream=_png(photo))
+    page.insert_image(SIGNATURE_RECT, stream=_png(signature))
+
+
+def _transcript_page(doc, fields, rng, number):
+    page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+    page.insert_text(fitz.Point(60, 60), f"Statement of Marks - Semester {number}", fontsize=20, fontname="tiro")
+    page.insert_text(fitz.Point(60, 90), f"Name: {fields['name']}    Roll No: {fields['roll_number']}",
+                     fontsize=13, fontname="tiro")
+    y = 130
+    for subject in rng.choice(SUBJECTS, size=8, replace=False):
+        page.insert_text(fitz.Point(80, y), str(subject), fontsize=13, fontname="tiro")
+        page.insert_text(fitz.Point(520, y), f"{int(rng.integers(40, 100))} / 100", fontsize=13, fontname="tiro")
+        page.draw_line(fitz.Point(70, y + 8), fitz.Point(700, y + 8), color=(0.6, 0.6, 0.6), width=0.5)
+        y += 40
+
+
+def certificate_pdf(fields, rng, transcript_pages=0):
+    """Digital certificate (with a text layer), optionally followed by transcript pages."""
+    doc = fitz.open()
+    _certificate_page(doc, fields, synthetic_photo(rng), synthetic_signature(rng))
+    for number in range(1, transcript_pages + 1):
+        _transcript_page(doc, fields, rng, number)
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+
+def scan(pdf_bytes, rng, dpi=200, quality=70):
+    """First page of a PDF as a tilted, noisy, slightly blurred RGB 'scan'."""
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    pix = doc[0].get_pixmap(dpi=dpi)
+    img = np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.width, pix.n)[:, :, :3].copy()
+    doc.close()
+
+    height, width = img.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), rng.uniform(-1.5, 1.5), 1.0)
+    img = cv2.warpAffine(img, matrix, (width, height), borderValue=(255, 255, 255))
+    img = cv2.GaussianBlur(img, (3, 3), 0)
+    noise = rng.normal(0, 8, img.shape)
+    img = np.clip(img.astype(np.float32) + noise + rng.uniform(-15, 5), 0, 255).astype(np.uint8)
+    return _jpeg(img, quality)
+
+
+def image_pdf(jpeg_bytes):
+    """A scan wrapped in a PDF page, without any text layer."""
+    doc = fitz.open()
+    page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+    page.insert_image(page.rect, stream=jpeg_bytes)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def build_corpus(out_dir, count=12, seed=0):
+    """Writes the corpus and returns its manifest."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = []
+
+    def write(name, data, kind, pages, fields, source=None):
+        with open(os.path.join(out_dir, name), "wb") as f:
+            f.write(data)
+        entry = {"file": name, "kind": kind, "pages": pages, "fields": fields}
+        if source:
+            entry["source"] = source
+        manifest.append(entry)
+
+    for idx in range(count):
+        fields = random_fields(rng)
+        stem = f"cert_{idx:03d}"
+        pdf = certificate_pdf(fields, rng)
+        write(f"{stem}.pdf", pdf, "text_pdf", 1, fields)
+        scanned = scan(pdf, rng)
+        write(f"{stem}_scan.jpg", scanned, "scanned_image", 1, fields, source=f"{stem}.pdf")
+        write(f"{stem}_scan.pdf", image_pdf(scanned), "scanned_pdf", 1, fields, source=f"{stem}.pdf")
+        if idx % 3 == 0:
+            pages = int(rng.integers(2, 5))
+            write(f"{stem}_multi.pdf", certificate_pdf(fields, rng, transcript_pages=pages - 1),
+                  "multipage_pdf", pages, fields)
+
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump({"seed": seed, "documents": manifest}, f, indent=2)
+    return manifest
+
+
+def load_manifest(corpus_dir):
+    with open(os.path.join(corpus_dir, "manifest.json")) as f:
+        return json.load(f)["documents"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dir")
+    parser.add_argument("--count", type=int, default=12, help="number of certificates")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    manifest = build_corpus(args.out_dir, args.count, args.seed)
+    kinds = {}
+    for entry in manifest:
+        kinds[entry["kind"]] = kinds.get(entry["kind"], 0) + 1
+    print(f"Wrote {len(manifest)} documents to {args.out_dir}: "
+          + ", ".join(f"{count} {kind}" for kind, count in sorted(kinds.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+"""
+End-to-end benchmark of the Python services on a synthetic certificate corpus.
+
+    python benchmarks/harness.py --json bench.json
+    python benchmarks/harness.py --corpus bench_corpus --concurrency 1,4,8 --requests 24
+    python benchmarks/harness.py --services extract --baseline bench_before.json
+
+Three parts:
+  stages     each pipeline stage timed on its own over the corpus: decode,
+             rasterize, ocr_tesseract, ocr_easyocr, fields (local extraction),
+             llm (mock server), yolo, embed, sift
+  endpoints  /extract, /robust-ocr and /compare-images driven in process
+             through Flask test clients, one after another and under
+             concurrent load: throughput and p50/p95/p99 latency
+  memory     peak RSS of the benchmark process
+
+The services are imported in this process with the result caches off (use
+--with-cache to keep them), a local mock LLM with --llm-latency, and their
+job, anchor and reference data in a temporary directory. A service whose
+dependencies are missing is reported as skipped. The JSON output records
+the git commit, so runs can be compared with --baseline.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from corpus import build_corpus, load_manifest  # noqa: E402
+from mock_llm_server import serve as serve_mock_llm  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SERVICES = ("extract", "robust-ocr", "compare-images")
+SERVICE_MODULES = {"extract": "ocr_functions", "robust-ocr": "robust_ocr", "compare-images": "compare_certificates"}
+# Models each service loads on first use (model_registry names)
+SERVICE_MODELS = {"extract": ("spacy_en",), "robust-ocr": ("easyocr_en",), "compare-images": ("yolo", "embedder")}
+# Latency columns compared against --baseline (endpoint runs add throughput)
+LATENCY_KEYS = ("p50_ms", "p95_ms", "p99_ms")
+
+
+# ---------------- Measurements ----------------
+def percentiles(samples_ms):
+    if not samples_ms:
+        return {"count": 0}
+    values = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        "count": len(values),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class StageTimer:
+    """Collects durations per stage name."""
+
+    def __init__(self):
+        self.samples = {}
+        self.skipped = {}
+
+    def time(self, stage, func, *args, **kwargs):
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.samples.setdefault(stage, []).append((time.perf_counter() - started) * 1000)
+        return result
+
+    def skip(self, stage, reason):
+        self.skipped.setdefault(stage, reason)
+
+    def report(self):
+        report = {stage: percentiles(samples) for stage, samples in self.samples.items()}
+        for stage, reason in self.skipped.items():
+            report.setdefault(stage, {"count": 0})["skipped"] = reason
+        return report
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SERVICE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+# ---------------- Setup ----------------
+def configure_environment(work_dir, llm_url, with_cache):
+    """Environment the services read at import time; must run before importing them."""
+    os.environ["PRELOAD_MODELS"] = "0"
+    os.environ["WARMUP_IN_BACKGROUND"] = "0"
+    os.environ["LLM_BACKEND"] = "http"
+    os.environ["LLM_HTTP_URL"] = llm_url
+    os.environ["JOB_DATA_DIR"] = os.path.join(work_dir, "job_data")
+    os.environ["FIELD_ANCHOR_DIR"] = os.path.join(work_dir, "field_anchors")
+    os.environ["REFERENCE_STORE_DIR"] = os.path.join(work_dir, "reference_store")
+    os.environ["RESULT_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    if not with_cache:
+        os.environ["RESULT_CACHE_ENABLED"] = "0"
+
+
+def import_services(names):
+    """
+    {service: module or the error}; relative model paths resolve from the
+    service directory. Models are lazy, so each service's models are loaded
+    here too: a missing model package (e.g. easyocr) skips that service
+    instead of failing the benchmark halfway through.
+    """
+    sys.path.insert(0, SERVICE_DIR)
+    os.chdir(SERVICE_DIR)
+    modules = {}
+    for name in names:
+        try:
+            module = __import__(SERVICE_MODULES[name])
+            for model in SERVICE_MODELS[name]:
+                module.registry.get(model)
+            modules[name] = module
+        except Exception as e:
+            modules[name] = e
+    return modules
+
+
+def read_document(corpus_dir, entry):
+    with open(os.path.join(corpus_dir, entry["file"]), "rb") as f:
+        return f.read()
+
+
+# ---------------- Stage Benchmarks ----------------
+def bench_stages(modules, corpus_dir, documents, timer):
+    import fitz
+    import rasterizer
+    from PIL import Image
+
+    rendered = []
+    for entry in documents:
+        file_bytes = read_document(corpus_dir, entry)
+        is_pdf = entry["file"].endswith(".pdf")
+
+        def decode():
+            if is_pdf:
+                doc = fitz.open(stream=file_bytes, filetype="pdf")
+                count = doc.page_count
+                doc.close()
+                return count
+            Image.open(io.BytesIO(file_bytes)).load()
+            return 1
+
+        timer.time("decode", decode)
+        pages = timer.time("rasterize", lambda: [img for _, img in rasterizer.iter_pages(
+            file_bytes, is_pdf, dpi=300, grayscale=False)])
+        rendered.append((entry, pages))
+
+    ocr = modules.get("extract")
+    if isinstance(ocr, Exception):
+        for stage in ("ocr_tesseract", "fields", "llm"):
+            timer.skip(stage, f"ocr_functions: {ocr}")
+    elif ocr is not None:
+        from field_extractor import FIELDS, build_batch_prompt
+        for entry, pages in rendered:
+            texts = [timer.time("ocr_tesseract", ocr.extract_text, page) for page in pages]
+            for text in texts:
+                timer.time("fields", ocr.field_extractor.local_fields, text)
+            prompt = build_batch_prompt([(number, text, list(FIELDS)) for number, text in enumerate(texts, start=1)])
+            # Through the shared client, so rate limiting and retries are included
+            timer.time("llm", ocr.llm_client, prompt)
+
+    robust = modules.get("robust-ocr")
+    if isinstance(robust, Exception):
+        timer.skip("ocr_easyocr", f"robust_ocr: {robust}")
+    elif robust is not None:
+        for entry, pages in rendered:
+            timer.time("ocr_easyocr", robust.ocr_pages, pages)
+
+    compare = modules.get("compare-images")
+    if isinstance(compare, Exception):
+        for stage in ("yolo", "embed", "sift"):
+            timer.skip(stage, f"compare_certificates: {compare}")
+    elif compare is not None:
+        for entry, pages in rendered:
+            image = Image.fromarray(pages[0])
+            profile, sign = timer.time("yolo", compare.crop_from_yolo, image)
+            crops = [crop for crop in (profile, sign) if crop is not None]
+            if not crops:
+                # The detector may find nothing on synthetic pages; time the rest on fixed regions
+                width, height = image.size
+                crops = [image.crop((int(width * 0.78), int(height * 0.25), int(width * 0.92), int(height * 0.49))),
+                         image.crop((int(width * 0.66), int(height * 0.79), int(width * 0.9), int(height * 0.89)))]
+            timer.time("embed", compare.extract_features_batch, crops)
+            matcher = compare.keypoint_matcher
+            descriptors = [timer.time("sift", matcher.describe, crop) for crop in crops]
+            timer.time("sift", matcher.similarity, descriptors[0], descriptors[-1])
+
+
+# ---------------- Endpoint Benchmarks ----------------
+def endpoint_requests(service, corpus_dir, documents):
+    """One (description, request kwargs factory) per request to send."""
+    requests = []
+    if service == "extract":
+        for entry in documents:
+            file_bytes = read_document(corpus_dir, entry)
+            body = {"filename": entry["file"], "b64": base64.b64encode(file_bytes).decode()}
+            requests.append((entry["file"], lambda body=body: {"json": body}))
+    elif service == "robust-ocr":
+        for entry in documents:
+            file_bytes = read_document(corpus_dir, entry)
+            file_type = "normal" if entry["file"].endswith(".pdf") else "scanned"
+            requests.append((entry["file"], lambda file_bytes=file_bytes, name=entry["file"], file_type=file_type: {
+                "data": {"file": (io.BytesIO(file_bytes), name), "type": file_type},
+                "content_type": "multipart/form-data",
+            }))
+    else:
+        # Each scan against its original (genuine) and against the next certificate's original
+        originals = [entry for entry in documents if entry["kind"] == "text_pdf"]
+        scans = {entry["source"]: entry for entry in documents if entry["kind"] == "scanned_image"}
+        for idx, original in enumerate(originals):
+            others = [scans.get(original["file"]), scans.get(originals[(idx + 1) % len(originals)]["file"])]
+            for other in (other for other in others if other is not None):
+                first, second = read_document(corpus_dir, original), read_document(corpus_dir, other)
+                requests.append((f"{original['file']} vs {other['file']}",
+                                 lambda first=first, second=second, a=original["file"], b=other["file"]: {
+                                     "data": {"file1": (io.BytesIO(first), a), "file_type1": "normal",
+                                              "file2": (io.BytesIO(second), b), "file_type2": "scanned"},
+                                     "content_type": "multipart/form-data",
+                                 }))
+    return requests
+
+
+def run_load(app, path, requests, total, concurrency):
+    """Sends `total` requests (cycling through `requests`) with `concurrency` threads."""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(idx):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        _, make_kwargs = requests[idx % len(requests)]
+        started = time.perf_counter()
+        try:
+            response = client.post(path, **make_kwargs())
+            failed = response.status_code >= 400
+            detail = response.get_data(as_text=True)[:200] if failed else None
+        except Exception as e:
+            failed, detail = True, str(e)
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            if failed:
+                errors.append(detail)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(total)))
+    wall = time.perf_counter() - started
+
+    result = percentiles(latencies)
+    result.update({
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "throughput_rps": total / wall if wall else None,
+        "wall_seconds": wall,
+    })
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+def bench_endpoints(modules, corpus_dir, documents, concurrency_levels, total):
+    report = {}
+    for service, module in modules.items():
+        if isinstance(module, Exception):
+            report[service] = {"skipped": f"{SERVICE_MODULES[service]}: {module}"}
+            continue
+        requests = endpoint_requests(service, corpus_dir, documents)
+        if not requests:
+            report[service] = {"skipped": "no requests for this corpus"}
+            continue
+        # Warm-up: load the models outside the measurements
+        run_load(module.app, f"/{service}", requests[:1], 1, 1)
+        report[service] = {
+            "requests": len(requests),
+            "runs": [run_load(module.app, f"/{service}", requests, max(total, concurrency), concurrency)
+                     for concurrency in concurrency_levels],
+        }
+    return report
+
+
+# ---------------- Output ----------------
+def print_report(results, baseline=None):
+    def change(current, previous):
+        if not previous or current is None:
+            return ""
+        return f"{(current - previous) / previous * 100:+.1f}%"
+
+    def changes(stats, previous, keys):
+        """Change of each key against the baseline; blank without one."""
+        if baseline is None:
+            return ""
+        return "".join(f"{change(stats.get(key), (previous or {}).get(key)):>9}" for key in keys)
+
+    vs_latency = "".join(f"{'Δ' + key[:3]:>9}" for key in LATENCY_KEYS) if baseline else ""
+    print(f"{'stage':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{vs_latency}")
+    for stage, stats in results["stages"].items():
+        if "skipped" in stats:
+            print(f"{stage:<16}  skipped: {stats['skipped']}")
+            continue
+        previous = (baseline or {}).get("stages", {}).get(stage)
+        print(f"{stage:<16}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{changes(stats, previous, LATENCY_KEYS)}")
+
+    print()
+    vs_run = f"{'Δreq/s':>9}{vs_latency}" if baseline else ""
+    print(f"{'endpoint':<16}{'conc':>5}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{vs_run}")
+    for service, stats in results["endpoints"].items():
+        if "skipped" in stats:
+            print(f"{service:<16}  skipped: {stats['skipped']}")
+            continue
+        previous_runs = {run["concurrency"]: run for run in
+                         (baseline or {}).get("endpoints", {}).get(service, {}).get("runs", [])}
+        for run in stats["runs"]:
+            previous = previous_runs.get(run["concurrency"])
+            print(f"{service:<16}{run['concurrency']:>5}{run['throughput_rps']:>8.2f}{run['p50_ms']:>10.1f}"
+                  f"{run['p95_ms']:>10.1f}{run['p99_ms']:>10.1f}{run['errors']:>8}"
+                  f"{changes(run, previous, ('throughput_rps',) + LATENCY_KEYS)}")
+
+    if results["peak_rss_mb"] is not None:
+        print(f"\npeak RSS: {results['peak_rss_mb']:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="corpus directory (default: generate one in a temporary directory)")
+    parser.add_argument("--count", type=int, default=6, help="certificates to generate without --corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--services", default=",".join(SERVICES), help=f"comma-separated subset of {SERVICES}")
+    parser.add_argument("--concurrency", default="1,4", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=12, help="requests per concurrency level")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="seconds per mock LLM call")
+    parser.add_argument("--with-cache", action="store_true", help="keep the result caches enabled")
+    parser.add_argument("--skip-stages", action="store_true")
+    parser.add_argument("--skip-endpoints", action="store_true")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="earlier --json output to compare against")
+    args = parser.parse_args()
+
+    services = [name.strip() for name in args.services.split(",") if name.strip()]
+    unknown = set(services) - set(SERVICES)
+    if unknown:
+        sys.exit(f"Unknown services: {', '.join(sorted(unknown))}")
+    json_path = os.path.abspath(args.json) if args.json else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    work_dir = tempfile.mkdtemp(prefix="certify-bench-")
+    corpus_dir = os.path.abspath(args.corpus) if args.corpus else os.path.join(work_dir, "corpus")
+    if not os.path.exists(os.path.join(corpus_dir, "manifest.json")):
+        build_corpus(corpus_dir, args.count, args.seed)
+    documents = load_manifest(corpus_dir)
+
+    mock = serve_mock_llm(port=0, latency=args.llm_latency)
+    configure_environment(work_dir, f"http://127.0.0.1:{mock.server_address[1]}/generate", args.with_cache)
+    modules = import_services(services)
+
+    timer = StageTimer()
+    if not args.skip_stages:
+        bench_stages(modules, corpus_dir, documents, timer)
+    endpoints = {}
+    if not args.skip_endpoints:
+        levels = [int(level) for level in args.concurrency.split(",")]
+        endpoints = bench_endpoints(modules, corpus_dir, documents, levels, args.requests)
+    mock.shutdown()
+
+    results = {
+        "meta": {
+            "git_commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "result_cache": args.with_cache,
+            "llm_latency_seconds": args.llm_latency,
+        },
+        "corpus": {
+            "documents": len(documents),
+            "pages": sum(entry["pages"] for entry in documents),
+            "kinds": sorted({entry["kind"] for entry in documents}),
+        },
+        "stages": timer.report(),
+        "endpoints": endpoints,
+        "mock_llm": dict(mock.stats),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print_report(results, baseline)
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
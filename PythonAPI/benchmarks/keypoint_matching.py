@@ -0,0 +1,157 @@
+"""
+Speed / accuracy trade-off of the keypoint matchers against the original
+per-call SIFT + BFMatcher + Python ratio loop.
+
+    python benchmarks/keypoint_matching.py                      # synthetic crops
+    python benchmarks/keypoint_matching.py --images uploads/crops --json out.json
+
+Each image is paired with a perturbed copy of itself (rotation, rescale,
+noise, JPEG) as a genuine pair and with a different image as an impostor
+pair. Reported per configuration: median describe+match time per pair,
+genuine/impostor match rates at the 0.75 threshold, and the mean absolute
+score difference from the original implementation.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from keypoint_matching import MATCHERS  # noqa: E402
+
+THRESHOLD = 0.75
+
+
+# ---------------- Original Implementation ----------------
+def legacy_similarity(gray1, gray2):
+    """The matching code compare_crops used before the matching engine."""
+    sift = cv2.SIFT_create()
+    kp1, des1 = sift.detectAndCompute(gray1, None)
+    kp2, des2 = sift.detectAndCompute(gray2, None)
+    if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
+        return 0.0
+    matches = cv2.BFMatcher().knnMatch(des1, des2, k=2)
+    good = [m for pair in matches if len(pair) == 2 for m, n in [pair] if m.distance < 0.75 * n.distance]
+    min_keypoints = min(len(kp1), len(kp2))
+    return len(good) / min_keypoints if min_keypoints else 0.0
+
+
+# ---------------- Inputs ----------------
+def synthetic_signature(rng, size=(900, 320)):
+    """Random pen strokes, roughly the size of a 300-DPI signature crop."""
+    width, height = size
+    img = np.full((height, width), 255, np.uint8)
+    for _ in range(rng.integers(3, 7)):
+        points = np.cumsum(rng.normal(0, 25, size=(40, 2)), axis=0)
+        points += (rng.integers(100, width - 100), rng.integers(80, height - 80))
+        cv2.polylines(img, [points.astype(np.int32)], False, 0, int(rng.integers(2, 5)), cv2.LINE_AA)
+    return img
+
+
+def synthetic_profile(rng, size=(600, 750)):
+    """Smooth blobs plus texture, roughly the size of a passport photo crop."""
+    width, height = size
+    img = cv2.resize(rng.integers(0, 255, (12, 10), dtype=np.uint8), (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = rng.integers(0, 40, (height, width), dtype=np.uint8)
+    img = cv2.add(img, noise)
+    for _ in range(8):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(img, center, int(rng.integers(20, 120)), int(rng.integers(0, 255)), -1)
+    return cv2.GaussianBlur(img, (5, 5), 0)
+
+
+def perturb(img, rng):
+    """A re-scanned copy: small rotation, rescale, sensor noise and JPEG."""
+    height, width = img.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), rng.uniform(-3, 3), rng.uniform(0.9, 1.1))
+    out = cv2.warpAffine(img, matrix, (width, height), borderValue=255)
+    out = cv2.add(out, rng.integers(0, 12, out.shape, dtype=np.uint8))
+    _, encoded = cv2.imencode(".jpg", out, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    return cv2.imdecode(encoded, cv2.IMREAD_GRAYSCALE)
+
+
+def load_inputs(images_dir, count, rng):
+    if images_dir:
+        paths = sorted(glob.glob(os.path.join(images_dir, "*")))[:count]
+        images = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in paths]
+        return [img for img in images if img is not None]
+    half = count // 2
+    return [synthetic_signature(rng) for _ in range(half)] + [synthetic_profile(rng) for _ in range(count - half)]
+
+
+# ---------------- Benchmark ----------------
+def run_config(label, similarity, pairs):
+    timings, scores = [], []
+    for img1, img2 in pairs:
+        start = time.perf_counter()
+        scores.append(similarity(img1, img2))
+        timings.append((time.perf_counter() - start) * 1000)
+    return label, timings, scores
+
+
+def summarize(label, timings, scores, labels, legacy_scores):
+    genuine = [s for s, same in zip(scores, labels) if same]
+    impostor = [s for s, same in zip(scores, labels) if not same]
+    return {
+        "matcher": label,
+        "median_ms": statistics.median(timings),
+        "mean_ms": statistics.mean(timings),
+        "genuine_match_rate": sum(s >= THRESHOLD for s in genuine) / max(len(genuine), 1),
+        "impostor_match_rate": sum(s >= THRESHOLD for s in impostor) / max(len(impostor), 1),
+        "mean_genuine_score": statistics.mean(genuine) if genuine else 0.0,
+        "mean_impostor_score": statistics.mean(impostor) if impostor else 0.0,
+        "mean_abs_diff_vs_legacy": float(np.mean(np.abs(np.array(scores) - np.array(legacy_scores)))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="directory of crop images (default: synthetic crops)")
+    parser.add_argument("--count", type=int, default=20, help="number of base images")
+    parser.add_argument("--max-sides", default="0,1024,512", help="comma-separated downscale limits (0 = none)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    images = load_inputs(args.images, args.count, rng)
+    if len(images) < 2:
+        sys.exit("Need at least two images")
+
+    pairs, labels = [], []
+    for idx, img in enumerate(images):
+        pairs.append((img, perturb(img, rng)))
+        labels.append(True)
+        pairs.append((img, images[(idx + 1) % len(images)]))
+        labels.append(False)
+
+    _, legacy_timings, legacy_scores = run_config("legacy", legacy_similarity, pairs)
+    rows = [summarize("legacy sift+bf", legacy_timings, legacy_scores, labels, legacy_scores)]
+    for max_side in (int(value) for value in args.max_sides.split(",")):
+        for name, matcher_cls in MATCHERS.items():
+            matcher = matcher_cls(max_side=max_side)
+            label = f"{name} max_side={max_side or 'none'}"
+            _, timings, scores = run_config(
+                label, lambda a, b: matcher.similarity(matcher.describe(a), matcher.describe(b)), pairs
+            )
+            rows.append(summarize(label, timings, scores, labels, legacy_scores))
+
+    header = f"{'matcher':<28}{'median ms':>10}{'genuine':>9}{'impostor':>9}{'|d| vs legacy':>15}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(f"{row['matcher']:<28}{row['median_ms']:>10.1f}{row['genuine_match_rate']:>9.2f}"
+              f"{row['impostor_match_rate']:>9.2f}{row['mean_abs_diff_vs_legacy']:>15.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"pairs": len(pairs), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
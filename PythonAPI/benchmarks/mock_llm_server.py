@@ -0,0 +1,102 @@
+"""
+Local stand-in for the LLM, for benchmarks and tests without Gemini.
+
+    python benchmarks/mock_llm_server.py --latency 1.5 --fail-rate 0.1
+    LLM_BACKEND=http LLM_HTTP_URL=http://127.0.0.1:8765/generate python ocr_functions.py
+
+POST /generate {"prompt"} answers {"text"} after --latency seconds with a
+JSON object in the shape build_batch_prompt asks for: every page and key
+listed in the prompt, with values found by the local regexes or null.
+--fail-rate makes that share of requests return 503 to exercise retries.
+GET /stats reports the number of requests and the peak concurrency.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from field_extractor import regex_candidates  # noqa: E402
+
+PAGE = re.compile(r'Page (\d+) \(keys: ([^)]*)\):\n"""(.*?)"""', re.DOTALL)
+
+
+def answer(prompt):
+    pages = {}
+    for page_number, keys, text in PAGE.findall(prompt):
+        found = regex_candidates(text)
+        pages[page_number] = {key: found[key][0] if key in found else None for key in keys.split(", ")}
+    return json.dumps(pages)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def _send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self._send(404, {"error": "not found"})
+        self._send(200, self.server.stats)
+
+    def do_POST(self):
+        if self.path != "/generate":
+            return self._send(404, {"error": "not found"})
+        prompt = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))["prompt"]
+        stats = self.server.stats
+        with self.server.lock:
+            stats["requests"] += 1
+            stats["active"] += 1
+            stats["peak_concurrency"] = max(stats["peak_concurrency"], stats["active"])
+        try:
+            time.sleep(self.server.latency)
+            if random.random() < self.server.fail_rate:
+                return self._send(503, {"error": "mock overload"})
+            self._send(200, {"text": answer(prompt)})
+        finally:
+            with self.server.lock:
+                stats["active"] -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=8765, latency=1.0, fail_rate=0.0):
+    """Starts the server on a background thread and returns it (call shutdown() to stop)."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.latency = latency
+    server.fail_rate = fail_rate
+    server.lock = threading.Lock()
+    server.stats = {"requests": 0, "active": 0, "peak_concurrency": 0}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds per request")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with 503")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.latency, args.fail_rate)
+    print(f"Mock LLM listening on http://{args.host}:{args.port}/generate")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Import time and per-model load time of a Python service.
+
+    python benchmarks/startup.py compare_certificates
+    python benchmarks/startup.py ocr_functions --json startup.json
+
+The service module is imported in a fresh interpreter (so nothing is
+cached in-process), then every registered model is warmed up and the
+model registry's timings are printed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter() - started
+from model_registry import registry
+registry.warmup()
+status = registry.status()
+status["import_total_seconds"] = imported
+status["startup_total_seconds"] = time.perf_counter() - started
+print(json.dumps(status))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("module", help="service module, e.g. compare_certificates")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PRELOAD_MODELS="0", WARMUP_IN_BACKGROUND="0")
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(module=args.module)],
+        cwd=SERVICE_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    status = json.loads(output.strip().splitlines()[-1])
+
+    print(f"import {args.module}: {status['import_total_seconds']:.2f}s")
+    for name, model in status["models"].items():
+        print(f"  load {name}: {model['load_seconds']:.2f}s")
+    print(f"ready after {status['startup_total_seconds']:.2f}s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(status, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+# ---------------- Issued Certificate Index ----------------
+# Character-trigram index over the fields of every issued certificate
+# (name, rollNo, certificateId, year, grade), so noisy OCR text can be
+# checked against the Certificate table without an exact match:
+#   * names, years and grades are indexed as lower-case words, padded with
+#     spaces so word starts and ends count
+#   * IDs and roll numbers are indexed compacted (no spaces or punctuation)
+#     with OCR look-alikes folded (O->0, I/L->1, S->5, B->8, Z->2), so
+#     "R0LL N0 2O19-CS 0l7" still matches "2019CS017"
+# A query is either a page of OCR text or already extracted fields. Rare
+# trigrams (weighted by IDF) pick a few candidate certificates; each
+# candidate then gets a score per field: the share of the field's trigrams
+# found in the text, or the Dice coefficient against an extracted value.
+# Values shorter than MIN_TEXT_FIELD_CHARS (one-letter grades) would be found
+# in almost any text, so they are only checked against extracted fields. A
+# key field (rollNo, certificateId) the certificate has but the extracted
+# fields lack scores 0, so a name alone never makes a match.
+#
+# The index lives in memory. It is loaded from a database snapshot
+# (VERIFY_DB: a SQLite file or a postgresql:// URL of the app database,
+# which needs psycopg2) and updated one certificate at a time on ingest.
+
+VERIFY_DB = os.getenv(
+    "VERIFY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "certificates.sqlite3")
+)
+# Candidates scored in full per query
+VERIFY_CANDIDATES = int(os.getenv("VERIFY_CANDIDATES", 50))
+# Trigrams found in more than this share of certificates do not nominate candidates
+VERIFY_MAX_POSTING_RATIO = float(os.getenv("VERIFY_MAX_POSTING_RATIO", 0.2))
+
+SPACE_WORDS = "words"
+SPACE_COMPACT = "compact"
+
+# field -> (index space, weight in the overall score)
+FIELDS = {
+    "name": (SPACE_WORDS, 2.0),
+    "rollNo": (SPACE_COMPACT, 3.0),
+    "certificateId": (SPACE_COMPACT, 3.0),
+    "year": (SPACE_WORDS, 1.0),
+    "grade": (SPACE_WORDS, 0.5),
+}
+# Fields that identify one certificate
+KEY_FIELDS = ("rollNo", "certificateId")
+MIN_TEXT_FIELD_CHARS = 3
+# Field names used by the OCR services and the upload route
+FIELD_ALIASES = {
+    "roll_number": "rollNo",
+    "roll_no": "rollNo",
+    "certificate_id": "certificateId",
+    "organisation_id": "organisationId",
+}
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+_LOOKALIKES = str.maketrans("oilsbz", "011582")
+
+
+def normalise_words(text):
+    """Lower-case ASCII words separated by single spaces."""
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(char for char in text if not unicodedata.combining(char)).lower()
+    return _NON_ALNUM.sub(" ", text).strip()
+
+
+def normalise_compact(text):
+    """Letters and digits only, with OCR look-alike letters folded into digits."""
+    return normalise_words(text).replace(" ", "").translate(_LOOKALIKES)
+
+
+def trigrams(text, space):
+    if space == SPACE_WORDS:
+        text = normalise_words(text)
+        if not text:
+            return frozenset()
+        text = f" {text} "
+    else:
+        text = normalise_compact(text)
+        if not text:
+            return frozenset()
+    if len(text) < 3:
+        return frozenset([text])
+    return frozenset(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def canonical_record(record):
+    """Certificate dict with the Prisma field names."""
+    return {FIELD_ALIASES.get(key, key): value for key, value in record.items()}
+
+
+class CertificateIndex:
+    def __init__(self):
+        self._records = {}
+        self._grams = {}
+        self._postings = {SPACE_WORDS: {}, SPACE_COMPACT: {}}
+        self._lock = threading.Lock()
+        self.source = None
+
+    def __len__(self):
+        return len(self._records)
+
+    # ---------------- Updates ----------------
+    def _unindex(self, certificate_id):
+        for field, grams in self._grams.pop(certificate_id, {}).items():
+            postings = self._postings[FIELDS[field][0]]
+            for gram in grams:
+                ids = postings.get(gram)
+                if ids is not None:
+                    ids.discard(certificate_id)
+                    if not ids:
+                        del postings[gram]
+
+    def add(self, record):
+        """Adds or replaces one certificate; record needs an "id" plus any of FIELDS."""
+        record = canonical_record(record)
+        certificate_id = record.get("id")
+        if certificate_id is None:
+            raise ValueError("Certificate record needs an id")
+        grams = {}
+        for field, (space, _) in FIELDS.items():
+            if record.get(field) and (grams_value := trigrams(record[field], space)):
+                grams[field] = grams_value
+        with self._lock:
+            self._unindex(certificate_id)
+            self._records[certificate_id] = record
+            self._grams[certificate_id] = grams
+            for field, field_grams in grams.items():
+                postings = self._postings[FIELDS[field][0]]
+                for gram in field_grams:
+                    postings.setdefault(gram, set()).add(certificate_id)
+
+    def remove(self, certificate_id):
+        with self._lock:
+            if self._records.pop(certificate_id, None) is None:
+                return False
+            self._unindex(certificate_id)
+            return True
+
+    def get(self, certificate_id):
+        return self._records.get(certificate_id)
+
+    def replace(self, other):
+        """Takes over another index's contents at once, so lookups never see a half-loaded index."""
+        with self._lock:
+            self._records, self._grams, self._postings = other._records, other._grams, other._postings
+            self.source = other.source
+
+    # ---------------- Queries ----------------
+    def _candidates(self, query_grams, allowed, limit):
+        """Certificate IDs sharing the most (IDF-weighted) rare trigrams with the query."""
+        total = len(self._records)
+        max_postings = max(1, int(total * VERIFY_MAX_POSTING_RATIO)) if total >= 100 else total
+        weights = {}
+        for space, grams in query_grams.items():
+            postings = self._postings[space]
+            for gram in grams:
+                ids = postings.get(gram)
+                if not ids or len(ids) > max_postings:
+                    continue
+                idf = math.log(1 + total / len(ids))
+                for certificate_id in ids:
+                    weights[certificate_id] = weights.get(certificate_id, 0.0) + idf
+        if allowed is not None:
+            weights = {certificate_id: weight for certificate_id, weight in weights.items() if allowed(certificate_id)}
+        return sorted(weights, key=weights.get, reverse=True)[:limit]
+
+    def _score(self, certificate_id, text_grams, field_grams):
+        """(overall score, {field: score}) for one certificate."""
+        scores = {}
+        weighted = weight_sum = 0.0
+        record = self._records[certificate_id]
+        for field, grams in self._grams[certificate_id].items():
+            space, weight = FIELDS[field]
+            if field in field_grams:
+                query = field_grams[field]
+                score = 2 * len(grams & query) / (len(grams) + len(query)) if query else 0.0
+            elif text_grams is not None:
+                if len(normalise_compact(record[field])) < MIN_TEXT_FIELD_CHARS:
+                    continue
+                score = len(grams & text_grams[space]) / len(grams)
+            elif field in KEY_FIELDS:
+                score = 0.0
+            else:
+                continue
+            scores[field] = round(score, 4)
+            weighted += weight * score
+            weight_sum += weight
+        return (weighted / weight_sum if weight_sum else 0.0), scores
+
+    def search(self, text=None, fields=None, organisation_id=None, organisation=None, k=3):
+        """
+        Best matching issued certificates for OCR text and/or extracted
+        fields, best first: [{"id", "score", "field_scores", "certificate"}].
+        organisation_id / organisation (name) restrict the search.
+        """
+        fields = {key: value for key, value in canonical_record(fields or {}).items()
+                  if key in FIELDS and value}
+        text_grams = None
+        if text:
+            text_grams = {SPACE_WORDS: trigrams(text, SPACE_WORDS), SPACE_COMPACT: trigrams(text, SPACE_COMPACT)}
+        field_grams = {field: trigrams(value, FIELDS[field][0]) for field, value in fields.items()}
+
+        query_grams = {SPACE_WORDS: set(), SPACE_COMPACT: set()}
+        if text_grams is not None:
+            for space, grams in text_grams.items():
+                query_grams[space].update(grams)
+        for field, grams in field_grams.items():
+            query_grams[FIELDS[field][0]].update(grams)
+
+        allowed = None
+        if organisation_id is not None or organisation:
+            wanted_name = normalise_words(organisation) if organisation else None
+
+            def allowed(certificate_id):
+                record = self._records[certificate_id]
+                if organisation_id is not None and str(record.get("organisationId")) != str(organisation_id):
+                    return False
+                return wanted_name is None or normalise_words(record.get("organisation") or "") == wanted_name
+
+        with self._lock:
+            candidates = self._candidates(query_grams, allowed, max(VERIFY_CANDIDATES, k))
+            results = []
+            for certificate_id in candidates:
+                score, field_scores = self._score(certificate_id, text_grams, field_grams)
+                results.append({
+                    "id": certificate_id,
+                    "score": round(score, 4),
+                    "field_scores": field_scores,
+                    "certificate": dict(self._records[certificate_id]),
+                })
+        results.sort(key=lambda result: result["score"], reverse=True)
+        return results[:k]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "certificates": len(self._records),
+                "trigrams": {space: len(postings) for space, postings in self._postings.items()},
+                "source": self.source,
+            }
+
+
+# ---------------- Database Snapshots ----------------
+# Snapshots written by write_snapshot() keep the organisation name in an
+# extra "organisation" column; the app database joins its Organisation table.
+_COLUMNS = ("id", "name", "degree", "rollNo", "certificateId", "year", "grade", "organisationId")
+_SELECT = (
+    'SELECT c."id", c."name", c."degree", c."rollNo", c."certificateId", c."year", c."grade", '
+    'c."organisationId", o."name" FROM "Certificate" c LEFT JOIN "Organisation" o ON o."id" = c."organisationId"'
+)
+_SELECT_SNAPSHOT = (
+    'SELECT "id", "name", "degree", "rollNo", "certificateId", "year", "grade", "organisationId", "organisation" '
+    'FROM "Certificate"'
+)
+# Snapshots written before the organisation column existed
+_SELECT_WITHOUT_ORGANISATIONS = (
+    'SELECT "id", "name", "degree", "rollNo", "certificateId", "year", "grade", "organisationId", NULL '
+    'FROM "Certificate"'
+)
+
+
+def _is_postgres(source):
+    return source.startswith(("postgres://", "postgresql://"))
+
+
+def _rows_to_records(rows):
+    return [dict(zip(_COLUMNS + ("organisation",), row)) for row in rows]
+
+
+def read_snapshot(source=VERIFY_DB):
+    """Certificate records from a SQLite snapshot or the Postgres database; [] if the file does not exist."""
+    if _is_postgres(source):
+        import psycopg2
+        with psycopg2.connect(source) as conn, conn.cursor() as cursor:
+            cursor.execute(_SELECT)
+            return _rows_to_records(cursor.fetchall())
+
+    if not os.path.exists(source):
+        return []
+    with sqlite3.connect(source) as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if "Certificate" not in tables:
+            return []
+        if "Organisation" in tables:
+            query = _SELECT
+        elif "organisation" in _certificate_columns(conn):
+            query = _SELECT_SNAPSHOT
+        else:
+            query = _SELECT_WITHOUT_ORGANISATIONS
+        return _rows_to_records(conn.execute(query).fetchall())
+
+
+def _certificate_columns(conn):
+    return {row[1] for row in conn.execute('PRAGMA table_info("Certificate")')}
+
+
+def write_snapshot(records, path=VERIFY_DB):
+    """
+    Upserts certificate records into a SQLite snapshot (Prisma's table and
+    column names, plus the organisation name).
+    """
+    columns = _COLUMNS + ("organisation",)
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS "Certificate" ("id" INTEGER PRIMARY KEY, "name" TEXT, "degree" TEXT, '
+            '"rollNo" TEXT, "certificateId" TEXT, "year" TEXT, "grade" TEXT, "organisationId" INTEGER, '
+            '"organisation" TEXT)'
+        )
+        if "organisation" not in _certificate_columns(conn):
+            conn.execute('ALTER TABLE "Certificate" ADD COLUMN "organisation" TEXT')
+        names = ", ".join(f'"{column}"' for column in columns)
+        conn.executemany(
+            f'INSERT OR REPLACE INTO "Certificate" ({names}) VALUES ({", ".join("?" for _ in columns)})',
+            [tuple(canonical_record(record).get(column) for column in columns) for record in records],
+        )
+
+
+def delete_from_snapshot(certificate_id, path=VERIFY_DB):
+    if not os.path.exists(path):
+        return
+    with sqlite3.connect(path) as conn:
+        conn.execute('DELETE FROM "Certificate" WHERE "id" = ?', (certificate_id,))
+
+
+def load_index(source=VERIFY_DB):
+    index = CertificateIndex()
+    for record in read_snapshot(source):
+        index.add(record)
+    index.source = source if not _is_postgres(source) else "postgresql"
+    return index
@@ -1,72 +1,73 @@
+import time
+_import_started = time.perf_counter()
+
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from PIL import Image
 import io
-import fitz  # PyMuPDF
+import os
 import torch
-from torchvision import models, transforms
-import cv2
 import numpy as np
-from ultralytics import YOLO
+from rasterizer import iter_pdf_pages
+from reference_store import ReferenceStore
+from keypoint_matching import get_matcher
+from jobs import register_job, create_jobs_blueprint
+from model_registry import registry, create_ready_blueprint, finish_startup
+from similarity_index import SimilarityIndex, perceptual_hash
+from result_cache import get_cache, hash_bytes, make_key, cache_stats
+from inference_backends import create_embedder, embedder_version, load_yolo, yolo_model_path, preprocess
+from tracing import instrument_app, timed, stage
 
 app = Flask(__name__)
 CORS(app)
+instrument_app(app, "compare")
 
 # ---------------- YOLO Model ----------------
 # Ensure the model path is correct for your environment
-yolo_model = YOLO(r"../models/my_model.pt")
+YOLO_MODEL_PATH = r"../models/my_model.pt"
+
+# YOLO_BACKEND=pytorch|onnx|torchscript picks the weights written by model_export.py
+registry.register("yolo", lambda: load_yolo(YOLO_MODEL_PATH))
+
+# Bump YOLO_MODEL_VERSION when the weights change so cached crops are discarded
+YOLO_MODEL_VERSION = os.getenv("YOLO_MODEL_VERSION", os.path.basename(yolo_model_path(YOLO_MODEL_PATH)))
+PDF_DPI = int(os.getenv("COMPARE_PDF_DPI", 300))
 
 # ---------------- Deep Learning Model for Crop Comparison ----------------
-resnet_model = models.resnet50(pretrained=True)
-resnet_model = torch.nn.Sequential(*list(resnet_model.children())[:-1])
-resnet_model.eval()
-cos = torch.nn.CosineSimilarity(dim=1, eps=1e-6)
+# Intra-op threads for the CPU matmuls; defaults to one per core
+torch.set_num_threads(int(os.getenv("TORCH_NUM_THREADS", os.cpu_count() or 1)))
+# EMBEDDER_BACKEND / EMBEDDER_BACKBONE select the embedder (see inference_backends)
+EMBEDDER_VERSION = embedder_version()
 
-preprocess = transforms.Compose([
-    transforms.Resize(256),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                         std=[0.229, 0.224, 0.225])
-])
+registry.register("embedder", create_embedder)
+cos = torch.nn.CosineSimilarity(dim=1, eps=1e-6)
 
 # ---------------- File Loader (REVISED) ----------------
 def load_image(file_bytes, file_type):
     """
     Load a scanned image or a PDF page as a PIL Image.
-    This function has been revised for more robust PDF handling.
+    PDF pages are rendered straight from the pixmap buffer without a PNG round trip.
     """
     if file_type == "normal":  # PDF
         try:
-            doc = fitz.open(stream=file_bytes, filetype="pdf")
-            # Using load_page is slightly more robust
-            page = doc.load_page(0)  # Process only the first page
-            pix = page.get_pixmap(dpi=300)  # Render at high resolution
-            doc.close()
-
-            # The original numpy conversion can be fragile. A better method is to
-            # convert the pixmap to a standard format (like PNG) in memory and
-            # then load it with PIL. This handles different color spaces reliably.
-            img_data = pix.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-
-            # Ensure the image is in RGB format, as required by the models.
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            return img
+            # Process only the first page, rendered directly as RGB
+            with stage("rasterize"):
+                _, page = next(iter_pdf_pages(file_bytes, dpi=PDF_DPI, page_numbers=[1]))
+            return Image.fromarray(page)
         except Exception as e:
             # Propagate error with more context
             raise RuntimeError(f"Failed to process PDF file: {e}") from e
 
     else:  # Scanned images (e.g., JPEG, PNG)
-        img = Image.open(io.BytesIO(file_bytes)).convert("RGB")
+        with stage("decode"):
+            img = Image.open(io.BytesIO(file_bytes)).convert("RGB")
         return img
 
 # ---------------- YOLO Crop Extractor ----------------
+@timed("yolo")
 def crop_from_yolo(image):
     """Returns the first most confident profile and signature crops."""
-    results = yolo_model(image)
+    results = registry.get("yolo")(image)
     profile_crop = None
     sign_crop = None
 
@@ -83,65 +84,162 @@ def crop_from_yolo(image):
                     sign_crop = crop
     return profile_crop, sign_crop
 
+def _crops_key(digest, file_type):
+    return make_key(digest, stage="yolo", file_type=file_type, dpi=PDF_DPI, model=YOLO_MODEL_VERSION)
+
+def load_crops(file_bytes, file_type):
+    """
+    Loads a document and returns its YOLO crops, cached by file content so a
+    reference image compared against many scans is only processed once.
+    """
+    return get_cache("yolo_crops").get_or_compute(
+        _crops_key(hash_bytes(file_bytes), file_type),
+        lambda: crop_from_yolo(load_image(file_bytes, file_type))
+    )
+
+def load_crops_and_hash(file_bytes, file_type):
+    """YOLO crops plus the page's perceptual hash; the page is rendered at most once."""
+    digest = hash_bytes(file_bytes)
+    crop_cache, hash_cache = get_cache("yolo_crops"), get_cache("page_hashes")
+    crops_key = _crops_key(digest, file_type)
+    hash_key = make_key(digest, stage="phash", file_type=file_type, dpi=PDF_DPI)
+
+    image = None
+    crops = crop_cache.get(crops_key)
+    if crops is None:
+        image = load_image(file_bytes, file_type)
+        crops = crop_from_yolo(image)
+        crop_cache.set(crops_key, crops)
+    phash = hash_cache.get(hash_key)
+    if phash is None:
+        if image is None:
+            image = load_image(file_bytes, file_type)
+        with stage("phash"):
+            phash = perceptual_hash(image)
+        hash_cache.set(hash_key, phash)
+    return crops, phash
+
 # ---------------- Feature Extractor ----------------
+def crop_digest(image):
+    """Content hash of a PIL crop, used as the embedding cache key."""
+    return hash_bytes(image.tobytes() + f"{image.mode}{image.size}".encode())
+
+def extract_features_batch(images):
+    """
+    Embeds many crops with a single batched forward pass.
+    Returns one float32 vector per crop; crops seen before come from the cache.
+    """
+    if not images:
+        return []
+    cache = get_cache("embeddings")
+    keys = [make_key(crop_digest(image), stage="embed", model=EMBEDDER_VERSION) for image in images]
+    features = [cache.get(key) for key in keys]
+    missing = [i for i, feat in enumerate(features) if feat is None]
+    if missing:
+        with stage("embed"):
+            batch = torch.stack([preprocess(images[i]) for i in missing])
+            embedded = registry.get("embedder")(batch)
+        for i, vector in zip(missing, embedded):
+            features[i] = vector.copy()
+            cache.set(keys[i], features[i])
+    return features
+
 def extract_features(image):
     """Extracts deep learning features from an image crop."""
-    img_t = preprocess(image).unsqueeze(0)
-    with torch.no_grad():
-        features = resnet_model(img_t)
-    return features
+    return torch.from_numpy(extract_features_batch([image])[0]).unsqueeze(0)
 
 # ---------------- Compare Crops (REVISED) ----------------
-def compare_crops(crop1, crop2):
-    """
-    Compares two image crops using both a deep learning model and SIFT.
-    This function has been revised for more robust SIFT comparison.
-    """
+REGIONS = (("profile", "Profile"), ("sign", "Signature"))
+
+# Keypoint matcher for /compare-images (KEYPOINT_MATCHER); the reference store
+# always holds SIFT descriptors, so ingest/verify use a SIFT matcher
+keypoint_matcher = get_matcher()
+reference_matcher = get_matcher(descriptor="sift")
+
+def compare_signatures(signature1, signature2, matcher=None):
+    """Compares two (embedding, keypoint_descriptors) pairs."""
+    matcher = matcher or keypoint_matcher
+    (emb1, des1), (emb2, des2) = signature1, signature2
+
     # --- Deep Learning Comparison ---
-    feat1 = extract_features(crop1)
-    feat2 = extract_features(crop2)
+    feat1, feat2 = (torch.from_numpy(np.asarray(emb, dtype=np.float32)).unsqueeze(0) for emb in (emb1, emb2))
     sim_dl = cos(feat1, feat2).item()
     is_same_dl = sim_dl >= 0.95
 
-    # --- SIFT Comparison ---
-    sim_sift = 0.0
-    try:
-        img1 = cv2.cvtColor(np.array(crop1), cv2.COLOR_RGB2GRAY)
-        img2 = cv2.cvtColor(np.array(crop2), cv2.COLOR_RGB2GRAY)
-        sift = cv2.SIFT_create()
-        kp1, des1 = sift.detectAndCompute(img1, None)
-        kp2, des2 = sift.detectAndCompute(img2, None)
-
-        # Ensure we have enough descriptors to compare for knnMatch (k=2)
-        if des1 is not None and des2 is not None and len(des1) >= 2 and len(des2) >= 2:
-            bf = cv2.BFMatcher()
-            matches = bf.knnMatch(des1, des2, k=2)
-
-            # Apply Lowe's ratio test to find good matches.
-            # Added a check to ensure each keypoint has two matches before unpacking.
-            good_matches = []
-            for match_pair in matches:
-                if len(match_pair) == 2:
-                    m, n = match_pair
-                    if m.distance < 0.75 * n.distance:
-                        good_matches.append(m)
-            
-            # Calculate similarity score, avoiding division by zero.
-            min_keypoints = min(len(kp1), len(kp2))
-            if min_keypoints > 0:
-                sim_sift = len(good_matches) / min_keypoints
-
-    except cv2.error as e:
-        # SIFT can sometimes throw errors. This catch prevents the entire request from failing.
-        print(f"A non-critical SIFT error occurred: {e}")
-        sim_sift = 0.0
-
+    # --- Keypoint (SIFT/ORB) Comparison ---
+    sim_sift = matcher.similarity(des1, des2)
     is_same_sift = sim_sift >= 0.75
     return {
         "deep_learning_similarity": sim_dl, "deep_learning_match": is_same_dl,
-        "sift_similarity": sim_sift, "sift_match": is_same_sift
+        "sift_similarity": sim_sift, "sift_match": is_same_sift,
+        "sift_matcher": matcher.name
     }
 
+def compare_crops(crop1, crop2, features=None, matcher=None):
+    """
+    Compares two image crops using both a deep learning model and SIFT.
+    features optionally holds the two precomputed embeddings.
+    """
+    matcher = matcher or keypoint_matcher
+    if features is None:
+        features = extract_features_batch([crop1, crop2])
+    return compare_signatures((features[0], matcher.describe(crop1)),
+                              (features[1], matcher.describe(crop2)), matcher)
+
+def describe_crops(documents, matcher=None):
+    """
+    Embeds and SIFT-describes the crops of several documents at once.
+    documents is a list of {"profile": crop|None, "sign": crop|None}; every
+    crop goes through a single batched forward pass. Returns the same shape
+    with (embedding, keypoint_descriptors) in place of each crop.
+    """
+    matcher = matcher or keypoint_matcher
+    crops = [(idx, name, crop) for idx, doc in enumerate(documents)
+             for name, crop in doc.items() if crop is not None]
+    features = extract_features_batch([crop for _, _, crop in crops])
+    described = [dict.fromkeys(doc) for doc in documents]
+    for (idx, name, crop), feat in zip(crops, features):
+        described[idx][name] = (feat, matcher.describe(crop))
+    return described
+
+def compare_described(described1, described2, matcher=None):
+    """Builds the /compare-images result from two describe_crops outputs."""
+    results = {}
+    tampering_suspected = False
+    for name, label in REGIONS:
+        if described1.get(name) is not None and described2.get(name) is not None:
+            results[name] = compare_signatures(described1[name], described2[name], matcher)
+            # Suspect tampering if either method doesn't find a match
+            if not (results[name]["deep_learning_match"] and results[name]["sift_match"]):
+                tampering_suspected = True
+        else:
+            results[name] = {"error": f"{label} not detected in one or both images"}
+    results["tampering_suspected"] = tampering_suspected
+    return results
+
+def compare_documents(file_bytes1, file_type1, file_bytes2, file_type2, matcher=None, progress=None):
+    """Full /compare-images pipeline for two documents."""
+    # Load images and crop regions of interest
+    profile1, sign1 = load_crops(file_bytes1, file_type1)
+    profile2, sign2 = load_crops(file_bytes2, file_type2)
+    if progress:
+        progress(1, 2, "Regions detected")
+
+    # Embed all crops from both documents in one batched forward pass
+    described1, described2 = describe_crops([
+        {"profile": profile1, "sign": sign1},
+        {"profile": profile2, "sign": sign2},
+    ], matcher)
+    results = compare_described(described1, described2, matcher)
+    if progress:
+        progress(2, 2, "Compared")
+    return results
+
+# ---------------- Reference Store ----------------
+# Embeddings from a different EMBEDDER_BACKEND / EMBEDDER_BACKBONE are refused
+reference_store = ReferenceStore(embedder=EMBEDDER_VERSION)
+similarity_index = SimilarityIndex(reference_store)
+
 # ---------------- Flask API ----------------
 @app.route("/compare-images", methods=["POST"])
 def compare_images():
@@ -152,43 +250,127 @@ def compare_images():
     file2 = request.files['file2']
     file_type1 = request.form.get("file_type1", "scanned")
     file_type2 = request.form.get("file_type2", "scanned")
+    try:
+        # Optional per-request override: "sift-bf" | "sift-flann" | "orb"
+        matcher = get_matcher(request.form.get("matcher"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        # Load images
-        img1 = load_image(file1.read(), file_type1)
-        img2 = load_image(file2.read(), file_type2)
+        results = compare_documents(file1.read(), file_type1, file2.read(), file_type2, matcher)
+        return jsonify({"results": results})
 
-        # Crop regions of interest
-        profile1, sign1 = crop_from_yolo(img1)
-        profile2, sign2 = crop_from_yolo(img2)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        results = {}
-        tampering_suspected = False
+@app.route("/references", methods=["POST"])
+def ingest_reference():
+    """
+    Ingests an issued certificate once: form fields certificate_id and
+    file_type ("scanned" | "normal"), plus the file. Later verifications
+    against this ID only embed the suspect scan.
+    """
+    certificate_id = request.form.get("certificate_id")
+    if 'file' not in request.files or not certificate_id:
+        return jsonify({"error": "file and certificate_id are required"}), 400
 
-        # Compare profile images
-        if profile1 and profile2:
-            results["profile"] = compare_crops(profile1, profile2)
-            # Suspect tampering if either method doesn't find a match
-            if not (results["profile"]["deep_learning_match"] and results["profile"]["sift_match"]):
-                tampering_suspected = True
-        else:
-            results["profile"] = {"error": "Profile not detected in one or both images"}
+    file_type = request.form.get("file_type", "scanned")
+    try:
+        (profile, sign), phash = load_crops_and_hash(request.files['file'].read(), file_type)
+        described = describe_crops([{"profile": profile, "sign": sign}], reference_matcher)[0]
+        if all(value is None for value in described.values()):
+            return jsonify({"error": "Neither profile nor signature detected"}), 422
+        reference_store.add(certificate_id, described, phash=phash)
+        return jsonify({
+            "certificate_id": certificate_id,
+            "profile": described["profile"] is not None,
+            "sign": described["sign"] is not None,
+        })
 
-        # Compare signatures
-        if sign1 and sign2:
-            results["sign"] = compare_crops(sign1, sign2)
-            # Suspect tampering if either method doesn't find a match
-            if not (results["sign"]["deep_learning_match"] and results["sign"]["sift_match"]):
-                tampering_suspected = True
-        else:
-            results["sign"] = {"error": "Signature not detected in one or both images"}
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/verify/<certificate_id>", methods=["POST"])
+def verify_against_reference(certificate_id):
+    """Compares an uploaded scan (file, file_type) with an ingested certificate."""
+    if 'file' not in request.files:
+        return jsonify({"error": "File is required"}), 400
 
-        results["tampering_suspected"] = tampering_suspected
+    try:
+        reference = reference_store.get(certificate_id)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    if reference is None:
+        return jsonify({"error": f"Unknown certificate_id '{certificate_id}'"}), 404
+
+    file_type = request.form.get("file_type", "scanned")
+    try:
+        profile, sign = load_crops(request.files['file'].read(), file_type)
+        described = describe_crops([{"profile": profile, "sign": sign}], reference_matcher)[0]
+        results = compare_described(reference, described, reference_matcher)
+        return jsonify({"certificate_id": certificate_id, "results": results})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/search-similar", methods=["POST"])
+def search_similar():
+    """
+    Finds issued certificates that look like the uploaded scan, without
+    knowing which original to compare against.
+    Form fields: file, file_type, k (default 5), max_distance (page-hash bits, default 10).
+    """
+    if 'file' not in request.files:
+        return jsonify({"error": "File is required"}), 400
+
+    file_type = request.form.get("file_type", "scanned")
+    try:
+        k = int(request.form.get("k", 5))
+        max_distance = int(request.form.get("max_distance", 10))
+    except ValueError:
+        return jsonify({"error": "k and max_distance must be integers"}), 400
+
+    try:
+        (profile, sign), phash = load_crops_and_hash(request.files['file'].read(), file_type)
+        crops = {name: crop for name, crop in (("profile", profile), ("sign", sign)) if crop is not None}
+        features = dict(zip(crops, extract_features_batch(list(crops.values()))))
+
+        results = {
+            "page_hash": {
+                "hash": f"{phash:016x}",
+                "matches": similarity_index.search_hash(phash, max_distance=max_distance, k=k),
+            }
+        }
+        for name, label in REGIONS:
+            if name in features:
+                results[name] = {"matches": similarity_index.search_embeddings(name, [features[name]], k=k)[0]}
+            else:
+                results[name] = {"error": f"{label} not detected in the image"}
         return jsonify({"results": results})
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@register_job("compare-images", stage="vision")
+def compare_images_job(files, params, progress):
+    """Job version of /compare-images: multipart file1/file2 plus the same form fields."""
+    if "file1" not in files or "file2" not in files:
+        raise ValueError("Both files are required")
+    matcher = get_matcher(params.get("matcher"))
+    results = compare_documents(files["file1"], params.get("file_type1", "scanned"),
+                                files["file2"], params.get("file_type2", "scanned"), matcher, progress)
+    return {"results": results}
+
+app.register_blueprint(create_jobs_blueprint("compare"))
+app.register_blueprint(create_ready_blueprint())
+
+@app.route("/cache-stats", methods=["GET"])
+def get_cache_stats():
+    """Hit/miss counters for this worker's result caches."""
+    return jsonify(cache_stats())
+
+finish_startup(__name__, _import_started)
+
 # ---------------- Run Flask ----------------
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,417 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from tracing import stage
+
+# ---------------- Local Field Extraction ----------------
+# Finds certificate fields without a network call and scores each one:
+#   * template-aware regexes ("This is to certify that ...", "Roll No: ...")
+#   * spaCy NER (PERSON / ORG / DATE) as a weaker fallback
+#   * layout anchors learned per organisation: the label text that preceded
+#     a confidently extracted value ("Enrolment No.") is remembered and used
+#     on later certificates from the same organisation
+# Only fields below the confidence threshold are sent to the LLM, and all
+# pages of a document share one batched prompt.
+
+FIELDS = ("name", "degree", "year", "honors", "roll_number", "grade", "organisation", "organisation_id")
+CONFIDENCE_THRESHOLD = float(os.getenv("FIELD_CONFIDENCE_THRESHOLD", 0.8))
+LLM_CONFIDENCE = 0.85
+# Pages per LLM prompt; 0 (the default) sends the whole document in one
+# prompt, the fewest calls against the rate limit. Smaller prompts run
+# concurrently when the llm offers map() (see llm_client), which speeds up
+# long documents at the cost of more calls.
+PAGES_PER_PROMPT = int(os.getenv("FIELD_LLM_PAGES_PER_PROMPT", 0))
+ANCHOR_DIR = os.getenv(
+    "FIELD_ANCHOR_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "field_anchors")
+)
+# Learned labels kept per organisation and field
+MAX_ANCHORS_PER_FIELD = int(os.getenv("FIELD_MAX_ANCHORS", 20))
+MAX_NER_CHARS = 5000
+
+logger = logging.getLogger(__name__)
+
+# Words that end a name captured after "certify that" in upper-case OCR text
+_NAME_STOP = r"(?!(?:HAS|HAVE|IS|WAS|SON|DAUGHTER|WIFE|OF|FOR|BEARING|WITH|ROLL|FROM|IN|AND|ON)\b)"
+_NAME = rf"(?P<value>{_NAME_STOP}[A-Z][A-Za-z.'\-]*(?:[ \t]+{_NAME_STOP}[A-Z][A-Za-z.'\-]*){{0,4}})"
+_TITLE = r"(?:(?i:mr|ms|mrs|miss|dr|shri|smt|kumari|km)\.?\s+)?"
+
+# (field, pattern, confidence); patterns capture the value as group "value"
+RULES = [
+    ("name", re.compile(rf"(?i:name(?:\s+of\s+(?:the\s+)?(?:student|candidate|recipient))?)[ \t]*[:\-][ \t]*{_TITLE}{_NAME}"), 0.95),
+    ("name", re.compile(rf"(?i:certif(?:y|ies)\s+that)\s+{_TITLE}{_NAME}"), 0.9),
+    ("name", re.compile(rf"(?i:awarded\s+to|presented\s+to|conferred\s+(?:up)?on)\s+{_TITLE}{_NAME}"), 0.9),
+    ("roll_number", re.compile(
+        r"(?i:roll|enrol(?:l)?ment|reg(?:istration)?|seat|student\s+id)\.?[ \t]*(?i:no|number|num|id)?\.?[ \t]*[:\-#]?[ \t]*"
+        r"(?P<value>(?=[A-Za-z/\-]*\d)[A-Za-z0-9][A-Za-z0-9/\-]{3,})"), 0.95),
+    ("organisation_id", re.compile(
+        r"(?i:(?:institute|institution|college|university|organi[sz]ation|school)[ \t]*(?:code|id))[ \t]*[:\-#]?[ \t]*"
+        r"(?P<value>[A-Za-z0-9\-]{2,})"), 0.9),
+    ("year", re.compile(r"(?i:year(?:\s+of\s+(?:passing|completion|graduation))?|passed\s+in|completed\s+in|in\s+the\s+year)"
+                        r"[ \t]*[:\-]?[ \t]*(?P<value>(?:19|20)\d{2})\b"), 0.95),
+    ("year", re.compile(r"(?i:session|batch)[ \t]*[:\-]?[ \t]*(?:19|20)\d{2}[ \t]*[\-–/to ]+[ \t]*(?P<value>(?:19|20)\d{2})\b"), 0.9),
+    ("grade", re.compile(r"(?i:c?gpa|sgpa|grade|division)[ \t]*(?i:obtained|secured|awarded)?[ \t]*[:\-]?[ \t]*"
+                         r"(?P<value>\d{1,2}\.\d{1,2}(?:[ \t]*/[ \t]*10)?|[A-F][+\-]?(?![A-Za-z])|(?i:first|second|third|pass)(?:[ \t]+(?i:class|division))?)"), 0.9),
+    ("grade", re.compile(r"(?P<value>(?i:first|second|third)[ \t]+(?i:class|division))"), 0.8),
+    ("honors", re.compile(r"(?P<value>(?i:(?:summa|magna)[ \t]+)?(?i:cum[ \t]+laude)|(?i:with[ \t]+(?:high[ \t]+)?distinction)"
+                          r"|(?i:with[ \t]+honou?rs)|(?i:gold[ \t]+medal(?:ist)?))"), 0.9),
+    ("degree", re.compile(r"(?P<value>(?i:bachelor|master|doctor)[ \t]+(?i:of)[ \t]+[A-Za-z][A-Za-z &]{2,60})"), 0.85),
+    ("degree", re.compile(r"\b(?P<value>B\.?[ \t]?Tech|M\.?[ \t]?Tech|M\.?[ \t]?B\.?[ \t]?A|B\.?[ \t]?Sc|M\.?[ \t]?Sc|B\.?[ \t]?Com"
+                          r"|M\.?[ \t]?Com|Ph\.?[ \t]?D|(?i:diploma)[ \t]+(?i:in)[ \t]+[A-Za-z][A-Za-z &]{2,40})\b"), 0.8),
+]
+
+# Trailing phrases that are not part of a degree name
+_DEGREE_STOP = re.compile(r"(?i)[ \t]+(?:with|in[ \t]+the[ \t]+year|during|from|on|and[ \t]+has|has|securing|for)\b.*$")
+_ORG_KEYWORDS = re.compile(r"(?i)\b(university|institute|college|academy|school|board|council|polytechnic)\b")
+_YEAR = re.compile(r"\b(?:19|20)\d{2}\b")
+_ID_FIELDS = {"roll_number", "organisation_id", "year", "grade"}
+# A field with none of its cue words anywhere on the page is confidently absent,
+# so optional fields don't send every certificate to the LLM
+_ABSENCE_CUES = {
+    "honors": re.compile(r"(?i)distinction|honou?rs?|laude|medal"),
+    "roll_number": re.compile(r"(?i)\b(?:roll|enrol|registration|reg\.|seat|student\s+id)"),
+    "grade": re.compile(r"(?i)\b(?:grade|c?gpa|sgpa|class|division|marks|percentage)\b"),
+    "organisation_id": re.compile(r"(?i)\b(?:code|id)\b"),
+}
+ABSENT_CONFIDENCE = 0.9
+
+
+def clean_json(text):
+    text = re.sub(r"^```json\s*", "", text, flags=re.IGNORECASE | re.MULTILINE)
+    text = re.sub(r"\s*```$", "", text, flags=re.MULTILINE)
+    return text.strip()
+
+
+def _clean(value):
+    return re.sub(r"\s+", " ", value).strip(" \t:;,.-")
+
+
+def _offer(candidates, field, value, confidence, source):
+    """Keeps the most confident candidate per field."""
+    value = _clean(value) if value else value
+    if not value:
+        return
+    if field not in candidates or confidence > candidates[field][1]:
+        candidates[field] = (value, confidence, source)
+
+
+# ---------------- Rule and NER Candidates ----------------
+def regex_candidates(text):
+    candidates = {}
+    for field, pattern, confidence in RULES:
+        match = pattern.search(text)
+        if match is None:
+            continue
+        value = match.group("value")
+        if field == "degree":
+            value = _DEGREE_STOP.sub("", value)
+        _offer(candidates, field, value, confidence, "regex")
+
+    # Unlabelled years: trust a single distinct year more than the latest of several
+    years = sorted(set(_YEAR.findall(text)))
+    if len(years) == 1:
+        _offer(candidates, "year", years[0], 0.75, "regex")
+    elif years:
+        _offer(candidates, "year", years[-1], 0.5, "regex")
+
+    for idx, line in enumerate(text.splitlines()):
+        line = _clean(line)
+        if _ORG_KEYWORDS.search(line) and 5 <= len(line) <= 80:
+            # The issuer's name is usually the letterhead
+            _offer(candidates, "organisation", line, 0.85 if idx < 5 else 0.75, "regex")
+            break
+    return candidates
+
+
+def ner_candidates(nlp, text):
+    candidates = {}
+    if nlp is None:
+        return candidates
+    with stage("spacy"):
+        doc = nlp(text[:MAX_NER_CHARS])
+    for ent in doc.ents:
+        if ent.label_ == "PERSON":
+            _offer(candidates, "name", ent.text, 0.6, "spacy")
+        elif ent.label_ == "ORG" and _ORG_KEYWORDS.search(ent.text):
+            _offer(candidates, "organisation", ent.text, 0.65, "spacy")
+        elif ent.label_ == "DATE":
+            year = _YEAR.search(ent.text)
+            if year:
+                _offer(candidates, "year", year.group(0), 0.55, "spacy")
+    return candidates
+
+
+# ---------------- Learned Layout Anchors ----------------
+def _normalise_anchor(text):
+    """Lower-case label words; words with digits are values, not labels."""
+    return [word for word in re.sub(r"[^a-z0-9 ]+", " ", text.lower()).split()
+            if not any(c.isdigit() for c in word)]
+
+
+class LayoutAnchors:
+    """
+    Per-organisation label text seen before each field's value, with counts.
+    Stored in one SQLite database, so every gunicorn and job worker adds to
+    the same counts instead of overwriting each other's; only the
+    MAX_ANCHORS_PER_FIELD most frequent labels per organisation and field
+    are kept. JSON files written by earlier versions are imported once.
+    """
+
+    def __init__(self, directory=ANCHOR_DIR, max_per_field=MAX_ANCHORS_PER_FIELD):
+        self.directory = directory
+        self.db_path = os.path.join(directory, "anchors.sqlite3")
+        self.max_per_field = max_per_field
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self._lock:
+            if not self._ready:
+                self._create()
+                self._ready = True
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _create(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with sqlite3.connect(self.db_path, timeout=30) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS anchors (
+                    organisation TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    anchor TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (organisation, field, anchor)
+                )
+            """)
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    self._import_json(conn, os.path.join(self.directory, name))
+
+    def _import_json(self, conn, path):
+        """Moves one organisation's anchors from the old JSON file into the database."""
+        try:
+            with open(path) as f:
+                anchors = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        organisation = os.path.splitext(os.path.basename(path))[0]
+        conn.executemany(
+            "INSERT OR IGNORE INTO anchors (organisation, field, anchor, count) VALUES (?, ?, ?, ?)",
+            [(organisation, field, anchor, count)
+             for field, seen in anchors.items() for anchor, count in seen.items()],
+        )
+        os.replace(path, path + ".imported")
+
+    @staticmethod
+    def _key(organisation):
+        # Same naming as the old per-organisation JSON files
+        return re.sub(r"[^A-Za-z0-9_\-]+", "_", str(organisation))
+
+    def _load(self, organisation):
+        """{field: [(anchor, count), ...]}, most frequent first."""
+        anchors = {}
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT field, anchor, count FROM anchors WHERE organisation = ? ORDER BY count DESC, anchor",
+                    (self._key(organisation),),
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning("Could not read layout anchors for '%s': %s", organisation, e)
+            return anchors
+        for field, anchor, count in rows:
+            anchors.setdefault(field, []).append((anchor, count))
+        return anchors
+
+    def candidates(self, organisation, text):
+        candidates = {}
+        if organisation is None:
+            return candidates
+        for field, seen in self._load(organisation).items():
+            for anchor, count in seen:
+                words = anchor.split()
+                pattern = r"\b" + r"\W+".join(map(re.escape, words)) + r"\W*(?P<value>[^\n]{1,80})"
+                match = re.search(pattern, text, re.IGNORECASE)
+                if match is None:
+                    continue
+                value = match.group("value")
+                if field in _ID_FIELDS:
+                    value = value.split()[0] if value.split() else ""
+                # An anchor seen on more certificates is trusted more
+                _offer(candidates, field, value, min(0.7 + 0.05 * count, 0.95), "anchor")
+                break
+        return candidates
+
+    def learn(self, organisation, text, fields):
+        """Records the label preceding each confidently known value."""
+        if organisation is None:
+            return
+        learned = []
+        for field, value in fields.items():
+            if not value or not isinstance(value, str):
+                continue
+            for line in text.splitlines():
+                idx = line.lower().find(value.lower())
+                if idx <= 0:
+                    continue
+                words = _normalise_anchor(line[:idx])[-4:]
+                if words and sum(len(word) for word in words) >= 2:
+                    learned.append((field, " ".join(words)))
+                break
+        if learned:
+            self._save(organisation, learned)
+
+    def _save(self, organisation, learned):
+        """Adds one to each (field, anchor) count and drops the rarest beyond the cap."""
+        key = self._key(organisation)
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT INTO anchors (organisation, field, anchor, count) VALUES (?, ?, ?, 1) "
+                    "ON CONFLICT (organisation, field, anchor) DO UPDATE SET count = count + 1",
+                    [(key, field, anchor) for field, anchor in learned],
+                )
+                for field in {field for field, _ in learned}:
+                    conn.execute(
+                        "DELETE FROM anchors WHERE organisation = ? AND field = ? AND anchor NOT IN ("
+                        "SELECT anchor FROM anchors WHERE organisation = ? AND field = ? "
+                        "ORDER BY count DESC, anchor LIMIT ?)",
+                        (key, field, key, field, self.max_per_field),
+                    )
+        except sqlite3.Error as e:
+            logger.warning("Could not save layout anchors for '%s': %s", organisation, e)
+
+
+# ---------------- Batched LLM Fallback ----------------
+def build_batch_prompt(pages):
+    """One prompt for every page that still needs fields: [(page_number, text, fields)]."""
+    sections = []
+    for page_number, text, fields in pages:
+        sections.append(f'Page {page_number} (keys: {", ".join(fields)}):\n"""{text}"""')
+    return f"""
+You are an AI trained to extract information from certificates.
+Below are pages from one certificate document. For each page, extract only the listed keys:
+- "name": name of the recipient
+- "degree": degree name
+- "year": year of completion
+- "honors": honors or distinction if mentioned
+- "roll_number": roll number
+- "grade": grade
+- "organisation": name of the organisation
+- "organisation_id": organisation ID
+
+Return a valid JSON object ONLY, without any explanations, comments, or extra text, mapping each page
+number (as a string) to an object with that page's keys. If a field is not found, use null for that field.
+
+{chr(10).join(sections)}
+"""
+
+
+def parse_batch_response(output_text):
+    """Parses the LLM reply into {page_number: fields}; raises ValueError if unusable."""
+    try:
+        parsed = json.loads(clean_json(output_text))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Failed to parse JSON: {e}")
+    if not isinstance(parsed, dict):
+        raise ValueError("Expected a JSON object keyed by page number")
+    return {int(page): fields for page, fields in parsed.items()
+            if str(page).isdigit() and isinstance(fields, dict)}
+
+
+class FieldExtractor:
+    """
+    llm is a callable taking a prompt and returning the model's text (None
+    for local-only extraction); nlp returns the spaCy pipeline (or None).
+    """
+
+    def __init__(self, llm=None, nlp=None, anchors=None, threshold=CONFIDENCE_THRESHOLD,
+                 pages_per_prompt=PAGES_PER_PROMPT):
+        self.llm = llm
+        self.nlp = nlp
+        self.anchors = anchors if anchors is not None else LayoutAnchors()
+        self.threshold = threshold
+        self.pages_per_prompt = pages_per_prompt
+
+    def _ask_llm(self, pending):
+        """Fields per page from the LLM, one prompt per chunk of pages; returns (fields, error)."""
+        size = self.pages_per_prompt or len(pending)
+        prompts = [build_batch_prompt(pending[i:i + size]) for i in range(0, len(pending), size)]
+        if hasattr(self.llm, "map"):
+            replies = self.llm.map(prompts)
+        else:
+            replies = []
+            for prompt in prompts:
+                try:
+                    replies.append(self.llm(prompt))
+                except Exception as e:
+                    replies.append(e)
+
+        llm_fields, errors = {}, []
+        for reply in replies:
+            try:
+                if isinstance(reply, Exception):
+                    raise reply
+                llm_fields.update(parse_batch_response(reply))
+            except Exception as e:
+                errors.append(str(e))
+        return llm_fields, "; ".join(errors) or None
+
+    def local_fields(self, text, organisation=None):
+        """{field: (value, confidence, source)} from regexes, NER and anchors."""
+        merged = {}
+        with stage("fields_local"):
+            sources = [regex_candidates(text), self.anchors.candidates(organisation, text)]
+        needs_ner = any(field not in sources[0] or sources[0][field][1] < self.threshold
+                        for field in ("name", "organisation", "year"))
+        if needs_ner and self.nlp is not None:
+            sources.append(ner_candidates(self.nlp(), text))
+        for candidates in sources:
+            for field, (value, confidence, source) in candidates.items():
+                _offer(merged, field, value, confidence, source)
+        for field, cue in _ABSENCE_CUES.items():
+            if field not in merged and not cue.search(text):
+                merged[field] = (None, ABSENT_CONFIDENCE, "absent")
+        return merged
+
+    def extract_document(self, texts, organisation=None):
+        """
+        Fields for every page of one document. Returns one
+        {"fields", "confidence", "field_sources"} dict per page (plus
+        "llm_error" if the LLM reply could not be used).
+        """
+        local = [self.local_fields(text, organisation) for text in texts]
+
+        pending = []
+        for page_number, (text, found) in enumerate(zip(texts, local), start=1):
+            missing = [field for field in FIELDS if field not in found or found[field][1] < self.threshold]
+            if missing and text.strip():
+                pending.append((page_number, text, missing))
+
+        llm_fields, llm_error = {}, None
+        if pending and self.llm is not None:
+            llm_fields, llm_error = self._ask_llm(pending)
+
+        results = []
+        for page_number, (text, found) in enumerate(zip(texts, local), start=1):
+            for field, value in llm_fields.get(page_number, {}).items():
+                if field in FIELDS and value not in (None, "") and (field not in found or found[field][0] is None
+                                                                  or found[field][1] < LLM_CONFIDENCE):
+                    found[field] = (_clean(str(value)), LLM_CONFIDENCE, "llm")
+            fields = {field: found[field][0] if field in found else None for field in FIELDS}
+            result = {
+                "fields": fields,
+                "confidence": {field: found[field][1] if field in found else 0.0 for field in FIELDS},
+                "field_sources": {field: found[field][2] if field in found else None for field in FIELDS},
+            }
+            if llm_error:
+                result["llm_error"] = llm_error
+            results.append(result)
+
+            confident = {field: value for field, value in fields.items()
+                         if value and found[field][1] >= self.threshold and found[field][2] != "anchor"}
+            self.anchors.learn(organisation, text, confident)
+        return results
@@ -0,0 +1,50 @@
+# Production server settings for the Python services, e.g.
+#   gunicorn -c gunicorn.conf.py compare_certificates:app
+#   GUNICORN_BIND=0.0.0.0:5001 gunicorn -c gunicorn.conf.py ocr_functions:app
+#
+# The app is imported once in the master with PRELOAD_MODELS=1, so every
+# model is loaded before the workers fork and the weights are shared
+# copy-on-write instead of each worker holding its own copy.
+#
+# Forking a process whose OpenMP thread pool is already running leaves the
+# children with a pool they cannot use (GNU libgomp hangs on the next
+# parallel region). The master therefore loads the models with a single
+# torch/OpenMP thread (TORCH_NUM_THREADS=1, OMP_NUM_THREADS=1), so no pool
+# is started before the fork, and each worker sets TORCH_NUM_THREADS
+# (default: cores / workers) after it forks.
+# Job pools (jobs.py) spawn their processes and are unaffected.
+import gc
+import os
+import sys
+
+os.environ.setdefault("PRELOAD_MODELS", "1")
+
+preload_app = True
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", 2))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+
+worker_torch_threads = int(os.getenv("TORCH_NUM_THREADS", 0)) or max(1, (os.cpu_count() or 1) // workers)
+_worker_omp_threads = os.environ.get("OMP_NUM_THREADS")
+# Read by torch/OpenMP and the services at import time, i.e. in the master
+os.environ["TORCH_NUM_THREADS"] = "1"
+os.environ["OMP_NUM_THREADS"] = "1"
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far out of the GC's reach; otherwise the
+    # collector's refcount/flag writes would copy the shared pages per worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Restore the environment for anything the worker starts (tesseract, job pools)
+    os.environ["TORCH_NUM_THREADS"] = str(worker_torch_threads)
+    if _worker_omp_threads is None:
+        os.environ.pop("OMP_NUM_THREADS", None)
+    else:
+        os.environ["OMP_NUM_THREADS"] = _worker_omp_threads
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(worker_torch_threads)
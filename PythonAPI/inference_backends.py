@@ -0,0 +1,195 @@
+import os
+import numpy as np
+import torch
+from torchvision import models, transforms
+
+# ---------------- CPU Inference Backends ----------------
+# Selectable backends for the crop embedder and the YOLO region detector:
+#
+#   EMBEDDER_BACKEND   "torch"        eager float32 (default)
+#                      "int8"         torchvision's int8-quantized backbone (fbgemm)
+#                      "onnx"         ONNX Runtime session on an exported model (pip install onnxruntime)
+#                      "torchscript"  TorchScript module on an exported model
+#   EMBEDDER_BACKBONE  "resnet50" (default, 2048-d) or "resnet18" (512-d, under half the FLOPs)
+#   YOLO_BACKEND       "pytorch" (default), "onnx" or "torchscript"
+#
+# "onnx"/"torchscript" load the files written by `python model_export.py
+# export`; `python model_export.py parity` checks their similarity scores
+# against the eager float32 embedder. A different backbone changes the
+# embedding size, so it needs its own REFERENCE_STORE_DIR.
+
+EMBEDDER_BACKEND = os.getenv("EMBEDDER_BACKEND", "torch").lower()
+EMBEDDER_BACKBONE = os.getenv("EMBEDDER_BACKBONE", "resnet50").lower()
+YOLO_BACKEND = os.getenv("YOLO_BACKEND", "pytorch").lower()
+MODEL_EXPORT_DIR = os.getenv(
+    "MODEL_EXPORT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models", "exports")
+)
+
+BACKBONES = {
+    "resnet50": 2048,
+    "resnet18": 512,
+}
+INPUT_SIZE = 224
+
+# Crop preprocessing shared by every embedder backend
+preprocess = transforms.Compose([
+    transforms.Resize(256),
+    transforms.CenterCrop(INPUT_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                         std=[0.229, 0.224, 0.225])
+])
+
+
+def _check_backbone(backbone):
+    if backbone not in BACKBONES:
+        raise ValueError(f"Unknown embedder backbone '{backbone}'. Use one of: {', '.join(BACKBONES)}")
+
+
+def build_backbone(backbone=EMBEDDER_BACKBONE):
+    """ImageNet backbone with the classifier removed: [N, 3, 224, 224] -> [N, dim, 1, 1]."""
+    _check_backbone(backbone)
+    # May download the ImageNet weights on first use
+    model = getattr(models, backbone)(pretrained=True)
+    model = torch.nn.Sequential(*list(model.children())[:-1])
+    model.eval()
+    return model
+
+
+def export_path(kind, backbone_or_name, fmt):
+    extension = {"onnx": "onnx", "torchscript": "pt"}[fmt]
+    return os.path.join(MODEL_EXPORT_DIR, f"{kind}-{backbone_or_name}.{extension}")
+
+
+# ---------------- Embedders ----------------
+class Embedder:
+    """Maps a preprocessed float32 batch [N, 3, 224, 224] to embeddings [N, dim]."""
+    backend = "base"
+
+    def __init__(self, backbone=EMBEDDER_BACKBONE):
+        _check_backbone(backbone)
+        self.backbone = backbone
+        self.dim = BACKBONES[backbone]
+
+    @property
+    def version(self):
+        """Part of the embedding cache key; embeddings of different versions never mix."""
+        return embedder_version(self.backend, self.backbone)
+
+    def embed(self, batch):
+        raise NotImplementedError
+
+    def __call__(self, batch):
+        return self.embed(batch)
+
+
+class TorchEmbedder(Embedder):
+    backend = "torch"
+
+    def __init__(self, backbone=EMBEDDER_BACKBONE):
+        super().__init__(backbone)
+        self.model = build_backbone(backbone)
+
+    def embed(self, batch):
+        with torch.inference_mode():
+            return self.model(batch).flatten(1).numpy()
+
+
+class Int8Embedder(Embedder):
+    """
+    torchvision's statically quantized backbone (int8 weights and activations).
+    Dynamic quantization only covers Linear layers, and the embedder has none
+    once the classifier is removed.
+    """
+    backend = "int8"
+
+    def __init__(self, backbone=EMBEDDER_BACKBONE):
+        super().__init__(backbone)
+        torch.backends.quantized.engine = "fbgemm"
+        model = getattr(models.quantization, backbone)(pretrained=True, quantize=True)
+        model.fc = torch.nn.Identity()
+        model.eval()
+        self.model = model
+
+    def embed(self, batch):
+        with torch.inference_mode():
+            return self.model(batch).flatten(1).numpy()
+
+
+class TorchScriptEmbedder(Embedder):
+    backend = "torchscript"
+
+    def __init__(self, backbone=EMBEDDER_BACKBONE, path=None):
+        super().__init__(backbone)
+        self.path = path or export_path("embedder", backbone, "torchscript")
+        self.model = torch.jit.load(self.path, map_location="cpu")
+        self.model.eval()
+
+    def embed(self, batch):
+        with torch.inference_mode():
+            return self.model(batch).flatten(1).numpy()
+
+
+class OnnxEmbedder(Embedder):
+    backend = "onnx"
+
+    def __init__(self, backbone=EMBEDDER_BACKBONE, path=None):
+        super().__init__(backbone)
+        import onnxruntime
+        self.path = path or export_path("embedder", backbone, "onnx")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def embed(self, batch):
+        batch = np.ascontiguousarray(batch.numpy() if isinstance(batch, torch.Tensor) else batch, dtype=np.float32)
+        output, = self.session.run(None, {self.input_name: batch})
+        return output.reshape(len(batch), -1)
+
+
+EMBEDDERS = {
+    TorchEmbedder.backend: TorchEmbedder,
+    Int8Embedder.backend: Int8Embedder,
+    TorchScriptEmbedder.backend: TorchScriptEmbedder,
+    OnnxEmbedder.backend: OnnxEmbedder,
+}
+
+
+def create_embedder(backend=EMBEDDER_BACKEND, backbone=EMBEDDER_BACKBONE):
+    if backend not in EMBEDDERS:
+        raise ValueError(f"Unknown embedder backend '{backend}'. Use one of: {', '.join(EMBEDDERS)}")
+    return EMBEDDERS[backend](backbone)
+
+
+def embedder_version(backend=EMBEDDER_BACKEND, backbone=EMBEDDER_BACKBONE):
+    """Version string of an embedder without loading it."""
+    if backend not in EMBEDDERS:
+        raise ValueError(f"Unknown embedder backend '{backend}'. Use one of: {', '.join(EMBEDDERS)}")
+    _check_backbone(backbone)
+    version = f"{backbone}-imagenet-avgpool"
+    # The eager float32 embedder keeps the version it had before backends existed
+    return version if backend == TorchEmbedder.backend else f"{version}-{backend}"
+
+
+# ---------------- YOLO ----------------
+YOLO_FORMATS = {
+    "pytorch": None,
+    "onnx": "onnx",
+    "torchscript": "torchscript",
+}
+
+
+def yolo_model_path(weights_path, backend=YOLO_BACKEND):
+    """The weights file for a YOLO backend; exports sit next to the .pt file as Ultralytics writes them."""
+    if backend not in YOLO_FORMATS:
+        raise ValueError(f"Unknown YOLO backend '{backend}'. Use one of: {', '.join(YOLO_FORMATS)}")
+    if YOLO_FORMATS[backend] is None:
+        return weights_path
+    return os.path.splitext(weights_path)[0] + {"onnx": ".onnx", "torchscript": ".torchscript"}[backend]
+
+
+def load_yolo(weights_path, backend=YOLO_BACKEND):
+    """Ultralytics runs exported ONNX / TorchScript weights through the same YOLO API."""
+    from ultralytics import YOLO
+    return YOLO(yolo_model_path(weights_path, backend), task="detect")
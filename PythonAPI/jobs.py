@@ -0,0 +1,418 @@
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Blueprint, Response, request, jsonify, url_for
+from tracing import metrics
+
+# ---------------- Asynchronous Jobs ----------------
+# Long OCR / comparison requests are queued instead of holding the HTTP
+# connection: POST a document, get a job ID back, then poll the status or
+# stream progress. Jobs live in a local SQLite database (no external
+# services), one database per service. Each stage (e.g. "ocr", "vision")
+# has its own bounded process pool, one process by default, so a model-heavy
+# stage is loaded once per worker process and slow documents queue behind
+# each other instead of blocking fast requests.
+#
+# Pool workers are started with "spawn" (JOB_START_METHOD) rather than forked
+# from the threaded web process, which may already hold torch/OpenMP thread
+# pools; each worker imports the service module and loads its models lazily.
+# A crashed worker breaks its pool: the pool is replaced, the job it was
+# running is marked failed and jobs still waiting in it are re-dispatched.
+# Jobs left running by a previous run are marked failed on startup, and
+# finished jobs are deleted after JOB_RETENTION_HOURS.
+#
+# Handlers are registered per service:
+#
+#     @register_job("extract", stage="ocr")
+#     def extract_job(files, params, progress):
+#         ...
+#         progress(done, total, "message")
+#         return {...}   # JSON-serialisable result
+#
+# files maps each uploaded form field to its bytes; params holds the other
+# form fields plus "filenames" ({field: uploaded filename}).
+
+JOB_DATA_DIR = os.getenv("JOB_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_data"))
+# Queued + running jobs per service; JOB_MAX_QUEUED_<SERVICE> overrides it for one service
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", 100))
+JOB_START_METHOD = os.getenv("JOB_START_METHOD", "spawn")
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", 24))
+# Seconds between retention sweeps
+CLEANUP_INTERVAL = 300
+EVENT_POLL_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+_handlers = {}
+
+
+def register_job(kind, stage="default"):
+    """Decorator registering a job handler under `kind`, run on the `stage` pool."""
+    def decorator(func):
+        _handlers[kind] = (func, stage)
+        return func
+    return decorator
+
+
+# ---------------- SQLite Job Store ----------------
+class JobStore:
+    """
+    Job rows in SQLite; safe to use from the web process and pool workers.
+    Each service (namespace) has its own database and upload directory.
+    """
+
+    def __init__(self, directory=JOB_DATA_DIR, namespace="default"):
+        self.directory = directory
+        self.namespace = namespace
+        self.files_dir = os.path.join(directory, "files", namespace)
+        self.db_path = os.path.join(directory, f"jobs_{namespace}.sqlite3")
+        os.makedirs(self.files_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    files TEXT NOT NULL,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    worker_pid INTEGER,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def create(self, kind, files, params):
+        """
+        Spools the uploaded files to disk and inserts a queued job. files maps
+        each field to bytes or a readable file object, which is copied in chunks.
+        """
+        job_id = uuid.uuid4().hex
+        paths = {}
+        for field, data in files.items():
+            path = os.path.join(self.files_dir, f"{job_id}_{field}")
+            with open(path, "wb") as f:
+                if isinstance(data, (bytes, bytearray)):
+                    f.write(data)
+                else:
+                    shutil.copyfileobj(data, f, 1024 * 1024)
+            paths[field] = path
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, params, files, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, STATUS_QUEUED, json.dumps(params), json.dumps(paths), time.time()),
+            )
+        return job_id
+
+    def claim(self, job_id):
+        """Marks a queued job as running; False if another worker already has it."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, started_at = ?, worker_pid = ? WHERE id = ? AND status = ?",
+                (STATUS_RUNNING, time.time(), os.getpid(), job_id, STATUS_QUEUED),
+            )
+            return cursor.rowcount == 1
+
+    def set_progress(self, job_id, progress):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+    def finish(self, job_id, result=None, error=None, only_if=None):
+        """
+        Stores the result (or error) and removes the spooled uploads. With
+        only_if, the job is only finished while it still has that status.
+        """
+        status = STATUS_FAILED if error is not None else STATUS_DONE
+        query = "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?"
+        args = (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+        if only_if is not None:
+            query += " AND status = ?"
+            args += (only_if,)
+        with self._connect() as conn:
+            if conn.execute(query, args).rowcount != 1:
+                return False
+        self._remove_files(job_id)
+        return True
+
+    def _remove_files(self, job_id):
+        job = self.get(job_id, include_result=False)
+        for path in (job or {}).get("files", {}).values():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, job_id, include_result=True):
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {
+            "job_id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "params": json.loads(row["params"]),
+            "files": json.loads(row["files"]),
+            "progress": json.loads(row["progress"]) if row["progress"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+        }
+        if include_result:
+            job["result"] = json.loads(row["result"]) if row["result"] else None
+        return job
+
+    def ids_with_status(self, status):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, kind FROM jobs WHERE status = ? ORDER BY created_at", (status,))
+            return rows.fetchall()
+
+    def running_jobs(self):
+        """(job id, worker pid) of every job marked running."""
+        with self._connect() as conn:
+            return conn.execute("SELECT id, worker_pid FROM jobs WHERE status = ?", (STATUS_RUNNING,)).fetchall()
+
+    def purge_finished(self, older_than):
+        """Deletes done and failed jobs that finished before `older_than` (epoch seconds)."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (STATUS_DONE, STATUS_FAILED, older_than),
+            )
+            return cursor.rowcount
+
+    def count_with_status(self, *statuses):
+        placeholders = ", ".join("?" for _ in statuses)
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT COUNT(*) FROM jobs WHERE status IN ({placeholders})", statuses).fetchone()
+            return row[0]
+
+
+# ---------------- Worker Side ----------------
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _run_job(directory, namespace, job_id, kind, module):
+    """Executes one job inside a pool worker process."""
+    if kind not in _handlers and module != "__main__":
+        # Spawned workers start empty; importing the service registers its handlers
+        # (a service run as a script is re-imported by multiprocessing itself)
+        importlib.import_module(module)
+    store = JobStore(directory, namespace)
+    if not store.claim(job_id):
+        return
+    job = store.get(job_id, include_result=False)
+    func, _ = _handlers[kind]
+
+    def progress(done, total, message=None):
+        store.set_progress(job_id, {"done": done, "total": total, "message": message})
+
+    try:
+        files = {}
+        for field, path in job["files"].items():
+            with open(path, "rb") as f:
+                files[field] = f.read()
+        result = func(files, job["params"], progress)
+    except Exception as e:
+        store.finish(job_id, error=str(e))
+    else:
+        store.finish(job_id, result=result)
+
+
+class JobManager:
+    """Owns one bounded process pool per stage and dispatches queued jobs to it."""
+
+    def __init__(self, store=None):
+        self.store = store or JobStore()
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._recovered = False
+        self._last_cleanup = 0.0
+
+    def _pool(self, stage):
+        with self._lock:
+            if stage not in self._pools:
+                workers = int(os.getenv(f"JOB_WORKERS_{stage.upper()}", os.getenv("JOB_WORKERS", 1)))
+                context = multiprocessing.get_context(JOB_START_METHOD)
+                self._pools[stage] = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            return self._pools[stage]
+
+    def _discard_pool(self, stage, pool):
+        """Drops a broken pool so the next dispatch starts a fresh one."""
+        with self._lock:
+            if self._pools.get(stage) is pool:
+                del self._pools[stage]
+            else:
+                return
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def dispatch(self, job_id, kind):
+        func, stage = _handlers[kind]
+        args = (_run_job, self.store.directory, self.store.namespace, job_id, kind, func.__module__)
+        pool = self._pool(stage)
+        try:
+            future = pool.submit(*args)
+        except BrokenProcessPool:
+            logger.warning("Job pool '%s' was broken; starting a new one", stage)
+            self._discard_pool(stage, pool)
+            pool = self._pool(stage)
+            future = pool.submit(*args)
+        future.add_done_callback(lambda done: self._on_done(stage, pool, job_id, kind, done))
+
+    def _on_done(self, stage, pool, job_id, kind, future):
+        if future.cancelled() or not isinstance(future.exception(), BrokenProcessPool):
+            return
+        # A worker died (segfault, OOM kill, ...): the pool is unusable from now on
+        self._discard_pool(stage, pool)
+        if self.store.finish(job_id, error="Job worker process exited unexpectedly", only_if=STATUS_RUNNING):
+            logger.warning("Job %s (%s) failed: its worker process exited", job_id, kind)
+        elif (self.store.get(job_id, include_result=False) or {}).get("status") == STATUS_QUEUED:
+            # Never started: run it on the replacement pool
+            self.dispatch(job_id, kind)
+
+    def submit(self, kind, files, params):
+        self.cleanup()
+        job_id = self.store.create(kind, files, params)
+        self.dispatch(job_id, kind)
+        return job_id
+
+    def recover(self):
+        """
+        On the first request: fails jobs whose worker process is gone (left
+        running by a previous run of the service) and re-dispatches queued ones.
+        """
+        with self._lock:
+            if self._recovered:
+                return
+            self._recovered = True
+        for job_id, worker_pid in self.store.running_jobs():
+            if worker_pid is None or not _pid_alive(worker_pid):
+                self.store.finish(job_id, error="Interrupted: the service stopped before the job finished",
+                                  only_if=STATUS_RUNNING)
+        for job_id, kind in self.store.ids_with_status(STATUS_QUEUED):
+            if kind in _handlers:
+                self.dispatch(job_id, kind)
+        self.cleanup()
+
+    def cleanup(self):
+        """Deletes finished jobs older than JOB_RETENTION_HOURS, at most once per CLEANUP_INTERVAL."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < CLEANUP_INTERVAL:
+                return
+            self._last_cleanup = now
+        self.store.purge_finished(now - JOB_RETENTION_HOURS * 3600)
+
+    def queue_depth(self):
+        return self.store.count_with_status(STATUS_QUEUED, STATUS_RUNNING)
+
+
+# ---------------- Flask Blueprint ----------------
+def create_jobs_blueprint(service="default", manager=None):
+    """
+    Job routes for one service; its jobs are kept apart from other services'.
+    Routes:
+      POST /jobs/<kind>         multipart upload -> 202 {"job_id", ...}
+      GET  /jobs/<job_id>       status, progress and (when done) the result
+      GET  /jobs/<job_id>/events  Server-Sent Events with progress until done
+    """
+    manager = manager or JobManager(JobStore(namespace=service))
+    max_queued = int(os.getenv(f"JOB_MAX_QUEUED_{service.upper().replace('-', '_')}", JOB_MAX_QUEUED))
+    bp = Blueprint("jobs", __name__)
+    metrics.gauge("certify_job_queue_depth", "Jobs waiting for or running on a job pool.",
+                  lambda: {(status,): manager.store.count_with_status(status) for status in (STATUS_QUEUED, STATUS_RUNNING)},
+                  ("status",))
+
+    @bp.before_app_request
+    def _recover_queued_jobs():
+        manager.recover()
+
+    @bp.route("/jobs/<kind>", methods=["POST"])
+    def submit_job(kind):
+        if kind not in _handlers:
+            return jsonify({"error": f"Unknown job kind '{kind}'. Use one of: {', '.join(_handlers)}"}), 404
+        if not request.files:
+            return jsonify({"error": "No file uploaded"}), 400
+        if manager.queue_depth() >= max_queued:
+            return jsonify({"error": "Job queue is full, retry later"}), 503
+
+        # Copied from the request's (spooled) upload streams, never read whole into memory
+        files = {field: storage.stream for field, storage in request.files.items()}
+        params = request.form.to_dict()
+        params["filenames"] = {field: storage.filename for field, storage in request.files.items()}
+        job_id = manager.submit(kind, files, params)
+        return jsonify({
+            "job_id": job_id,
+            "status": STATUS_QUEUED,
+            "status_url": url_for("jobs.get_job", job_id=job_id),
+            "events_url": url_for("jobs.job_events", job_id=job_id),
+        }), 202
+
+    @bp.route("/jobs/<job_id>", methods=["GET"])
+    def get_job(job_id):
+        job = manager.store.get(job_id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        job.pop("files")
+        return jsonify(job)
+
+    @bp.route("/jobs/<job_id>/events", methods=["GET"])
+    def job_events(job_id):
+        if manager.store.get(job_id, include_result=False) is None:
+            return jsonify({"error": "Job not found"}), 404
+
+        def stream():
+            last = None
+            while True:
+                job = manager.store.get(job_id)
+                if job is None:
+                    # Purged (JOB_RETENTION_HOURS) while the client was listening
+                    yield f"event: gone\ndata: {json.dumps({'error': 'Job not found'})}\n\n"
+                    return
+                state = (job["status"], job["progress"])
+                if state != last:
+                    last = state
+                    event = {"status": job["status"], "progress": job["progress"]}
+                    if job["status"] in (STATUS_DONE, STATUS_FAILED):
+                        event["result"] = job["result"]
+                        event["error"] = job["error"]
+                    yield f"data: {json.dumps(event)}\n\n"
+                if job["status"] in (STATUS_DONE, STATUS_FAILED):
+                    return
+                time.sleep(EVENT_POLL_INTERVAL)
+
+        return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    bp.manager = manager
+    return bp
@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+import cv2
+import numpy as np
+from tracing import record_error, stage
+
+logger = logging.getLogger(__name__)
+
+# ---------------- Keypoint Matching Engine ----------------
+# Configurable replacement for the per-call SIFT + BFMatcher + Python ratio
+# loop in compare_crops:
+#   * detectors are created once per thread and reused
+#   * crops can be downscaled so their longest side is at most max_side
+#     (KEYPOINT_MAX_SIDE, off by default: resizing changes the scores the
+#     0.75 similarity threshold was calibrated on, so measure the decisions
+#     with benchmarks/keypoint_matching.py before enabling it)
+#   * "sift-bf"    exact brute-force L2 (cv2.batchDistance, no DMatch objects)
+#   * "sift-flann" approximate KD-tree search
+#   * "orb"        binary ORB descriptors with brute-force Hamming distance
+#   * Lowe's ratio test runs as a single NumPy comparison
+# Select with KEYPOINT_MATCHER / KEYPOINT_MAX_SIDE.
+
+DEFAULT_MATCHER = os.getenv("KEYPOINT_MATCHER", "sift-bf")
+# 0 keeps crops at full resolution
+DEFAULT_MAX_SIDE = int(os.getenv("KEYPOINT_MAX_SIDE", 0))
+RATIO = 0.75
+
+
+class KeypointMatcher:
+    """Describes crops and scores descriptor sets by the share of ratio-test matches."""
+    name = "base"
+    descriptor = None
+
+    def __init__(self, max_side=DEFAULT_MAX_SIDE, ratio=RATIO):
+        self.max_side = max_side
+        self.ratio = ratio
+        self._local = threading.local()
+
+    def _create_detector(self):
+        raise NotImplementedError
+
+    def _knn_distances(self, des1, des2):
+        """Distances to the two nearest neighbours in des2, one row per descriptor in des1."""
+        raise NotImplementedError
+
+    @property
+    def detector(self):
+        detector = getattr(self._local, "detector", None)
+        if detector is None:
+            detector = self._create_detector()
+            self._local.detector = detector
+        return detector
+
+    def prepare(self, crop):
+        """Grayscale crop, downscaled so its longest side is at most max_side."""
+        img = np.asarray(crop)
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        longest = max(img.shape[:2])
+        if self.max_side and longest > self.max_side:
+            scale = self.max_side / longest
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return img
+
+    def describe(self, crop):
+        """Descriptors of a crop, or None if no keypoints were found."""
+        with stage("keypoints"):
+            try:
+                _, des = self.detector.detectAndCompute(self.prepare(crop), None)
+            except cv2.error as e:
+                # Keypoint detection can sometimes throw errors. This catch prevents the entire request from failing.
+                record_error("keypoints")
+                logger.warning("A non-critical %s error occurred: %s", self.name, e)
+                return None
+        return des
+
+    def similarity(self, des1, des2):
+        """Share of keypoints (of the smaller set) that survive Lowe's ratio test."""
+        # Ensure we have enough descriptors to compare for a 2-NN search
+        if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
+            return 0.0
+        with stage("keypoint_match"):
+            try:
+                distances = self._knn_distances(des1, des2)
+            except cv2.error as e:
+                record_error("keypoint_match")
+                logger.warning("A non-critical %s error occurred: %s", self.name, e)
+                return 0.0
+        if len(distances) == 0:
+            return 0.0
+        good = np.count_nonzero(distances[:, 0] < self.ratio * distances[:, 1])
+        return good / min(len(des1), len(des2))
+
+
+class SiftBruteForceMatcher(KeypointMatcher):
+    """Exact L2 nearest neighbours, same results as cv2.BFMatcher().knnMatch."""
+    name = "sift-bf"
+    descriptor = "sift"
+
+    def _create_detector(self):
+        return cv2.SIFT_create()
+
+    def _knn_distances(self, des1, des2):
+        dist, _ = cv2.batchDistance(np.asarray(des1, np.float32), np.asarray(des2, np.float32),
+                                    cv2.CV_32F, normType=cv2.NORM_L2, K=2)
+        return dist
+
+
+class SiftFlannMatcher(SiftBruteForceMatcher):
+    """Approximate KD-tree search; faster on large descriptor sets."""
+    name = "sift-flann"
+
+    def __init__(self, max_side=DEFAULT_MAX_SIDE, ratio=RATIO, trees=4, checks=32):
+        super().__init__(max_side, ratio)
+        self.trees = trees
+        self.checks = checks
+
+    @property
+    def flann(self):
+        flann = getattr(self._local, "flann", None)
+        if flann is None:
+            flann = cv2.FlannBasedMatcher({"algorithm": 1, "trees": self.trees}, {"checks": self.checks})
+            self._local.flann = flann
+        return flann
+
+    def _knn_distances(self, des1, des2):
+        matches = self.flann.knnMatch(np.asarray(des1, np.float32), np.asarray(des2, np.float32), k=2)
+        return np.array([(pair[0].distance, pair[1].distance) for pair in matches if len(pair) == 2],
+                        dtype=np.float32).reshape(-1, 2)
+
+
+class OrbMatcher(KeypointMatcher):
+    """Binary ORB descriptors with Hamming distance; fastest, least discriminative."""
+    name = "orb"
+    descriptor = "orb"
+
+    def __init__(self, max_side=DEFAULT_MAX_SIDE, ratio=RATIO, nfeatures=1000):
+        super().__init__(max_side, ratio)
+        self.nfeatures = nfeatures
+
+    def _create_detector(self):
+        return cv2.ORB_create(nfeatures=self.nfeatures)
+
+    def _knn_distances(self, des1, des2):
+        dist, _ = cv2.batchDistance(des1, des2, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=2)
+        return dist.astype(np.float32)
+
+
+MATCHERS = {
+    SiftBruteForceMatcher.name: SiftBruteForceMatcher,
+    SiftFlannMatcher.name: SiftFlannMatcher,
+    OrbMatcher.name: OrbMatcher,
+}
+
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+
+def get_matcher(name=None, descriptor=None):
+    """
+    Shared matcher instance by name (default: KEYPOINT_MATCHER).
+    If descriptor is given and the named matcher produces a different kind,
+    the exact brute-force matcher for that descriptor is returned instead;
+    stored references are always SIFT.
+    """
+    name = (name or DEFAULT_MATCHER).lower()
+    if name not in MATCHERS:
+        raise ValueError(f"Unknown keypoint matcher '{name}'. Use one of: {', '.join(MATCHERS)}")
+    if descriptor is not None and MATCHERS[name].descriptor != descriptor:
+        name = next(key for key, cls in MATCHERS.items() if cls.descriptor == descriptor)
+    with _matchers_lock:
+        if name not in _matchers:
+            _matchers[name] = MATCHERS[name]()
+        return _matchers[name]
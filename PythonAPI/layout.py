@@ -0,0 +1,141 @@
+import os
+import cv2
+
+# ---------------- Layout Analysis ----------------
+# Finds the text blocks on a page so OCR only sees those crops instead of
+# the whole 300-DPI page (borders, seals and whitespace are skipped):
+#   * a fast morphological pass on a downscaled copy of the page joins
+#     characters into text lines
+#   * neighbouring lines of similar height are grouped into blocks
+#   * each block is rescaled so its text height is TARGET_TEXT_HEIGHT pixels,
+#     the size Tesseract recognises best, before it is OCRed
+# If no blocks are found, or they cover most of the page anyway, the caller
+# OCRs the full page instead.
+
+LAYOUT_MAX_SIDE = int(os.getenv("LAYOUT_MAX_SIDE", 1200))
+TARGET_TEXT_HEIGHT = int(os.getenv("LAYOUT_TEXT_HEIGHT", 40))
+MAX_COVERAGE = float(os.getenv("LAYOUT_MAX_COVERAGE", 0.6))
+MAX_UPSCALE = 2.0
+
+
+def settings():
+    """Every setting that changes the blocks and their OCR; part of the OCR cache key."""
+    return {"max_side": LAYOUT_MAX_SIDE, "text_height": TARGET_TEXT_HEIGHT,
+            "max_coverage": MAX_COVERAGE, "max_upscale": MAX_UPSCALE}
+
+
+def _line_boxes(binary):
+    """Bounding boxes of text lines in a binarised (text = 255) page."""
+    height, width = binary.shape
+    # Drop page borders, frames and rules first; they would enclose the text
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    large = (stats[:, cv2.CC_STAT_HEIGHT] > height * 0.15) | (stats[:, cv2.CC_STAT_WIDTH] > width * 0.9)
+    large[0] = False
+    if large.any():
+        binary = binary.copy()
+        binary[large[labels]] = 0
+
+    # Join the characters of a line, but not neighbouring lines
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(9, width // 40), 1))
+    joined = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(joined, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    lines = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if h < 4 or w < 8 or h > height * 0.15:
+            continue
+        # Page borders and rules are long and thin or nearly empty
+        if w > width * 0.95 and h < 12:
+            continue
+        fill = cv2.countNonZero(binary[y:y + h, x:x + w]) / float(w * h)
+        if fill < 0.1 or fill > 0.9:
+            continue
+        lines.append([x, y, x + w, y + h])
+    return lines
+
+
+def _group_lines(lines):
+    """Merges vertically adjacent, overlapping lines of similar height into blocks."""
+    blocks = []
+    for x0, y0, x1, y1 in sorted(lines, key=lambda box: (box[1], box[0])):
+        height = y1 - y0
+        for block in blocks:
+            bx0, by0, bx1, by1, line_height = block
+            close = -line_height // 2 <= y0 - by1 <= line_height
+            overlaps = min(x1, bx1) > max(x0, bx0)
+            similar = max(height, line_height) <= 1.6 * min(height, line_height)
+            if close and overlaps and similar:
+                block[:4] = [min(x0, bx0), by0, max(x1, bx1), max(y1, by1)]
+                break
+        else:
+            blocks.append([x0, y0, x1, y1, height])
+    return blocks
+
+
+def detect_text_blocks(gray, max_side=LAYOUT_MAX_SIDE):
+    """
+    Text blocks of a grayscale page in reading order:
+    [{"box": [x0, y0, x1, y1], "text_height": h}] in page pixels.
+    """
+    longest = max(gray.shape[:2])
+    scale = min(1.0, max_side / float(longest))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+
+    gradient = cv2.morphologyEx(small, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+
+    page_height, page_width = gray.shape[:2]
+    blocks = []
+    for x0, y0, x1, y1, line_height in _group_lines(_line_boxes(binary)):
+        pad = int(0.3 * line_height)
+        box = [
+            max(0, int((x0 - pad) / scale)),
+            max(0, int((y0 - pad) / scale)),
+            min(page_width, int((x1 + pad) / scale)),
+            min(page_height, int((y1 + pad) / scale)),
+        ]
+        blocks.append({"box": box, "text_height": line_height / scale})
+    blocks.sort(key=lambda block: (block["box"][1], block["box"][0]))
+    return blocks
+
+
+def coverage(blocks, shape):
+    """Share of the page area inside the blocks."""
+    area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in (block["box"] for block in blocks))
+    return area / float(shape[0] * shape[1])
+
+
+def normalise_crop(gray, block, target_height=TARGET_TEXT_HEIGHT):
+    """The block's crop, rescaled so its text lines are about target_height pixels tall."""
+    x0, y0, x1, y1 = block["box"]
+    crop = gray[y0:y1, x0:x1]
+    scale = min(target_height / max(block["text_height"], 1.0), MAX_UPSCALE)
+    if abs(scale - 1.0) < 0.1:
+        return crop
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    return cv2.resize(crop, None, fx=scale, fy=scale, interpolation=interpolation)
+
+
+def ocr_blocks(gray, blocks, recognise):
+    """recognise(crop) -> text for every block; returns [{"box", "text"}] in reading order."""
+    results = []
+    for block in blocks:
+        text = recognise(normalise_crop(gray, block)).strip()
+        if text:
+            results.append({"box": block["box"], "text": text})
+    return results
+
+
+def locate_fields(blocks, fields):
+    """{field: box} of the block whose text contains each extracted field value."""
+    located = {}
+    for field, value in fields.items():
+        if not value:
+            continue
+        needle = " ".join(str(value).lower().split())
+        for block in blocks:
+            if needle in " ".join(block["text"].lower().split()):
+                located[field] = block["box"]
+                break
+    return located
@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from result_cache import hash_bytes, make_key
+from tracing import propagate, stage
+
+# ---------------- LLM Extraction Client ----------------
+# Shared client for every LLM call a service makes:
+#   * calls run on a bounded thread pool, so the prompts of different pages
+#     and documents are in flight at the same time
+#   * a token bucket keeps the request rate under the provider's quota
+#   * calls that fail transiently (timeouts, connection errors, 408/429/5xx)
+#     are retried a bounded number of times with exponential backoff and
+#     jitter, each attempt with a timeout; other errors (bad request, auth,
+#     unparsable reply) fail at once instead of spending the rate limit
+#   * identical prompts already in flight share one call (and, with a
+#     cache, identical prompts later on share the stored reply)
+# Backends are pluggable: "gemini" (default) or "http", which POSTs
+# {"prompt"} to LLM_HTTP_URL and reads {"text"} back, so a local mock
+# server (benchmarks/mock_llm_server.py) can stand in for Gemini.
+#
+# Concurrency pays off when several prompts exist at once: documents of a
+# batch or of parallel requests, or the pages of one long document when
+# FIELD_LLM_PAGES_PER_PROMPT splits it (see field_extractor). With the
+# default of one prompt per document, a single /extract call makes one call.
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+LLM_HTTP_URL = os.getenv("LLM_HTTP_URL", "http://127.0.0.1:8765/generate")
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+LLM_RATE_PER_SECOND = float(os.getenv("LLM_RATE_PER_SECOND", 4))
+LLM_BURST = int(os.getenv("LLM_BURST", 4))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+LLM_BACKOFF_SECONDS = float(os.getenv("LLM_BACKOFF_SECONDS", 1.0))
+LLM_MAX_BACKOFF_SECONDS = 30.0
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 60))
+# HTTP statuses worth retrying (plus every 5xx)
+RETRY_STATUSES = (408, 429)
+
+logger = logging.getLogger(__name__)
+
+
+def is_retryable(error):
+    """True for timeouts, connection failures and 408/429/5xx replies."""
+    # HTTPError and Google API errors carry the HTTP status in .code
+    status = getattr(error, "code", None)
+    if isinstance(status, int):
+        return status in RETRY_STATUSES or status >= 500
+    return isinstance(error, (TimeoutError, ConnectionError, urllib.error.URLError))
+
+
+# ---------------- Backends ----------------
+class GeminiBackend:
+    def __init__(self, model="gemini-1.5-flash"):
+        self.name = model
+        self._model = None
+        self._lock = threading.Lock()
+
+    def generate(self, prompt, timeout):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    import google.generativeai as genai
+                    self._model = genai.GenerativeModel(self.name)
+        response = self._model.generate_content(prompt, request_options={"timeout": timeout})
+        return response.text.strip()
+
+
+class HttpBackend:
+    """Any endpoint answering POST {"prompt": ...} with {"text": ...}."""
+
+    def __init__(self, url=LLM_HTTP_URL):
+        self.url = url
+        self.name = f"http:{url}"
+
+    def generate(self, prompt, timeout):
+        body = json.dumps({"prompt": prompt}).encode("utf-8")
+        req = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return json.loads(response.read())["text"].strip()
+
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "http": HttpBackend,
+}
+
+
+def create_backend(name=LLM_BACKEND, **kwargs):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LLM backend '{name}'. Use one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name](**kwargs)
+
+
+# ---------------- Rate Limiting ----------------
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, up to `burst` at once."""
+
+    def __init__(self, rate=LLM_RATE_PER_SECOND, burst=LLM_BURST):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# ---------------- Client ----------------
+class LLMClient:
+    """
+    Callable as llm(prompt) -> text, so it drops into FieldExtractor;
+    submit() and map() run prompts concurrently.
+    cache is an optional ResultCache; replies are stored only when
+    cache_if(text) is true (e.g. the reply parses as JSON).
+    """
+
+    def __init__(self, backend=None, concurrency=LLM_CONCURRENCY, limiter=None, max_retries=LLM_MAX_RETRIES,
+                 backoff=LLM_BACKOFF_SECONDS, timeout=LLM_TIMEOUT_SECONDS, cache=None, cache_if=None):
+        self.backend = backend or create_backend()
+        self.concurrency = concurrency
+        self.limiter = limiter or TokenBucket()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.cache_if = cache_if or (lambda text: True)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self.stats = {"calls": 0, "retries": 0, "coalesced": 0, "cache_hits": 0, "failures": 0}
+
+    def _pool(self):
+        # A pool inherited through fork has no threads; start a new one per process
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="llm")
+                self._executor_pid = os.getpid()
+                self._in_flight = {}
+            return self._executor
+
+    def _key(self, prompt):
+        return make_key(hash_bytes(prompt), stage="llm", model=self.backend.name)
+
+    @property
+    def pending(self):
+        """Distinct prompts queued or running."""
+        with self._lock:
+            return len(self._in_flight)
+
+    def _count(self, event):
+        with self._lock:
+            self.stats[event] += 1
+
+    def _call(self, prompt):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            self._count("calls")
+            try:
+                with stage("llm"):
+                    return self.backend.generate(prompt, self.timeout)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    self._count("failures")
+                    raise
+                delay = min(self.backoff * 2 ** attempt, LLM_MAX_BACKOFF_SECONDS)
+                delay *= random.uniform(0.5, 1.0)
+                logger.warning("LLM call failed (%s); retry %d/%d in %.1fs", e, attempt + 1, self.max_retries, delay)
+                self._count("retries")
+                time.sleep(delay)
+
+    def _run(self, prompt, key):
+        try:
+            text = self._call(prompt)
+            if self.cache is not None and self.cache_if(text):
+                self.cache.set(key, text)
+            return text
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def submit(self, prompt):
+        """Future for the reply; joins the call already in flight for the same prompt."""
+        pool = self._pool()
+        key = self._key(prompt)
+        if self.cache is not None:
+            text = self.cache.get(key)
+            if text is not None:
+                self._count("cache_hits")
+                future = Future()
+                future.set_result(text)
+                return future
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1  # already under the lock
+                return future
+            future = pool.submit(propagate(self._run), prompt, key)
+            self._in_flight[key] = future
+            return future
+
+    def map(self, prompts):
+        """Replies (or the raised exceptions) for all prompts, run concurrently."""
+        futures = [self.submit(prompt) for prompt in prompts]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def __call__(self, prompt):
+        return self.submit(prompt).result()
@@ -0,0 +1,194 @@
+"""
+Export the comparison models for the faster CPU backends and check that
+the exported embedders still give the same similarity scores.
+
+    python model_export.py export                            # embedder + YOLO, ONNX and TorchScript
+    python model_export.py export --embedder onnx --yolo none --backbone resnet18
+    python model_export.py parity                            # synthetic crops
+    python model_export.py parity --images uploads/crops --backends int8 onnx --json parity.json
+
+Embedder exports go to MODEL_EXPORT_DIR (default ../models/exports). YOLO
+exports are written by Ultralytics next to the .pt weights, where
+YOLO_BACKEND=onnx|torchscript looks for them.
+
+The parity check embeds every crop with the eager float32 ResNet-50 (the
+scores /compare-images reports as deep_learning_similarity today) and with
+each backend, then compares the cosine similarity of genuine pairs (a crop
+and a perturbed re-scan of it) and impostor pairs (two different crops).
+Reported per backend: median batch time, the largest and mean score
+difference from the reference, and how often the match decision at the
+0.95 threshold agrees with it.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+import numpy as np
+import torch
+from PIL import Image
+
+from inference_backends import (
+    BACKBONES, EMBEDDERS, INPUT_SIZE, build_backbone, create_embedder, export_path, preprocess, yolo_model_path,
+)
+
+YOLO_WEIGHTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models", "my_model.pt")
+MATCH_THRESHOLD = 0.95
+EXPORT_FORMATS = ("onnx", "torchscript")
+
+
+# ---------------- Export ----------------
+def export_embedder(backbone, fmt):
+    model = build_backbone(backbone)
+    dummy = torch.randn(1, 3, INPUT_SIZE, INPUT_SIZE)
+    path = export_path("embedder", backbone, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if fmt == "onnx":
+        torch.onnx.export(model, dummy, path, input_names=["input"], output_names=["embedding"],
+                          dynamic_axes={"input": {0: "batch"}, "embedding": {0: "batch"}}, opset_version=17)
+    else:
+        with torch.inference_mode():
+            traced = torch.jit.freeze(torch.jit.trace(model, dummy))
+        traced.save(path)
+    return path
+
+
+def export_yolo(weights, fmt):
+    from ultralytics import YOLO
+    YOLO(weights).export(format=fmt)
+    return yolo_model_path(weights, fmt)
+
+
+# ---------------- Parity ----------------
+def load_crops(images_dir, count, seed):
+    """RGB crops from a directory, or synthetic signature/profile crops."""
+    if images_dir:
+        paths = sorted(glob.glob(os.path.join(images_dir, "*")))[:count]
+        crops = []
+        for path in paths:
+            try:
+                crops.append(Image.open(path).convert("RGB"))
+            except OSError:
+                pass
+        return crops, None
+
+    from benchmarks.keypoint_matching import perturb, synthetic_profile, synthetic_signature
+    rng = np.random.default_rng(seed)
+    half = count // 2
+    grays = [synthetic_signature(rng) for _ in range(half)] + [synthetic_profile(rng) for _ in range(count - half)]
+    return [Image.fromarray(gray).convert("RGB") for gray in grays], (perturb, rng)
+
+
+def make_pairs(crops, perturber):
+    """(crop, other, genuine) pairs: each crop with a re-scan of itself and with its neighbour."""
+    pairs = []
+    for idx, crop in enumerate(crops):
+        if perturber is not None:
+            perturb, rng = perturber
+            rescan = Image.fromarray(perturb(np.asarray(crop.convert("L")), rng)).convert("RGB")
+        else:
+            rescan = crop.rotate(1.5, fillcolor=(255, 255, 255))
+        pairs.append((crop, rescan, True))
+        pairs.append((crop, crops[(idx + 1) % len(crops)], False))
+    return pairs
+
+
+def pair_scores(embedder, pairs, batch_size):
+    """Cosine similarity per pair, plus the time of every embedding batch in ms."""
+    images = [image for first, second, _ in pairs for image in (first, second)]
+    embeddings, timings = [], []
+    for start in range(0, len(images), batch_size):
+        batch = torch.stack([preprocess(image) for image in images[start:start + batch_size]])
+        began = time.perf_counter()
+        embeddings.append(np.asarray(embedder(batch), dtype=np.float32))
+        timings.append((time.perf_counter() - began) * 1000)
+    embeddings = np.concatenate(embeddings)
+    first, second = embeddings[0::2], embeddings[1::2]
+    norms = np.maximum(np.linalg.norm(first, axis=1) * np.linalg.norm(second, axis=1), 1e-6)
+    return (first * second).sum(axis=1) / norms, timings
+
+
+def summarize(label, scores, timings, reference, genuine):
+    diff = np.abs(scores - reference)
+    return {
+        "backend": label,
+        "median_batch_ms": statistics.median(timings),
+        "max_abs_diff": float(diff.max()),
+        "mean_abs_diff": float(diff.mean()),
+        "decision_agreement": float(np.mean((scores >= MATCH_THRESHOLD) == (reference >= MATCH_THRESHOLD))),
+        "mean_genuine_score": float(scores[genuine].mean()),
+        "mean_impostor_score": float(scores[~genuine].mean()),
+    }
+
+
+def run_parity(args):
+    crops, perturber = load_crops(args.images, args.count, args.seed)
+    if len(crops) < 2:
+        sys.exit("Need at least two crops")
+    pairs = make_pairs(crops, perturber)
+    genuine = np.array([same for _, _, same in pairs])
+
+    reference, timings = pair_scores(create_embedder("torch", "resnet50"), pairs, args.batch_size)
+    rows = [summarize("torch resnet50 (reference)", reference, timings, reference, genuine)]
+    for backend in args.backends:
+        try:
+            embedder = create_embedder(backend, args.backbone)
+        except Exception as e:
+            print(f"Skipping {backend} {args.backbone}: {e}")
+            continue
+        scores, timings = pair_scores(embedder, pairs, args.batch_size)
+        rows.append(summarize(f"{backend} {args.backbone}", scores, timings, reference, genuine))
+
+    header = f"{'backend':<28}{'batch ms':>10}{'max |d|':>9}{'mean |d|':>10}{'agree':>7}{'genuine':>9}{'impostor':>10}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(f"{row['backend']:<28}{row['median_batch_ms']:>10.1f}{row['max_abs_diff']:>9.4f}"
+              f"{row['mean_abs_diff']:>10.4f}{row['decision_agreement']:>7.2f}"
+              f"{row['mean_genuine_score']:>9.3f}{row['mean_impostor_score']:>10.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"pairs": len(pairs), "threshold": MATCH_THRESHOLD, "results": rows}, f, indent=2)
+
+
+def run_export(args):
+    for fmt in args.embedder:
+        if fmt != "none":
+            print(f"Embedder {args.backbone} -> {export_embedder(args.backbone, fmt)}")
+    for fmt in args.yolo:
+        if fmt != "none":
+            print(f"YOLO -> {export_yolo(args.yolo_weights, fmt)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="write ONNX / TorchScript models")
+    export.add_argument("--backbone", choices=list(BACKBONES), default="resnet50")
+    export.add_argument("--embedder", nargs="+", choices=EXPORT_FORMATS + ("none",), default=list(EXPORT_FORMATS))
+    export.add_argument("--yolo", nargs="+", choices=EXPORT_FORMATS + ("none",), default=list(EXPORT_FORMATS))
+    export.add_argument("--yolo-weights", default=YOLO_WEIGHTS)
+
+    parity = commands.add_parser("parity", help="compare backend similarity scores with eager ResNet-50")
+    parity.add_argument("--backbone", choices=list(BACKBONES), default="resnet50")
+    parity.add_argument("--backends", nargs="+", choices=list(EMBEDDERS), default=["int8", "onnx", "torchscript"])
+    parity.add_argument("--images", help="directory of crop images (default: synthetic crops)")
+    parity.add_argument("--count", type=int, default=32, help="number of base crops")
+    parity.add_argument("--batch-size", type=int, default=8)
+    parity.add_argument("--seed", type=int, default=0)
+    parity.add_argument("--json", help="write results to this file")
+
+    args = parser.parse_args()
+    torch.set_num_threads(int(os.getenv("TORCH_NUM_THREADS", os.cpu_count() or 1)))
+    if args.command == "export":
+        run_export(args)
+    else:
+        run_parity(args)
+
+
+if __name__ == "__main__":
+    main()
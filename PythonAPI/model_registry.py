@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+import time
+from flask import Blueprint, jsonify
+
+# ---------------- Lazy Model Registry ----------------
+# Models are registered with a loader and only loaded on first use, or up
+# front by warmup(). With PRELOAD_MODELS=1 (set by gunicorn.conf.py) each
+# service warms up at import time in the gunicorn master, so the weights are
+# loaded once and shared copy-on-write by every forked worker.
+#
+# Import time per service module and load time per model are recorded and
+# reported by the /ready probe. Without preloading, the first /ready probe
+# starts loading every model in the background, so a readiness probe passes
+# once they are loaded instead of waiting for traffic that would load them.
+
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "0") == "1"
+# Start loading in a background thread instead (e.g. for `python service.py`)
+WARMUP_IN_BACKGROUND = os.getenv("WARMUP_IN_BACKGROUND", "0") == "1"
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._load_seconds = {}
+        self._import_seconds = {}
+        self._errors = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._warmup_thread = None
+
+    def register(self, name, loader):
+        """Registers a zero-argument loader; nothing is loaded yet."""
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks[name] = threading.Lock()
+
+    def get(self, name):
+        """Returns the model, loading it on first use (once, even under concurrency)."""
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._locks[name]:
+            if name not in self._models:
+                started = time.perf_counter()
+                try:
+                    self._models[name] = self._loaders[name]()
+                except Exception as e:
+                    self._errors[name] = str(e)
+                    raise
+                self._errors.pop(name, None)
+                self._load_seconds[name] = time.perf_counter() - started
+                logger.info("Loaded model '%s' in %.2fs", name, self._load_seconds[name])
+            return self._models[name]
+
+    def warmup(self, names=None):
+        """Loads the given (default: all registered) models now."""
+        for name in names or list(self._loaders):
+            self.get(name)
+
+    def _warmup_all(self):
+        for name in list(self._loaders):
+            try:
+                self.get(name)
+            except Exception:
+                # Recorded in status(); the next warm-up retries it
+                logger.exception("Could not load model '%s'", name)
+
+    def warmup_in_background(self):
+        """Loads every model on a background thread, unless one is already loading or all are loaded."""
+        with self._lock:
+            running = self._warmup_thread is not None and self._warmup_thread.is_alive()
+            if not running and not self.is_ready():
+                self._warmup_thread = threading.Thread(target=self._warmup_all, name="model-warmup", daemon=True)
+                self._warmup_thread.start()
+            return self._warmup_thread
+
+    def record_import(self, module, seconds):
+        self._import_seconds[module] = seconds
+
+    def is_ready(self):
+        return all(name in self._models for name in self._loaders)
+
+    def status(self):
+        return {
+            "ready": self.is_ready(),
+            "import_seconds": dict(self._import_seconds),
+            "models": {
+                name: {
+                    "loaded": name in self._models,
+                    "load_seconds": self._load_seconds.get(name),
+                    "error": self._errors.get(name),
+                }
+                for name in self._loaders
+            },
+        }
+
+
+registry = ModelRegistry()
+
+
+def create_ready_blueprint(model_registry=None):
+    """
+    GET /ready: 200 once every registered model is loaded, else 503; a
+                probe while models are missing starts loading them in the
+                background (a failed load is retried by the next probe).
+    GET /live:  200 as soon as the process serves requests.
+    """
+    model_registry = model_registry or registry
+    bp = Blueprint("ready", __name__)
+
+    @bp.route("/ready", methods=["GET"])
+    def ready():
+        status = model_registry.status()
+        if not status["ready"]:
+            model_registry.warmup_in_background()
+        return jsonify(status), 200 if status["ready"] else 503
+
+    @bp.route("/live", methods=["GET"])
+    def live():
+        return jsonify({"live": True})
+
+    return bp
+
+
+def finish_startup(module, started):
+    """
+    Records a service module's import time and, with PRELOAD_MODELS=1, loads
+    every model before gunicorn forks its workers.
+    """
+    registry.record_import(module, time.perf_counter() - started)
+    if PRELOAD_MODELS:
+        registry.warmup()
+    elif WARMUP_IN_BACKGROUND:
+        registry.warmup_in_background()
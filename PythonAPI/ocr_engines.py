@@ -0,0 +1,151 @@
+import logging
+import os
+import queue
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pytesseract
+
+try:
+    # Optional: in-process Tesseract bindings (pip install tesserocr, needs libtesseract)
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# ---------------- OCR Engines ----------------
+# Common interface over the Tesseract backends. pytesseract forks a
+# `tesseract` process per call, which writes a temp image and reloads the
+# language data every time; TesserocrEngine keeps a bounded pool of warm
+# API handles that requests check out and return, and hands a handle the
+# page buffer directly.
+
+logger = logging.getLogger(__name__)
+
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+# Warm tesserocr handles per process; a request waits for a free one beyond this
+OCR_POOL_SIZE = int(os.getenv("OCR_POOL_SIZE", 0)) or os.cpu_count() or 1
+
+
+# Tesseract page segmentation mode for a crop holding one block of text
+PSM_SINGLE_BLOCK = 6
+
+
+class OcrEngine:
+    """
+    Base class: turns a grayscale or RGB uint8 array into text.
+    psm overrides Tesseract's page segmentation mode for one call.
+    """
+    name = "base"
+
+    def image_to_string(self, img, psm=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PytesseractEngine(OcrEngine):
+    """Subprocess-per-call Tesseract; always available, used as the fallback."""
+    name = "pytesseract"
+
+    def __init__(self, lang=OCR_LANG, config=""):
+        self.lang = lang
+        self.config = config
+
+    def image_to_string(self, img, psm=None):
+        config = self.config if psm is None else f"{self.config} --psm {psm}".strip()
+        return pytesseract.image_to_string(img, lang=self.lang, config=config)
+
+
+class TesserocrEngine(OcrEngine):
+    """
+    Bounded pool of warm PyTessBaseAPI handles (OCR_POOL_SIZE, default one
+    per core). A call checks a handle out and returns it afterwards; handles
+    are created on demand up to the pool size and then reused, so the
+    language data is loaded at most pool-size times per process no matter
+    how many threads the server starts.
+    """
+    name = "tesserocr"
+
+    def __init__(self, lang=OCR_LANG, psm=None, size=None):
+        if tesserocr is None:
+            raise RuntimeError("tesserocr is not installed")
+        self.lang = lang
+        self.psm = psm if psm is not None else tesserocr.PSM.AUTO
+        self.size = max(1, size or OCR_POOL_SIZE)
+        self._idle = queue.Queue(maxsize=self.size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _checkout(self):
+        try:
+            api = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    api = tesserocr.PyTessBaseAPI(lang=self.lang, psm=self.psm)
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                api = self._idle.get()
+        try:
+            yield api
+        finally:
+            api.Clear()
+            self._idle.put(api)
+
+    def image_to_string(self, img, psm=None):
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        height, width = img.shape[:2]
+        bytes_per_pixel = 1 if img.ndim == 2 else img.shape[2]
+        with self._checkout() as api:
+            api.SetPageSegMode(self.psm if psm is None else psm)
+            api.SetImageBytes(img.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+            return api.GetUTF8Text()
+
+    @property
+    def pool_size(self):
+        """Handles created so far (at most self.size)."""
+        with self._lock:
+            return self._created
+
+    def close(self):
+        """Ends the idle handles; call once no OCR is in flight."""
+        while True:
+            try:
+                api = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            api.End()
+            with self._lock:
+                self._created -= 1
+
+
+ENGINES = {
+    PytesseractEngine.name: PytesseractEngine,
+    TesserocrEngine.name: TesserocrEngine,
+}
+
+
+def create_ocr_engine(name=None):
+    """
+    Builds the engine named by `name` or the OCR_ENGINE env var.
+    "auto" (the default) picks tesserocr when it is installed, else pytesseract.
+    """
+    name = (name or os.getenv("OCR_ENGINE", "auto")).lower()
+    if name == "auto":
+        name = TesserocrEngine.name if tesserocr is not None else PytesseractEngine.name
+    if name not in ENGINES:
+        raise ValueError(f"Unknown OCR engine '{name}'. Use one of: auto, {', '.join(ENGINES)}")
+    try:
+        return ENGINES[name]()
+    except Exception as e:
+        logger.warning("OCR engine '%s' unavailable (%s); falling back to pytesseract", name, e)
+        return PytesseractEngine()
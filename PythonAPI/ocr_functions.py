@@ -1,135 +1,551 @@
+import time
+_import_started = time.perf_counter()
+
 from flask import Flask, request, jsonify
 import cv2
-import pytesseract
-from PIL import Image
-import re
-import spacy
-import numpy as np
 import io
 import base64
-from pdf2image import convert_from_bytes  
 import os
 import json
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 import google.generativeai as genai
 from dotenv import load_dotenv
+from result_cache import get_cache, hash_bytes, hash_source, make_key, cache_stats
+from pdf_text_layer import read_document_text, text_layer_flag, TEXT_LAYER_ENABLED, SOURCE_TEXT_LAYER, SOURCE_OCR
+from rasterizer import iter_pages, page_count
+from ocr_engines import create_ocr_engine, PSM_SINGLE_BLOCK
+import layout
+from jobs import register_job, create_jobs_blueprint
+from model_registry import registry, create_ready_blueprint, finish_startup
+from streaming import read_upload, request_params, wants_stream, ndjson_response
+from field_extractor import FieldExtractor, clean_json
+from llm_client import LLMClient, create_backend, LLM_BACKEND, LLM_CONCURRENCY
+from tracing import instrument_app, metrics, propagate, stage
 
 # ------------------- Flask App -------------------
 app = Flask(__name__)
-
-# Load spaCy English model
-nlp = spacy.load("en_core_web_sm")
+# Server-Timing headers, /metrics and the opt-in request profiler (see tracing)
+instrument_app(app, "ocr")
 
 # Initialize Gemini Client
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
 api_key = os.getenv("GEMINI_API_KEY")
 genai.configure(api_key=api_key)
 
+# Tesseract backend (OCR_ENGINE=auto|tesserocr|pytesseract)
+ocr_engine = create_ocr_engine()
+
+
+# Batch settings: one OCR process per core, with a cap on queued pages so a
+# large ZIP never holds more than a few rendered pages in memory at once.
+BATCH_WORKERS = int(os.getenv("OCR_BATCH_WORKERS", os.cpu_count() or 1))
+MAX_IN_FLIGHT_PAGES = int(os.getenv("OCR_MAX_IN_FLIGHT_PAGES", BATCH_WORKERS * 2))
+# Batch workers are spawned rather than forked from the threaded web process,
+# whose locks (Tesseract handle pool, logging, LLM threads) a fork would copy
+# in whatever state other threads held them; see jobs.py
+BATCH_START_METHOD = os.getenv("OCR_BATCH_START_METHOD", "spawn")
+BATCH_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png")
+
+# Pipeline parameters; they are part of every cache key so changing any of
+# them invalidates the affected cached results.
+OCR_DPI = int(os.getenv("OCR_DPI", 300))
+OCR_RENDERER = "mupdf-gray"
+OCR_ENGINE = ocr_engine.name
+OCR_THRESHOLD = 150
+GEMINI_MODEL = "gemini-1.5-flash"
+# Region-of-interest OCR: only the text blocks found by the layout pass are
+# OCRed (see layout.py). "auto" enables it with tesserocr, where a call per
+# block is cheap; pytesseract starts a process per call.
+OCR_LAYOUT = os.getenv("OCR_LAYOUT", "auto").lower()
+LAYOUT_ENABLED = OCR_LAYOUT in ("1", "true") or (OCR_LAYOUT == "auto" and OCR_ENGINE == "tesserocr")
+
+def is_json_reply(output_text):
+    try:
+        json.loads(clean_json(output_text))
+        return True
+    except json.JSONDecodeError:
+        return False
 
-def load_document_from_bytes(file_bytes, filename="file"):
+# Shared, rate-limited LLM client (LLM_BACKEND=gemini|http, see llm_client).
+# Replies are cached by prompt; ones that do not parse are not cached so the
+# next request retries them.
+llm_client = LLMClient(
+    backend=create_backend(LLM_BACKEND, model=GEMINI_MODEL) if LLM_BACKEND == "gemini" else create_backend(LLM_BACKEND),
+    cache=get_cache("fields"),
+    cache_if=is_json_reply,
+)
+
+
+def load_document_from_bytes(source, filename="file", first_page=None, last_page=None):
     """
-    Convert Base64 bytes to list of OpenCV images
-    Supports PDFs and images
+    Lazily yield the pages of a PDF or image as grayscale NumPy arrays
+    source is the file's bytes or its path (see rasterizer)
+    first_page/last_page (1-based) limit which PDF pages are rendered
     """
-    images = []
+    is_pdf = filename.lower().endswith(".pdf")
+    page_numbers = None
+    if is_pdf and (first_page or last_page):
+        page_numbers = range(first_page or 1, (last_page or count_pages(source, filename)) + 1)
     try:
-        if filename.lower().endswith(".pdf"):
-            # PDF → convert pages to images
-            pages = convert_from_bytes(file_bytes, dpi=300)
-            for page in pages:
-                img_bytes = io.BytesIO()
-                page.save(img_bytes, format="PNG")
-                img_bytes.seek(0)
-                img = cv2.imdecode(np.frombuffer(img_bytes.read(), np.uint8), cv2.IMREAD_COLOR)
-                images.append(img)
-        else:
-            # Treat as image
-            img = cv2.imdecode(np.frombuffer(file_bytes, np.uint8), cv2.IMREAD_COLOR)
-            images.append(img)
+        # Pages are rendered straight into a gray buffer, which is all
+        # extract_text needs; no PNG round trip and one page in memory at a time
+        for _, img in iter_pages(source, is_pdf, dpi=OCR_DPI, grayscale=True, page_numbers=page_numbers):
+            yield img
     except Exception as e:
         raise ValueError(f"Failed to load document: {e}")
-    return images
 
-def extract_text(img):
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    _, thresh = cv2.threshold(gray, 150, 255, cv2.THRESH_BINARY)
-    text = pytesseract.image_to_string(thresh)
-    return text
-
-def clean_json(text):
-    text = re.sub(r"^```json\s*", "", text, flags=re.IGNORECASE | re.MULTILINE)
-    text = re.sub(r"\s*```$", "", text, flags=re.MULTILINE)
-    return text.strip()
-
-def extract_fields_with_gemini(text):
-    prompt = f"""
-You are an AI trained to extract information from certificates. 
-From the certificate text below, extract the following fields:
-- Name of the recipient
-- Name of the organisation
-- Degree name
-- Year of completion
-- Honors or distinction if mentioned
-- Roll number
-- Grade
-- Organisation
-- Organisation ID
-
-Return the result as a valid JSON object only, JSON object ONLY, without any explanations, comments, or extra text with keys "name", "degree", "year", "honors", "roll_number", "grade", "organisation", "organisation_id".
-If a field is not found, use null for that field.
-
-Certificate Text:
-\"\"\"{text}\"\"\"
-"""
-    
-    model = genai.GenerativeModel("gemini-1.5-flash")
-    response = model.generate_content(prompt)
+def count_pages(source, filename="file"):
+    """Number of pages in a document (bytes or path) without rendering it."""
+    if filename.lower().endswith(".pdf"):
+        try:
+            return page_count(source)
+        except Exception as e:
+            raise ValueError(f"Failed to load document: {e}")
+    return 1
 
-    output_text = response.text.strip()
-    cleaned_text = clean_json(output_text)
+def ocr_page(img):
+    """
+    OCR of one page: {"text", "blocks"}. With LAYOUT_ENABLED only the text
+    blocks are OCRed, each at a normalised text height, and "blocks" lists
+    them as {"box", "text"}; otherwise (or when the blocks cover most of
+    the page) the full page is OCRed and "blocks" is empty.
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    if LAYOUT_ENABLED:
+        with stage("layout"):
+            blocks = layout.detect_text_blocks(gray)
+        if blocks and layout.coverage(blocks, gray.shape) <= layout.MAX_COVERAGE:
+            def recognise(crop):
+                _, thresh = cv2.threshold(crop, OCR_THRESHOLD, 255, cv2.THRESH_BINARY)
+                return ocr_engine.image_to_string(thresh, psm=PSM_SINGLE_BLOCK)
+
+            with stage("tesseract"):
+                blocks = layout.ocr_blocks(gray, blocks, recognise)
+            return {"text": "\n\n".join(block["text"] for block in blocks), "blocks": blocks}
+
+    with stage("tesseract"):
+        _, thresh = cv2.threshold(gray, OCR_THRESHOLD, 255, cv2.THRESH_BINARY)
+        text = ocr_engine.image_to_string(thresh)
+    return {"text": text, "blocks": []}
 
+def extract_text(img):
+    return ocr_page(img)["text"]
+
+
+# ------------------- Cached Pipeline Stages -------------------
+def load_page(source, filename, page_number, digest=None):
+    """Renders a single page, reusing a cached bitmap when available."""
+    digest = digest or hash_source(source)
+    key = make_key(digest, stage="page", page=page_number, dpi=OCR_DPI, renderer=OCR_RENDERER)
+
+    def render():
+        with stage("rasterize"):
+            img = next(load_document_from_bytes(source, filename, first_page=page_number, last_page=page_number), None)
+        if img is None:
+            raise ValueError("Failed to load document: page could not be decoded")
+        return img
+
+    return get_cache("pages").get_or_compute(key, render)
+
+def cached_ocr_page(source, filename, page_number, digest=None):
+    """ocr_page() result for a page; on a hit the page is never rendered."""
+    digest = digest or hash_source(source)
+    key = make_key(digest, stage="ocr", page=page_number, dpi=OCR_DPI, renderer=OCR_RENDERER,
+                   engine=OCR_ENGINE, lang=ocr_engine.lang, threshold=OCR_THRESHOLD,
+                   layout=layout.settings() if LAYOUT_ENABLED else None)
+    return get_cache("ocr_text").get_or_compute(
+        key, lambda: ocr_page(load_page(source, filename, page_number, digest))
+    )
+
+def read_text_layer(source, filename, use_text_layer=TEXT_LAYER_ENABLED):
+    """
+    Embedded text per page of a document, None for the pages to OCR; its
+    length is the page count. A digital PDF is opened once for all pages and
+    a page's text is only used when it passes the quality check.
+    """
+    if use_text_layer and filename.lower().endswith(".pdf"):
+        try:
+            with stage("text_layer"):
+                return read_document_text(source)
+        except Exception:
+            # Let count_pages / the OCR path report the error for unreadable PDFs
+            pass
+    return [None] * count_pages(source, filename)
+
+def extract_page_text(source, filename, page_number, digest=None, text=None):
+    """
+    Returns (text, source, blocks) for a page. text is the page's embedded
+    text from read_text_layer; without it the page is rasterized + OCRed.
+    blocks holds the OCRed text blocks (empty for full-page OCR).
+    """
+    if text is not None:
+        return text, SOURCE_TEXT_LAYER, []
+    result = cached_ocr_page(source, filename, page_number, digest)
+    return result["text"], SOURCE_OCR, result["blocks"]
+
+# spaCy English model for the field extractor, loaded on first use (see model_registry)
+def _load_spacy():
+    import spacy
+    return spacy.load("en_core_web_sm")
+
+registry.register("spacy_en", _load_spacy)
+
+# Local regex / spaCy / layout-anchor extraction; the LLM only sees the fields
+# that stay below FIELD_CONFIDENCE_THRESHOLD (FIELD_LLM=none disables it)
+field_extractor = FieldExtractor(
+    llm=None if os.getenv("FIELD_LLM", "gemini").lower() == "none" else llm_client,
+    nlp=lambda: registry.get("spacy_en"),
+)
+
+metrics.gauge("certify_llm_pending", "LLM calls queued or running in this worker.", lambda: llm_client.pending)
+metrics.collected_counter("certify_llm_events_total", "LLM client calls, retries, failures, coalesced prompts and cache hits.",
+                          lambda: {(event,): count for event, count in llm_client.stats.items()}, ("event",))
+
+def attach_fields(page_results, organisation_id=None):
+    """
+    Adds "fields", "confidence" and "field_sources" to the page results of
+    one document, plus "field_boxes" ({field: box}) for pages OCRed block by
+    block; pages that failed are left as they are.
+    """
+    pages = [result for result in page_results if result and "error" not in result]
+    if not pages:
+        return page_results
+    extracted = field_extractor.extract_document([page["ocr_text"] for page in pages], organisation_id)
+    for page, fields in zip(pages, extracted):
+        page.update(fields)
+        if page.get("blocks"):
+            page["field_boxes"] = layout.locate_fields(page["blocks"], page["fields"])
+    return page_results
+
+
+# ------------------- Batch Processing -------------------
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+def get_batch_pool():
+    """Process pool shared by all batch requests, created on first use."""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ProcessPoolExecutor(max_workers=BATCH_WORKERS,
+                                              mp_context=multiprocessing.get_context(BATCH_START_METHOD))
+        return _batch_pool
+
+def reset_batch_pool(pool):
+    """
+    Drop a pool whose worker died so the next batch starts a fresh one.
+    Does nothing if another request already replaced it, so a late error
+    from an old pool never shuts down the healthy one.
+    """
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is not pool:
+            return
+        _batch_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def submit_page(*args):
+    """Queues process_page(*args) on the batch pool, replacing the pool if it broke."""
+    pool = get_batch_pool()
     try:
-        extracted_fields = json.loads(cleaned_text)
-    except json.JSONDecodeError:
-        extracted_fields = {"error": "Failed to parse JSON", "raw_output": output_text}
-    
-    return extracted_fields
+        return pool, pool.submit(process_page, *args)
+    except (BrokenProcessPool, RuntimeError):
+        # Broken, or shut down by another request after we fetched it
+        reset_batch_pool(pool)
+        pool = get_batch_pool()
+        return pool, pool.submit(process_page, *args)
+
+def process_page(source, filename, page_number, digest=None, text=None):
+    """
+    Read a single page (text layer or OCR) of a document given as bytes or a
+    path; fields are attached per document afterwards by attach_fields. Runs
+    inside a pool worker for batches, where it gets the path of the spooled
+    file, so neither the document nor a 300-DPI bitmap crosses the process
+    boundary. text is the page's embedded text, if usable (see read_text_layer).
+    """
+    ocr_text, text_source, blocks = extract_page_text(source, filename, page_number, digest, text)
+    result = {"page": page_number, "source": text_source, "ocr_text": ocr_text}
+    if blocks:
+        result["blocks"] = blocks
+    return result
+
+def extract_zip_documents(zip_bytes, directory):
+    """
+    Writes every supported document in a ZIP archive to `directory` and
+    returns (filename, path) for each, in archive order.
+    """
+    documents = []
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(BATCH_EXTENSIONS):
+                continue
+            path = os.path.join(directory, f"{len(documents)}{os.path.splitext(info.filename)[1].lower()}")
+            with archive.open(info) as member, open(path, "wb") as f:
+                shutil.copyfileobj(member, f)
+            documents.append((info.filename, path))
+    return documents
+
+def spool_document(file_bytes, filename, directory):
+    """Writes a document to a uniquely named file in `directory` and returns its path."""
+    fd, path = tempfile.mkstemp(dir=directory, suffix=os.path.splitext(filename)[1].lower())
+    with os.fdopen(fd, "wb") as f:
+        f.write(file_bytes)
+    return path
+
+def run_batch(documents, use_text_layer=TEXT_LAYER_ENABLED, organisation_id=None):
+    """
+    OCR many documents across the process pool.
+    documents is a list of (filename, bytes or path); the result keeps that
+    order and reports errors per file (and per page) instead of failing the
+    batch. Documents given as bytes are spooled to a temporary file so each
+    page task only sends the pool a path. Fields are extracted for a file as
+    soon as all of its pages are read, on a thread pool so LLM calls for
+    different files overlap with the OCR.
+    """
+    spool_dir = tempfile.mkdtemp(prefix="certify-batch-")
+    try:
+        return _run_batch(documents, spool_dir, use_text_layer, organisation_id)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+def _run_batch(documents, spool_dir, use_text_layer, organisation_id):
+    files = []
+    tasks = []
+    remaining = {}
+    for filename, source in documents:
+        entry = {"filename": filename}
+        files.append(entry)
+        try:
+            texts = read_text_layer(source, filename, use_text_layer)
+            digest = hash_source(source)
+            if not isinstance(source, str):
+                source = spool_document(source, filename, spool_dir)
+        except Exception as e:
+            entry["error"] = str(e)
+            continue
+        entry["results"] = [None] * len(texts)
+        remaining[len(files) - 1] = len(texts)
+        for page_number, text in enumerate(texts, start=1):
+            tasks.append((len(files) - 1, page_number, source, filename, digest, text))
+
+    field_pool = ThreadPoolExecutor(max_workers=LLM_CONCURRENCY, thread_name_prefix="fields")
+    try:
+        field_futures = []
+        pending = {}
+        tasks = iter(tasks)
+        exhausted = False
+        while pending or not exhausted:
+            # Keep at most MAX_IN_FLIGHT_PAGES pages queued in the pool
+            while not exhausted and len(pending) < MAX_IN_FLIGHT_PAGES:
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                    break
+                file_index, page_number, path, filename, digest, text = task
+                pool, future = submit_page(path, filename, page_number, digest, text)
+                pending[future] = (file_index, page_number, pool)
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_index, page_number, pool = pending.pop(future)
+                entry = files[file_index]
+                try:
+                    page_result = future.result()
+                except BrokenProcessPool as e:
+                    reset_batch_pool(pool)
+                    page_result = {"page": page_number, "error": f"OCR worker crashed: {e}"}
+                except Exception as e:
+                    page_result = {"page": page_number, "error": str(e)}
+                if "error" in page_result:
+                    entry["error"] = page_result["error"]
+                entry["results"][page_number - 1] = page_result
+                remaining[file_index] -= 1
+                if remaining[file_index] == 0:
+                    field_futures.append((entry, field_pool.submit(propagate(attach_fields), entry["results"], organisation_id)))
+
+        for entry, future in field_futures:
+            try:
+                future.result()
+            except Exception as e:
+                entry["error"] = f"Field extraction failed: {e}"
+    finally:
+        field_pool.shutdown()
+    return files
 
 
 # ------------------- Flask Route -------------------
 
+FIELD_KEYS = ("fields", "confidence", "field_sources", "field_boxes", "llm_error")
+
+def iter_extract_pages(source, filename, use_text_layer=TEXT_LAYER_ENABLED, organisation_id=None):
+    """
+    Streaming /extract: yields each page's text as soon as the page is read,
+    then one {"fields": [...]} record with every page's fields, extracted
+    for the whole document exactly as without streaming, then
+    {"done": true, "pages": n}.
+    """
+    digest = hash_source(source)
+    texts = read_text_layer(source, filename, use_text_layer)
+    results = []
+    for page_number, text in enumerate(texts, start=1):
+        try:
+            result = process_page(source, filename, page_number, digest, text)
+        except Exception as e:
+            result = {"page": page_number, "error": str(e)}
+        results.append(result)
+        yield result
+    attach_fields(results, organisation_id)
+    yield {"fields": [{"page": result["page"], **{key: result[key] for key in FIELD_KEYS if key in result}}
+                      for result in results if "error" not in result]}
+    yield {"done": True, "pages": len(texts)}
+
+
 @app.route("/extract", methods=["POST"])
 def extract_certificate_fields():
     """
     Accepts JSON body:
     {
         "filename": "certificate.pdf",
-        "b64": "<Base64 encoded file>"
+        "b64": "<Base64 encoded file>",
+        "text_layer": true,   (optional, use the PDF's embedded text when usable)
+        "organisation_id": "" (optional, selects the learned layout anchors)
     }
+    or the file itself, without base64: a multipart "file" field (other
+    fields as form fields) or the raw body (?filename=...&text_layer=0).
+    Each page result reports its "source": "text_layer" or "ocr", plus a
+    confidence and source ("regex", "ner", "anchor", "llm", ...) per field.
+    With layout OCR, pages also list their text "blocks" and "field_boxes".
+    With ?stream=1 the response is NDJSON: one record per page as it is
+    read, then the fields of every page (see iter_extract_pages).
     """
-    data = request.get_json()
-    if not data or "b64" not in data:
-        return jsonify({"error": "No Base64 data provided"}), 400
-
-    file_b64 = data["b64"]
-    filename = data.get("filename", "file.png")  # default extension if not provided
-
-    try:
-        file_bytes = base64.b64decode(file_b64)
-    except Exception as e:
-        return jsonify({"error": f"Invalid Base64: {e}"}), 400
+    upload = read_upload(request)
+    if upload is not None:
+        filename, source = upload.filename, upload.source
+        data = request_params(request)
+    else:
+        data = request.get_json(silent=True)
+        if not data or "b64" not in data:
+            return jsonify({"error": "No file or Base64 data provided"}), 400
+
+        file_b64 = data["b64"]
+        filename = data.get("filename", "file.png")  # default extension if not provided
+
+        try:
+            source = base64.b64decode(file_b64)
+        except Exception as e:
+            return jsonify({"error": f"Invalid Base64: {e}"}), 400
+
+    use_text_layer = text_layer_flag(data.get("text_layer"))
+    organisation_id = data.get("organisation_id")
+    if wants_stream(request, data):
+        return ndjson_response(iter_extract_pages(source, filename, use_text_layer, organisation_id),
+                               on_close=upload.close if upload is not None else None)
 
     try:
-        images = load_document_from_bytes(file_bytes, filename)
+        digest = hash_source(source)
+        texts = read_text_layer(source, filename, use_text_layer)
+        all_results = [process_page(source, filename, page_number, digest, text)
+                       for page_number, text in enumerate(texts, start=1)]
+        attach_fields(all_results, organisation_id)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        if upload is not None:
+            upload.close()
+
+    return jsonify({"results": all_results})
+
 
+@app.route("/extract-batch", methods=["POST"])
+def extract_certificate_fields_batch():
+    """
+    Accepts JSON body with either a list of documents:
+    {
+        "documents": [{"filename": "certificate.pdf", "b64": "<Base64 encoded file>"}, ...]
+    }
+    or a whole ZIP archive:
+    {
+        "zip_b64": "<Base64 encoded zip>"
+    }
+    plus the optional "text_layer" and "organisation_id" fields as for /extract.
+    Returns {"files": [{"filename", "results" | "error"}, ...]}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or ("documents" not in data and "zip_b64" not in data):
+        return jsonify({"error": "No documents or zip_b64 provided"}), 400
+    if "documents" in data and not (isinstance(data["documents"], list)
+                                    and all(isinstance(doc, dict) for doc in data["documents"])):
+        return jsonify({"error": "documents must be a list of {\"filename\", \"b64\"} objects"}), 400
+
+    use_text_layer = text_layer_flag(data.get("text_layer"))
+    organisation_id = data.get("organisation_id")
+    if "zip_b64" in data:
+        with tempfile.TemporaryDirectory(prefix="certify-zip-") as directory:
+            try:
+                documents = extract_zip_documents(base64.b64decode(data["zip_b64"]), directory)
+            except Exception as e:
+                return jsonify({"error": f"Invalid ZIP archive: {e}"}), 400
+            return jsonify({"files": run_batch(documents, use_text_layer, organisation_id)})
+
+    documents = []
+    decode_errors = {}
+    for idx, doc in enumerate(data["documents"]):
+        filename = str(doc.get("filename") or f"file_{idx + 1}.png")
+        try:
+            documents.append((filename, base64.b64decode(doc["b64"])))
+        except Exception as e:
+            decode_errors[len(documents)] = {"filename": filename, "error": f"Invalid Base64: {e}"}
+            documents.append((filename, None))
+
+    valid = [(name, file_bytes) for i, (name, file_bytes) in enumerate(documents) if i not in decode_errors]
+    processed = iter(run_batch(valid, use_text_layer, organisation_id))
+    files = [decode_errors[i] if i in decode_errors else next(processed) for i in range(len(documents))]
+
+    return jsonify({"files": files})
+
+
+@register_job("extract", stage="ocr")
+def extract_job(files, params, progress):
+    """
+    Job version of /extract: multipart "file" plus optional "text_layer"
+    ("0" to force OCR) and "organisation_id".
+    """
+    if "file" not in files:
+        raise ValueError("No file uploaded")
+    file_bytes = files["file"]
+    filename = params.get("filename") or params["filenames"].get("file") or "file.png"
+    use_text_layer = text_layer_flag(params.get("text_layer"))
+
+    digest = hash_bytes(file_bytes)
+    texts = read_text_layer(file_bytes, filename, use_text_layer)
+    page_count = len(texts)
     all_results = []
-    for idx, img in enumerate(images):
-        ocr_text = extract_text(img)
-        fields = extract_fields_with_gemini(ocr_text)
-        all_results.append({"page": idx + 1, "ocr_text": ocr_text, "fields": fields})
+    for page_number, text in enumerate(texts, start=1):
+        all_results.append(process_page(file_bytes, filename, page_number, digest, text))
+        progress(page_number, page_count, f"Page {page_number} of {page_count}")
+    attach_fields(all_results, params.get("organisation_id"))
+    return {"results": all_results}
 
-    return jsonify({"results": all_results})
+app.register_blueprint(create_jobs_blueprint("ocr"))
+app.register_blueprint(create_ready_blueprint())
+
+
+@app.route("/cache-stats", methods=["GET"])
+def get_cache_stats():
+    """Hit/miss counters for this worker's result caches."""
+    return jsonify(cache_stats())
+
+
+finish_startup(__name__, _import_started)
 
 
 # ------------------- Run Server -------------------
@@ -0,0 +1,57 @@
+import os
+from rasterizer import open_pdf
+
+# ---------------- PDF Text-Layer Fast Path ----------------
+# Digitally generated certificates already carry an exact text layer, which
+# PyMuPDF returns in milliseconds. A page's embedded text is only trusted when
+# it passes a quality check; otherwise the caller rasterizes and OCRs it.
+
+TEXT_LAYER_ENABLED = os.getenv("PDF_TEXT_LAYER", "1") != "0"
+MIN_TEXT_CHARS = int(os.getenv("PDF_TEXT_LAYER_MIN_CHARS", 40))
+MIN_PRINTABLE_RATIO = float(os.getenv("PDF_TEXT_LAYER_MIN_PRINTABLE", 0.9))
+
+SOURCE_TEXT_LAYER = "text_layer"
+SOURCE_OCR = "ocr"
+
+
+def text_quality(text):
+    """
+    Character count (ignoring whitespace) and the share of those characters
+    that are printable. Broken font encodings show up as control characters
+    or U+FFFD replacement characters and pull the ratio down.
+    """
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return {"chars": 0, "printable_ratio": 0.0}
+    printable = sum(1 for c in chars if c.isprintable() and c != "\ufffd")
+    return {"chars": len(chars), "printable_ratio": printable / len(chars)}
+
+
+def is_usable_text(text):
+    quality = text_quality(text)
+    return quality["chars"] >= MIN_TEXT_CHARS and quality["printable_ratio"] >= MIN_PRINTABLE_RATIO
+
+
+def page_text_if_usable(page):
+    """Embedded text of a PyMuPDF page, or None if it fails the quality check."""
+    text = page.get_text("text")
+    return text if is_usable_text(text) else None
+
+
+def read_document_text(source):
+    """Usable embedded text of every page of a PDF (bytes or path), None for pages to OCR."""
+    with open_pdf(source) as doc:
+        return [page_text_if_usable(page) for page in doc]
+
+
+def text_layer_flag(value, default=TEXT_LAYER_ENABLED):
+    """
+    The "text_layer" request option as a bool, whether it came as a JSON
+    boolean or number or as a form/query string ("0", "false", "no", "off").
+    """
+    if value is None:
+        return default
+    if isinstance(value, str):
+        value = value.strip().lower()
+        return default if not value else value not in ("0", "false", "no", "off")
+    return bool(value)
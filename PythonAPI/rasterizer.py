@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+import fitz  # PyMuPDF
+
+# ---------------- Shared Page Rasterizer ----------------
+# Renders PDF pages straight into NumPy arrays. The array is a view over the
+# pixmap's own sample buffer, so a page is never encoded to PNG and decoded
+# again, and pages are yielded one at a time so only the page being processed
+# is held in memory.
+#
+# A document ("source") is either its bytes or the path of a file holding
+# them; a PDF on disk is opened by path, so MuPDF reads only the pages it
+# needs instead of the whole file being loaded into memory first.
+
+
+class PixmapArray(np.ndarray):
+    """ndarray view over a pixmap's samples; keeps the pixmap alive with it."""
+    pixmap = None
+
+
+def pixmap_to_array(pix):
+    """Wraps a pixmap's sample buffer as an (H, W) or (H, W, C) uint8 array without copying."""
+    arr = np.ndarray(
+        shape=(pix.height, pix.width, pix.n),
+        dtype=np.uint8,
+        buffer=pix.samples_mv,
+        strides=(pix.stride, pix.n, 1),
+    )
+    if pix.n == 1:
+        arr = arr[:, :, 0]
+    arr = arr.view(PixmapArray)
+    # The buffer belongs to the pixmap, so it must outlive the array
+    arr.pixmap = pix
+    return arr
+
+
+def render_page(page, dpi=300, grayscale=False):
+    """Renders a PyMuPDF page as an RGB (or single-channel gray) array."""
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    pix = page.get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+    return pixmap_to_array(pix)
+
+
+def open_pdf(source):
+    """Opens a PDF given as bytes or as a file path."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source, filetype="pdf")
+
+
+def page_count(source):
+    with open_pdf(source) as doc:
+        return doc.page_count
+
+
+def iter_pdf_pages(source, dpi=300, grayscale=False, page_numbers=None):
+    """
+    Lazily yields (page_number, array) for a PDF, 1-based.
+    page_numbers restricts rendering to the given pages.
+    """
+    with open_pdf(source) as doc:
+        numbers = page_numbers or range(1, doc.page_count + 1)
+        for page_number in numbers:
+            yield page_number, render_page(doc.load_page(page_number - 1), dpi, grayscale)
+
+
+def decode_image(source, grayscale=False):
+    """Decodes JPG/PNG bytes (or a file) into an RGB (or gray) array; None if undecodable."""
+    flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = np.frombuffer(source, np.uint8)
+    else:
+        data = np.fromfile(source, np.uint8)
+    img = cv2.imdecode(data, flag)
+    if img is None or grayscale:
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def iter_pages(source, is_pdf, dpi=300, grayscale=False, page_numbers=None):
+    """Lazily yields (page_number, array) for a PDF or a single image."""
+    if is_pdf:
+        yield from iter_pdf_pages(source, dpi, grayscale, page_numbers)
+    else:
+        yield 1, decode_image(source, grayscale)
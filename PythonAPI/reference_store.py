@@ -0,0 +1,300 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ---------------- Reference Embedding Store ----------------
+# Profile/signature embeddings and SIFT descriptors of every issued
+# certificate, computed once at ingest time. Vectors live in flat append-only
+# files that are memory-mapped for reads; a small JSON index maps each
+# certificate ID to its row.
+#
+#   profile.f32, sign.f32  float32 [rows, dim]      (zeros where a region is missing)
+#   sift.u8                uint8   [descriptors, 128] (SIFT values already lie in 0..255)
+#   index.json             {"format", "embedder", "dim", "rows", "sift_rows", "certificates": {id: entry}}
+#
+# Each region is a contiguous matrix so it can be scanned with one matmul.
+# "embedder" names the model that produced the embeddings (the embedding
+# cache's model version); a store opened with a different embedder refuses
+# to ingest or compare, since the vectors would live in different spaces.
+# Stores in the first format (one interleaved embeddings.f32 [rows, 2, dim]
+# with a "slot" per region, no "format" key) are converted on first open;
+# the old file is left in place and can be deleted afterwards.
+#
+# Ingests from several processes (gunicorn workers) take turns through an
+# flock on store.lock: each reloads the index, takes the next row from the
+# size of the region files, appends and writes the index back while holding
+# it. Readers in other processes pick up new certificates when index.json
+# changes. Without fcntl (Windows) only threads are serialised, so run a
+# single worker there.
+
+REFERENCE_STORE_DIR = os.getenv(
+    "REFERENCE_STORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference_store")
+)
+REGIONS = ("profile", "sign")
+SIFT_DIM = 128
+FORMAT_VERSION = 2
+# Stores written before the embedder was recorded all used this one
+LEGACY_EMBEDDER = "resnet50-imagenet-avgpool"
+
+logger = logging.getLogger(__name__)
+
+
+class ReferenceStore:
+    def __init__(self, directory=REFERENCE_STORE_DIR, embedder=None):
+        self.directory = directory
+        self.embedder = embedder
+        self._index_path = os.path.join(directory, "index.json")
+        self._region_paths = {name: os.path.join(directory, f"{name}.f32") for name in REGIONS}
+        self._sift_path = os.path.join(directory, "sift.u8")
+        self._lock_path = os.path.join(directory, "store.lock")
+        self._lock = threading.RLock()
+        self._lock_held = False
+        self._index_mtime = None
+        self._index = {"format": FORMAT_VERSION, "dim": None, "rows": 0, "sift_rows": 0, "certificates": {}}
+        self._embeddings = {}
+        self._sift = None
+        os.makedirs(directory, exist_ok=True)
+        self._refresh()
+
+    # ----- internal -----
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock on the store across processes (and, through self._lock, threads)."""
+        with self._lock:
+            if self._lock_held or fcntl is None:
+                # flock is per open file, so a nested call must not lock again
+                yield
+                return
+            with open(self._lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._lock_held = True
+                try:
+                    yield
+                finally:
+                    self._lock_held = False
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self, force=False):
+        """Reloads the index if another process has written to the store."""
+        try:
+            mtime = os.stat(self._index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._index_mtime and not force:
+            return
+        with self._file_lock():
+            self._load_index()
+
+    def _load_index(self):
+        try:
+            mtime = os.stat(self._index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with open(self._index_path) as f:
+            index = json.load(f)
+        version = index.get("format", 1)
+        if version > FORMAT_VERSION:
+            raise RuntimeError(f"Reference store {self.directory} has format {version}; this version reads "
+                               f"up to {FORMAT_VERSION}. Upgrade, or re-ingest into an empty REFERENCE_STORE_DIR.")
+        self._index = index
+        self._embeddings = {}
+        self._sift = None
+        if version < FORMAT_VERSION:
+            self._migrate_v1()
+        else:
+            self._index_mtime = mtime
+
+    def _migrate_v1(self):
+        """Splits the interleaved embeddings.f32 of a format-1 store into one matrix per region."""
+        rows, dim = self._index["rows"], self._index["dim"]
+        if rows:
+            old = np.memmap(os.path.join(self.directory, "embeddings.f32"), dtype=np.float32, mode="r",
+                            shape=(rows, len(REGIONS), dim))
+            for slot, name in enumerate(REGIONS):
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(np.ascontiguousarray(old[:, slot]).tobytes())
+                os.replace(tmp_path, self._region_paths[name])
+            del old
+        for entry in self._index["certificates"].values():
+            entry.setdefault("phash", None)
+            for region in entry["regions"].values():
+                region.pop("slot", None)
+        self._index["format"] = FORMAT_VERSION
+        self._write_index()
+        logger.info("Converted reference store %s to format %d (%d rows)", self.directory, FORMAT_VERSION, rows)
+
+    def _stored_embedder(self):
+        return self._index.get("embedder") or (LEGACY_EMBEDDER if self._index["rows"] else None)
+
+    def _check_embedder(self):
+        stored = self._stored_embedder()
+        if self.embedder and stored and stored != self.embedder:
+            raise RuntimeError(f"Reference store {self.directory} holds embeddings from '{stored}', but this "
+                               f"service embeds with '{self.embedder}' (EMBEDDER_BACKEND / EMBEDDER_BACKBONE). "
+                               f"Switch back, or re-ingest into an empty REFERENCE_STORE_DIR.")
+
+    def _write_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+        self._index_mtime = os.stat(self._index_path).st_mtime_ns
+
+    def _embedding_map(self, name):
+        rows = self._index["rows"]
+        if rows == 0:
+            return None
+        mapped = self._embeddings.get(name)
+        if mapped is None or mapped.shape[0] != rows:
+            mapped = np.memmap(self._region_paths[name], dtype=np.float32, mode="r",
+                               shape=(rows, self._index["dim"]))
+            self._embeddings[name] = mapped
+        return mapped
+
+    @staticmethod
+    def _file_rows(path, row_bytes):
+        """Whole rows in an append-only file."""
+        try:
+            return os.path.getsize(path) // row_bytes
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _truncate(path, size):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _sift_map(self):
+        rows = self._index["sift_rows"]
+        if rows == 0:
+            return None
+        if self._sift is None or self._sift.shape[0] != rows:
+            self._sift = np.memmap(self._sift_path, dtype=np.uint8, mode="r", shape=(rows, SIFT_DIM))
+        return self._sift
+
+    # ----- public -----
+    def add(self, certificate_id, regions, phash=None):
+        """
+        Stores the signatures of one issued certificate.
+        regions maps "profile"/"sign" to (embedding, sift_descriptors) or None;
+        phash is the optional 64-bit perceptual hash of the whole page.
+        Re-ingesting an ID replaces the previous entry.
+        """
+        certificate_id = str(certificate_id)
+        with self._file_lock():
+            # Another worker may have ingested since our last look
+            self._refresh(force=True)
+            self._check_embedder()
+            embeddings = [value[0] for value in regions.values() if value is not None]
+            dim = self._index["dim"] or (len(embeddings[0]) if embeddings else None)
+            if dim is None:
+                raise ValueError("Cannot ingest a certificate before any embedding dimension is known")
+
+            # The next row comes from the files, not the cached index. Anything
+            # past the last complete row was left by an ingest that died before
+            # writing the index; nothing refers to it, so it is cut off.
+            next_row = min(self._file_rows(self._region_paths[name], dim * 4) for name in REGIONS)
+            sift_rows = self._file_rows(self._sift_path, SIFT_DIM)
+            for name in REGIONS:
+                self._truncate(self._region_paths[name], next_row * dim * 4)
+            self._truncate(self._sift_path, sift_rows * SIFT_DIM)
+
+            row = np.zeros((len(REGIONS), dim), dtype=np.float32)
+            entry = {"row": next_row, "phash": phash, "regions": {}}
+            sift_chunks = []
+            for slot, name in enumerate(REGIONS):
+                value = regions.get(name)
+                if value is None:
+                    continue
+                embedding, descriptors = value
+                if len(embedding) != dim:
+                    raise ValueError(f"Embedding has dimension {len(embedding)}, store expects {dim}")
+                row[slot] = embedding
+                region = {"sift": None}
+                if descriptors is not None and len(descriptors):
+                    descriptors = np.clip(np.rint(descriptors), 0, 255).astype(np.uint8)
+                    region["sift"] = [sift_rows, len(descriptors)]
+                    sift_rows += len(descriptors)
+                    sift_chunks.append(descriptors)
+                entry["regions"][name] = region
+
+            for slot, name in enumerate(REGIONS):
+                with open(self._region_paths[name], "ab") as f:
+                    f.write(row[slot].tobytes())
+            if sift_chunks:
+                with open(self._sift_path, "ab") as f:
+                    for chunk in sift_chunks:
+                        f.write(np.ascontiguousarray(chunk).tobytes())
+
+            self._index["embedder"] = self.embedder or self._stored_embedder()
+            self._index["dim"] = dim
+            self._index["rows"] = next_row + 1
+            self._index["sift_rows"] = sift_rows
+            self._index["certificates"][certificate_id] = entry
+            self._write_index()
+        return entry
+
+    def get(self, certificate_id):
+        """
+        Returns {"profile"/"sign": (embedding, sift_descriptors) or None} for a
+        certificate, or None if it was never ingested. Embeddings are views
+        into the memory map.
+        """
+        with self._lock:
+            self._refresh()
+            self._check_embedder()
+            entry = self._index["certificates"].get(str(certificate_id))
+            if entry is None:
+                return None
+            sift = self._sift_map()
+            result = dict.fromkeys(REGIONS)
+            for name, region in entry["regions"].items():
+                descriptors = None
+                if region["sift"] is not None:
+                    offset, count = region["sift"]
+                    # OpenCV's SIFT matchers expect float32 descriptors
+                    descriptors = sift[offset:offset + count].astype(np.float32)
+                result[name] = (self._embedding_map(name)[entry["row"]], descriptors)
+            return result
+
+    def snapshot(self):
+        """
+        (rows, certificates, matrices) for building search indexes: the row
+        count, a copy of the ID -> entry map and the memory-mapped [rows, dim]
+        matrix per region, all from one index taken under the store lock.
+        Rows not referenced by any entry belong to replaced certificates.
+        """
+        with self._file_lock():
+            self._refresh()
+            self._check_embedder()
+            certificates = dict(self._index["certificates"])
+            matrices = {name: self._embedding_map(name) for name in REGIONS}
+            return self._index["rows"], certificates, matrices
+
+    @property
+    def version(self):
+        """Changes whenever a certificate is added (by any process)."""
+        with self._lock:
+            self._refresh()
+            return self._index["rows"]
+
+    def __contains__(self, certificate_id):
+        with self._lock:
+            self._refresh()
+            return str(certificate_id) in self._index["certificates"]
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._index["certificates"])
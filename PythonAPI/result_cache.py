@@ -0,0 +1,266 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# ---------------- Content-Addressed Result Cache ----------------
+# Results are keyed by a hash of the input bytes plus every parameter that
+# changes the output (DPI, OCR engine, model version, ...). Each cache level
+# keeps a bounded in-memory LRU in front of an on-disk store, so repeated
+# requests skip the expensive stages even after a restart. The on-disk store
+# of each level is bounded in bytes too: once it grows past its limit the
+# least recently used entries (oldest mtime; disk hits refresh it) are
+# deleted until it is back under PRUNE_TARGET of the limit.
+
+CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") != "0"
+
+# Default settings per level: (in-memory entries, persisted to disk, disk
+# limit in bytes); override them with RESULT_CACHE_<LEVEL>_ENTRIES and
+# RESULT_CACHE_<LEVEL>_MAX_BYTES (0 = unbounded). A level with no entries
+# that is not persisted is off. Rendered pages are up to ~25 MB each at 300
+# DPI and every process (gunicorn and batch workers alike) holds its own
+# copy, so the page cache is off unless RESULT_CACHE_PAGES_ENTRIES is set.
+MB = 1024 * 1024
+CACHE_LEVELS = {
+    "pages": (0, False, 0),
+    "ocr_text": (1024, True, 256 * MB),
+    "fields": (1024, True, 64 * MB),
+    "yolo_crops": (256, True, 1024 * MB),
+    "embeddings": (4096, True, 256 * MB),
+    "page_hashes": (4096, True, 16 * MB),
+}
+# Pruning deletes down to this share of the limit, so it does not run on every write
+PRUNE_TARGET = 0.8
+
+_MISSING = object()
+
+
+def hash_bytes(data):
+    """SHA-256 hex digest of raw bytes (or text, encoded as UTF-8)."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path, chunk_bytes=1024 * 1024):
+    """SHA-256 hex digest of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_source(source):
+    """Digest of a document given as bytes or as a file path; equal for both."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest()
+    return hash_file(source)
+
+
+def make_key(digest, **params):
+    """
+    Combines a content digest with the pipeline parameters into a cache key.
+    Parameters are serialised in sorted order so keyword order never matters.
+    """
+    params_json = json.dumps(params, sort_keys=True, default=str)
+    return hash_bytes(f"{digest}:{params_json}")
+
+
+class ResultCache:
+    """Thread-safe LRU cache with an optional on-disk backing store."""
+
+    def __init__(self, name, max_entries=256, persist=True, directory=None, max_bytes=0):
+        self.name = name
+        self.max_entries = max_entries
+        self.persist = persist
+        self.max_bytes = max_bytes
+        self.directory = directory or os.path.join(CACHE_DIR, name)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.pruned = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # Bytes on disk as last counted plus what this process wrote since;
+        # other processes write too, so pruning always recounts
+        self._disk_bytes = None
+        self._prune_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return CACHE_ENABLED and (self.max_entries > 0 or self.persist)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.pkl")
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+        if self.persist:
+            try:
+                with open(self._path(key), "rb") as f:
+                    value = pickle.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                # A corrupt or truncated entry is treated as a miss
+                pass
+            else:
+                try:
+                    # Mark it recently used for pruning
+                    os.utime(self._path(key))
+                except OSError:
+                    pass
+                self._remember(key, value)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        self._remember(key, value)
+        if not self.persist:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file and rename so readers never see partial data
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                written = f.tell()
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Result cache '%s' could not write to disk: %s", self.name, e)
+            return
+        if self.max_bytes:
+            self._account(written)
+
+    def _disk_entries(self):
+        """(mtime, size, path) of every entry on disk."""
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".pkl"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _account(self, written):
+        with self._prune_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+            else:
+                self._disk_bytes += written
+            if self._disk_bytes > self.max_bytes:
+                self._prune()
+
+    def _prune(self):
+        """Deletes the least recently used entries until the level is under PRUNE_TARGET of max_bytes."""
+        entries = sorted(self._disk_entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * PRUNE_TARGET
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._disk_bytes = total
+        with self._lock:
+            self.pruned += removed
+
+    def get_or_compute(self, key, compute):
+        """Returns the cached value for key, computing and storing it on a miss."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def clear(self, disk=False):
+        """Empties the in-memory cache; with disk=True the on-disk store is deleted too."""
+        with self._lock:
+            self._memory.clear()
+        if disk and self.persist:
+            with self._prune_lock:
+                for _, _, path in self._disk_entries():
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                self._disk_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._memory),
+                "max_entries": self.max_entries,
+                "persist": self.persist,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self._disk_bytes,
+                "pruned": self.pruned,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(level):
+    """Returns the shared cache for one of CACHE_LEVELS, creating it on first use."""
+    with _caches_lock:
+        if level not in _caches:
+            max_entries, persist, max_bytes = CACHE_LEVELS.get(level, (256, True, 256 * MB))
+            max_entries = int(os.getenv(f"RESULT_CACHE_{level.upper()}_ENTRIES", max_entries))
+            max_bytes = int(os.getenv(f"RESULT_CACHE_{level.upper()}_MAX_BYTES", max_bytes))
+            _caches[level] = ResultCache(level, max_entries=max_entries, persist=persist, max_bytes=max_bytes)
+        return _caches[level]
+
+
+def cache_stats():
+    """Hit/miss counters for every cache level used so far."""
+    with _caches_lock:
+        caches = list(_caches.values())
+    return {cache.name: cache.stats() for cache in caches}
@@ -1,88 +1,320 @@
+import time
+_import_started = time.perf_counter()
+
 from flask import Flask, request, jsonify
-import easyocr
+import cv2
 import numpy as np
 from flask_cors import CORS
 from PIL import Image
 import io
-import fitz  # PyMuPDF
+import math
+import os
+from result_cache import get_cache, hash_source, make_key, cache_stats
+import rasterizer
+from jobs import register_job, create_jobs_blueprint
+from model_registry import registry, create_ready_blueprint, finish_startup
+from pdf_text_layer import page_text_if_usable, text_layer_flag, TEXT_LAYER_ENABLED, SOURCE_TEXT_LAYER, SOURCE_OCR
+from streaming import read_upload, request_params, wants_stream, ndjson_response
+from tracing import instrument_app, timed, stage
 
 app = Flask(__name__)
 CORS(app)
+instrument_app(app, "robust-ocr")
+
+# EasyOCR reader (English), loaded on first use (see model_registry)
+def _load_reader():
+    import easyocr
+    return easyocr.Reader(['en'], gpu=False)  # Set gpu=True if you have GPU
+
+registry.register("easyocr_en", _load_reader)
 
-# Initialize EasyOCR reader (English)
-reader = easyocr.Reader(['en'], gpu=False)  # Set gpu=True if you have GPU
+# Pipeline parameters that make up the result cache key
+PDF_DPI = int(os.getenv("ROBUST_OCR_DPI", 300))
+OCR_ENGINE = "easyocr-en"
+
+# "batched": text detection runs on groups of same-sized pages, then the text
+# boxes of all pages are recognised together in batches of similar width
+# (EasyOCR's own recognize() handles one box at a time on CPU).
+# "per-page": one readtext() call per page.
+OCR_MODE = os.getenv("ROBUST_OCR_MODE", "batched")
+# Longest side the detector sees (EasyOCR's default); 300-DPI pages are
+# downscaled to this. Smaller is faster but loses small print.
+CANVAS_SIZE = int(os.getenv("ROBUST_OCR_CANVAS_SIZE", 2560))
+RECOGNITION_BATCH_SIZE = int(os.getenv("ROBUST_OCR_BATCH_SIZE", 32))
+RECOGNITION_WORKERS = int(os.getenv("ROBUST_OCR_WORKERS", 0))
+# Rendered pages held in memory while waiting for a batch
+PAGES_PER_BATCH = int(os.getenv("ROBUST_OCR_PAGES_PER_BATCH", 8))
 
 # ----------------- Helper Functions (REVISED) -----------------
-def load_document(file_bytes, file_type):
+@timed("rasterize")
+def render_page(page):
+    """Render a PyMuPDF page as an RGB array backed by the pixmap buffer (no PNG round trip)."""
+    return rasterizer.render_page(page, dpi=PDF_DPI)
+
+def load_document(source, file_type):
     """
-    Load a scanned image or a PDF page as a PIL Image.
-    This function has been revised for more robust PDF handling.
+    Lazily yield the pages of a scanned image or a PDF (bytes or a file path) as RGB images.
+    PDF pages are rendered one at a time, so only the current page is in memory.
     """
-    images = []
-
     if file_type == "normal":  # PDF
         try:
-            doc = fitz.open(stream=file_bytes, filetype="pdf")
-            # Loop over all pages in the PDF
-            for page in doc:
-                pix = page.get_pixmap(dpi=300)
-
-                # Convert pixmap to a standard format (like PNG) in memory and
-                # then load it with PIL. This handles different color spaces reliably.
-                img_data = pix.tobytes("png")
-                img = Image.open(io.BytesIO(img_data))
-
-                # Ensure the image is in RGB format, as required by EasyOCR.
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-
-                images.append(img)
-            doc.close()
+            doc = rasterizer.open_pdf(source)
+            # Closed even when the consumer stops early (GeneratorExit at the yield)
+            try:
+                # Loop over all pages in the PDF
+                for page in doc:
+                    yield render_page(page)
+            finally:
+                doc.close()
         except Exception as e:
             # Propagate error with more context
             raise RuntimeError(f"Failed to process PDF file: {e}") from e
 
     elif file_type == "scanned":  # JPG/PNG
-        img = Image.open(io.BytesIO(file_bytes)).convert("RGB")
-        images.append(img)
+        with stage("decode"):
+            img = Image.open(source if isinstance(source, str) else io.BytesIO(source)).convert("RGB")
+        yield img
 
     else:
         raise ValueError("Invalid file type. Use 'scanned' or 'normal'.")
 
-    return images
+def iter_document_pages(source, file_type, use_text_layer=TEXT_LAYER_ENABLED):
+    """
+    Yields (page_number, page_count, text, image) for every page. text is the
+    embedded text of a PDF page that passes the quality check (image is then
+    None, the page is never rasterized); otherwise image is the page to OCR.
+    """
+    if file_type != "normal":
+        for img in load_document(source, file_type):
+            yield 1, 1, None, img
+        return
+
+    try:
+        doc = rasterizer.open_pdf(source)
+        try:
+            for idx, page in enumerate(doc):
+                text = None
+                if use_text_layer:
+                    with stage("text_layer"):
+                        text = page_text_if_usable(page)
+                yield idx + 1, doc.page_count, text, render_page(page) if text is None else None
+        finally:
+            doc.close()
+    except Exception as e:
+        raise RuntimeError(f"Failed to process PDF file: {e}") from e
+
+def iter_document_text(source, file_type, use_text_layer=TEXT_LAYER_ENABLED, progress=None):
+    """
+    Yields {"page", "source", "text"} for every page in order, as soon as it
+    is done; OCRed pages also carry "lines": [{"text", "confidence", "box"}].
+    Pages to OCR are collected into batches of PAGES_PER_BATCH.
+    progress(done, total) is called whenever every page so far is done.
+    """
+    ready = []
+    waiting = []
+    batch_pages = PAGES_PER_BATCH if OCR_MODE == "batched" else 1
+    for page_number, page_count, text, img in iter_document_pages(source, file_type, use_text_layer):
+        if text is not None:
+            page = {"page": page_number, "source": SOURCE_TEXT_LAYER, "text": text}
+        else:
+            page = {"page": page_number, "source": SOURCE_OCR}
+            waiting.append((page, img))
+        ready.append(page)
+
+        if waiting and (len(waiting) >= batch_pages or page_number == page_count):
+            for (page, _), (page_text, lines) in zip(waiting, ocr_pages([img for _, img in waiting])):
+                page["text"] = page_text
+                page["lines"] = lines
+            waiting = []
+        if not waiting:
+            yield from ready
+            ready = []
+            if progress:
+                progress(page_number, page_count)
+
+def extract_document_text(source, file_type, use_text_layer=TEXT_LAYER_ENABLED, progress=None):
+    """All pages of iter_document_text as a list."""
+    return list(iter_document_text(source, file_type, use_text_layer, progress))
+
+# ----------------- EasyOCR -----------------
+def _as_line(box, text, confidence):
+    return {
+        "text": text,
+        "confidence": float(confidence),
+        "box": [[int(x), int(y)] for x, y in box],
+    }
+
+@timed("easyocr_detect")
+def detect_pages(reader, pages):
+    """(horizontal_list, free_list) per page; pages of the same size share one detector pass."""
+    boxes = [None] * len(pages)
+    by_shape = {}
+    for idx, page in enumerate(pages):
+        by_shape.setdefault(page.shape, []).append(idx)
+    for indices in by_shape.values():
+        batch = pages[indices[0]] if len(indices) == 1 else np.stack([pages[i] for i in indices])
+        horizontal, free = reader.detect(batch, canvas_size=CANVAS_SIZE, reformat=False)
+        for idx, page_horizontal, page_free in zip(indices, horizontal, free):
+            boxes[idx] = (page_horizontal, page_free)
+    return boxes
+
+@timed("easyocr_recognize")
+def recognize_pages(reader, pages, boxes):
+    """Recognises the detected boxes of all pages together; [[line, ...]] per page."""
+    from easyocr.config import imgH
+    from easyocr.recognition import get_text
+    from easyocr.utils import get_image_list
+
+    ignore_char = "".join(set(reader.character) - set(reader.lang_char))
+    crops = []
+    for page_idx, (page, (horizontal, free)) in enumerate(zip(pages, boxes)):
+        gray = cv2.cvtColor(page, cv2.COLOR_BGR2GRAY)
+        image_list, _ = get_image_list(horizontal, free, gray, model_height=imgH)
+        # The order get_image_list returns (top to bottom) is the reading order
+        crops.extend(((page_idx, order, box), crop) for order, (box, crop) in enumerate(image_list))
+
+    # Every crop in a batch is padded to the widest one, so batch similar widths
+    crops.sort(key=lambda item: item[1].shape[1])
+    lines = [[] for _ in pages]
+    for start in range(0, len(crops), RECOGNITION_BATCH_SIZE):
+        batch = crops[start:start + RECOGNITION_BATCH_SIZE]
+        max_width = max(math.ceil(batch[-1][1].shape[1] / imgH), 1) * imgH
+        results = get_text(reader.character, imgH, max_width, reader.recognizer, reader.converter, batch,
+                           ignore_char, batch_size=RECOGNITION_BATCH_SIZE, workers=RECOGNITION_WORKERS,
+                           device=reader.device)
+        for (page_idx, order, box), text, confidence in results:
+            lines[page_idx].append((order, _as_line(box, text, confidence)))
+    return [[line for _, line in sorted(page_lines, key=lambda item: item[0])] for page_lines in lines]
+
+def _as_bgr(img):
+    """A PIL Image or RGB array in the BGR channel order EasyOCR expects of arrays."""
+    page = np.asarray(img)
+    if page.ndim == 2:
+        return cv2.cvtColor(page, cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(page, cv2.COLOR_RGB2BGR)
+
+def ocr_pages(images):
+    """EasyOCR over several pages (PIL Images or RGB arrays); [(text, lines)] per page."""
+    reader = registry.get("easyocr_en")
+    # The batched path calls EasyOCR internals (reader.detect with reformat=False,
+    # recognition.get_text, utils.get_image_list); requirements.txt pins the version
+    pages = [_as_bgr(img) for img in images]
+    if OCR_MODE == "batched":
+        page_lines = recognize_pages(reader, pages, detect_pages(reader, pages))
+    else:
+        with stage("easyocr"):
+            page_lines = [
+                [_as_line(*result) for result in reader.readtext(page, canvas_size=CANVAS_SIZE,
+                                                                 batch_size=RECOGNITION_BATCH_SIZE,
+                                                                 workers=RECOGNITION_WORKERS)]
+                for page in pages
+            ]
+    return [("\n".join(line["text"] for line in lines), lines) for lines in page_lines]
 
 def extract_text(img):
-    """Uses EasyOCR to extract text from a PIL Image."""
-    # detail=0 returns a list of plain text strings
-    results = reader.readtext(np.array(img), detail=0)
-    return "\n".join(results)
+    """Uses EasyOCR to extract text from a PIL Image or RGB array."""
+    text, _ = ocr_pages([img])[0]
+    return text
+
+def _robust_ocr_key(source, file_type, use_text_layer):
+    return make_key(hash_source(source), stage="robust_ocr", file_type=file_type, dpi=PDF_DPI,
+                    engine=OCR_ENGINE, mode=OCR_MODE, canvas=CANVAS_SIZE, text_layer=use_text_layer)
+
+def build_response(pages):
+    """The /robust-ocr response for a list of page results."""
+    if not pages:
+        return {"results": "", "pages": []}
+
+    # Concatenate all page texts into one string, with a separator for multi-page documents
+    full_text = "\n\n--- Page Break ---\n\n".join(page["text"] for page in pages)
+
+    response = {
+        "results": full_text.strip(),
+        # Per page: the path it took ("text_layer" or "ocr"), its text and,
+        # for OCRed pages, the recognised lines with confidence and box
+        "pages": pages,
+    }
+    return response
+
+def run_robust_ocr(source, file_type, use_text_layer=TEXT_LAYER_ENABLED, progress=None):
+    """Text of every page joined with page breaks, plus the structured result of each page."""
+    cache = get_cache("ocr_text")
+    key = _robust_ocr_key(source, file_type, use_text_layer)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    pages = extract_document_text(source, file_type, use_text_layer, progress)
+    response = build_response(pages)
+    if pages:
+        cache.set(key, response)
+    return response
+
+def iter_robust_ocr(source, file_type, use_text_layer=TEXT_LAYER_ENABLED):
+    """Streaming /robust-ocr: one record per page, then {"done": true, "pages": n}."""
+    cache = get_cache("ocr_text")
+    key = _robust_ocr_key(source, file_type, use_text_layer)
+    cached = cache.get(key)
+    if cached is not None:
+        yield from cached["pages"]
+        yield {"done": True, "pages": len(cached["pages"])}
+        return
+
+    pages = []
+    for page in iter_document_text(source, file_type, use_text_layer):
+        pages.append(page)
+        yield page
+    if pages:
+        cache.set(key, build_response(pages))
+    yield {"done": True, "pages": len(pages)}
 
 # ----------------- Flask Route -----------------
 @app.route("/robust-ocr", methods=["POST"])
 def robust_ocr():
-    if 'file' not in request.files or 'type' not in request.form:
+    """
+    Multipart "file" plus form "type" ("scanned" | "normal") and optional
+    "text_layer", or the raw file as the body with the fields as query
+    arguments (?type=normal). With ?stream=1 the response is NDJSON, one
+    record per page as it finishes.
+    """
+    params = request_params(request)
+    # Checked before the body is read, so a bad request never spools a file
+    upload = read_upload(request) if 'type' in params else None
+    if upload is None:
         return jsonify({"error": "Missing file or type (expected 'scanned' or 'normal')"}), 400
 
-    file = request.files['file']
-    file_type = request.form['type']  # "scanned" | "normal"
-
-    try:
-        images = load_document(file.read(), file_type)
-        if not images:
-            return jsonify({"results": ""})
+    file_type = params['type']  # "scanned" | "normal"
 
-        # Concatenate all page texts into one string
-        full_text = ""
-        for img in images:
-            # Add a separator for multi-page documents
-            if full_text:
-                full_text += "\n\n--- Page Break ---\n\n"
-            full_text += extract_text(img)
+    use_text_layer = text_layer_flag(params.get("text_layer"))
+    if wants_stream(request, params):
+        return ndjson_response(iter_robust_ocr(upload.source, file_type, use_text_layer), on_close=upload.close)
 
-        return jsonify({"results": full_text.strip()})
+    try:
+        return jsonify(run_robust_ocr(upload.source, file_type, use_text_layer))
 
     except Exception as e:
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+    finally:
+        upload.close()
+
+@register_job("robust-ocr", stage="easyocr")
+def robust_ocr_job(files, params, progress):
+    """Job version of /robust-ocr: multipart "file" plus form "type" and optional "text_layer"."""
+    if "file" not in files or "type" not in params:
+        raise ValueError("Missing file or type (expected 'scanned' or 'normal')")
+    use_text_layer = text_layer_flag(params.get("text_layer"))
+    return run_robust_ocr(files["file"], params["type"], use_text_layer,
+                          lambda done, total: progress(done, total, f"Page {done}"))
+
+app.register_blueprint(create_jobs_blueprint("robust-ocr"))
+app.register_blueprint(create_ready_blueprint())
+
+@app.route("/cache-stats", methods=["GET"])
+def get_cache_stats():
+    """Hit/miss counters for this worker's result caches."""
+    return jsonify(cache_stats())
+
+finish_startup(__name__, _import_started)
 
 # ----------------- Run Flask -----------------
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+import threading
+import cv2
+import numpy as np
+from reference_store import REGIONS
+
+# ---------------- Similarity Search Index ----------------
+# Answers "does this scan look like any certificate we issued?" without a
+# pairwise comparison per certificate:
+#   * a 64-bit perceptual hash (pHash) of the whole page, searched with a
+#     vectorised XOR + popcount Hamming distance over a uint64 array
+#   * the ResNet crop embeddings, searched with one matmul per region over the
+#     reference store's contiguous [rows, dim] matrices, then a top-k select
+# The index is derived from a ReferenceStore and refreshes itself when new
+# certificates are ingested.
+
+# Popcount of every byte value, for Hamming distances on numpy versions
+# without np.bitwise_count
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def perceptual_hash(image, hash_size=8, highfreq_factor=4):
+    """
+    DCT-based perceptual hash of a PIL image or array, as a Python int.
+    Robust to rescaling, recompression and small edits; near-identical pages
+    differ in only a few bits.
+    """
+    img = np.asarray(image)
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    size = hash_size * highfreq_factor
+    small = cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(small)[:hash_size, :hash_size]
+    bits = (low_freq > np.median(low_freq)).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming_distances(hashes, query):
+    """Hamming distance between a uint64 array of hashes and one hash."""
+    xor = np.bitwise_xor(hashes, np.uint64(query))
+    return _POPCOUNT[xor.view(np.uint8)].reshape(len(hashes), 8).sum(axis=1, dtype=np.int32)
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+class SimilarityIndex:
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._version = None
+        self._row_ids = []
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._hash_valid = np.empty(0, dtype=bool)
+        self._matrices = {}
+        self._norms = {}
+        self._valid = {}
+
+    def _refresh(self):
+        """Rebuilds the row -> certificate map and per-region norms after ingests."""
+        if self.store.version == self._version:
+            return
+        # Row count, entries and matrices from the same index; the version read
+        # above may already be stale if another process ingested since
+        rows, certificates, matrices = self.store.snapshot()
+        row_ids = [None] * rows
+        hashes = np.zeros(rows, dtype=np.uint64)
+        hash_valid = np.zeros(rows, dtype=bool)
+        valid = {name: np.zeros(rows, dtype=bool) for name in REGIONS}
+        for certificate_id, entry in certificates.items():
+            row = entry["row"]
+            row_ids[row] = certificate_id
+            if entry.get("phash") is not None:
+                hashes[row] = entry["phash"]
+                hash_valid[row] = True
+            for name in entry["regions"]:
+                valid[name][row] = True
+
+        # Norms only need computing for rows appended since the last refresh
+        norms = {}
+        for name in REGIONS:
+            previous = self._norms.get(name, np.empty(0, dtype=np.float32))
+            matrix = matrices[name]
+            if matrix is None:
+                norms[name] = np.empty(0, dtype=np.float32)
+                continue
+            start = len(previous)
+            fresh = np.linalg.norm(matrix[start:], axis=1).astype(np.float32)
+            norms[name] = np.concatenate([previous, fresh])
+
+        self._row_ids = row_ids
+        self._hashes = hashes
+        self._hash_valid = hash_valid
+        self._matrices = matrices
+        self._norms = norms
+        self._valid = valid
+        self._version = rows
+
+    def search_hash(self, phash, max_distance=10, k=10):
+        """Certificates whose page hash is within max_distance bits, closest first."""
+        k = max(1, k)
+        with self._lock:
+            self._refresh()
+            if not self._hash_valid.any():
+                return []
+            distances = hamming_distances(self._hashes, phash)
+            candidates = np.flatnonzero(self._hash_valid & (distances <= max_distance))
+            order = candidates[np.argsort(distances[candidates], kind="stable")][:k]
+            return [{"certificate_id": self._row_ids[row], "distance": int(distances[row])} for row in order]
+
+    def search_embeddings(self, region, embeddings, k=5):
+        """
+        Cosine top-k over one region for a batch of query embeddings.
+        Returns one list of {"certificate_id", "score"} per query.
+        """
+        k = max(1, k)
+        with self._lock:
+            self._refresh()
+            matrix = self._matrices.get(region)
+            if matrix is None or not self._valid[region].any():
+                return [[] for _ in embeddings]
+            queries = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-6)
+            # One [rows, dim] x [dim, queries] product scores every certificate at once
+            scores = (matrix @ queries.T) / np.maximum(self._norms[region], 1e-6)[:, None]
+            scores[~self._valid[region]] = -np.inf
+            results = []
+            for column in scores.T:
+                best = [row for row in top_k(column, k) if np.isfinite(column[row])]
+                results.append([{"certificate_id": self._row_ids[row], "score": float(column[row])} for row in best])
+            return results
@@ -0,0 +1,139 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+from flask import Response, stream_with_context
+
+# ---------------- Streaming Uploads and Responses ----------------
+# Documents can be sent as the raw request body (Content-Type application/pdf,
+# image/* or application/octet-stream, filename in ?filename=) or as a
+# multipart "file" field instead of base64 inside JSON. Bodies up to
+# UPLOAD_MEMORY_MAX_BYTES are kept in memory; larger ones are copied in
+# chunks into a temporary file and handed on as that file's path, so a
+# request never holds a large document in memory. PDFs are opened from the
+# path and MuPDF reads the pages it needs.
+#
+# With ?stream=1 (or Accept: application/x-ndjson) a route answers with one
+# JSON record per line, written as soon as each page is done, followed by
+# {"done": true, ...}.
+
+# Where uploads are spooled; the system temp directory by default
+UPLOAD_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+# Uploads up to this size stay in memory instead of a temporary file
+UPLOAD_MEMORY_MAX_BYTES = int(os.getenv("UPLOAD_MEMORY_MAX_BYTES", 2 * 1024 * 1024))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+_FILENAME = re.compile(r'filename="?([^";]+)"?')
+
+
+def request_params(req):
+    """Form fields and query arguments (form wins) as a plain dict."""
+    params = req.args.to_dict()
+    params.update(req.form.to_dict())
+    return params
+
+
+class Upload:
+    """
+    An uploaded document: `source` is its bytes, or the path of the temporary
+    file it was spooled to (`path`, None for in-memory uploads). close()
+    deletes the file; use it as a context manager or pass close to
+    ndjson_response(on_close=...) when the file is read after the view returns.
+    """
+
+    def __init__(self, filename, path=None, data=None):
+        self.filename = filename
+        self.path = path
+        self.data = data
+
+    @property
+    def source(self):
+        """What the pipelines accept as a document: bytes or a file path."""
+        return self.path if self.path is not None else self.data
+
+    def close(self):
+        if self.path is None:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def spool_to_file(stream, filename, head=b""):
+    """Copies head and then a stream in chunks into a new temporary file; returns its path."""
+    fd, path = tempfile.mkstemp(dir=UPLOAD_DIR, prefix="upload-", suffix=os.path.splitext(filename)[1].lower())
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(head)
+            shutil.copyfileobj(stream, f, UPLOAD_CHUNK_BYTES)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def read_upload(req, field="file", default_filename="file.png"):
+    """
+    Upload from a multipart field or a raw request body, in memory or
+    spooled to a temporary file depending on its size; None when the request
+    carries neither (e.g. a JSON body) or the body is empty. The caller
+    closes it.
+    """
+    if field in req.files:
+        storage = req.files[field]
+        filename = storage.filename or default_filename
+        stream = storage.stream
+    elif req.is_json or req.mimetype in ("", "multipart/form-data", "application/x-www-form-urlencoded"):
+        return None
+    else:
+        filename = req.args.get("filename")
+        if not filename:
+            match = _FILENAME.search(req.headers.get("Content-Disposition", ""))
+            filename = match.group(1) if match else default_filename
+        stream = req.stream
+
+    # One byte past the limit tells a small body from a large one without reading it all
+    head = stream.read(UPLOAD_MEMORY_MAX_BYTES + 1)
+    if not head:
+        return None
+    if len(head) <= UPLOAD_MEMORY_MAX_BYTES:
+        return Upload(filename, data=head)
+    return Upload(filename, path=spool_to_file(stream, filename, head))
+
+
+def wants_stream(req, params=None):
+    value = (params or {}).get("stream", req.args.get("stream", ""))
+    return str(value).lower() in ("1", "true") or NDJSON_MIMETYPE in req.headers.get("Accept", "")
+
+
+def ndjson_response(records, on_close=None):
+    """
+    Streams an iterable of JSON-serialisable records, one per line.
+    on_close runs once the stream ends or the client goes away.
+    """
+    def generate():
+        try:
+            for record in records:
+                yield json.dumps(record) + "\n"
+        except Exception as e:
+            # Headers are already sent, so errors become the last record
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            if on_close is not None:
+                on_close()
+
+    response = Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE,
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    if on_close is not None:
+        # Also covers a stream that is closed before it starts
+        response.call_on_close(on_close)
+    return response
@@ -0,0 +1,450 @@
+import bisect
+import inspect
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from flask import Blueprint, Response, g, request
+
+logger = logging.getLogger(__name__)
+
+# ---------------- Request Tracing and Metrics ----------------
+# Every pipeline stage (rendering, Tesseract, EasyOCR, YOLO, the embedder,
+# SIFT, spaCy, the LLM, ...) is timed with
+#
+#     with stage("yolo"):              or     @timed("yolo")
+#         ...                                 def crop_from_yolo(image): ...
+#
+# Each timing goes into the certify_stage_seconds histogram and, during a
+# request, into that request's Server-Timing header, e.g.
+#     Server-Timing: rasterize;dur=212.4, tesseract;dur=1830.2, llm;dur=950.1, total;dur=3001.7
+# Work handed to a thread pool is attributed to the request when the
+# callable is wrapped with propagate(); work in process pools (batches, jobs)
+# only counts towards that process's own metrics. Streamed (NDJSON)
+# responses send their headers first, so their Server-Timing only covers
+# what ran before the first record.
+#
+# GET /metrics serves everything in the Prometheus text format: stage and
+# request histograms, in-flight requests, result cache hits and misses, and
+# whatever gauges the services register (job queue, LLM calls in flight).
+# Each gunicorn worker keeps its own metrics and a scrape reaches whichever
+# worker accepts it, so every sample carries a worker="<pid>" label
+# (METRICS_WORKER_LABEL=0 drops it); sum by the other labels across workers,
+# e.g. sum without (worker) (rate(certify_stage_seconds_sum[5m])).
+#
+# Sampling profiler (PROFILE_REQUESTS=1): a request with ?profile=1 or the
+# header "X-Profile: 1" (or a random PROFILE_SAMPLE_RATE share of requests)
+# has its threads' stacks sampled every PROFILE_INTERVAL_MS. The profile is
+# written to PROFILE_DIR in the collapsed-stack format that flamegraph.pl and
+# speedscope read, and its file name (unique per request) is returned in the
+# X-Profile header.
+
+PROFILE_ENABLED = os.getenv("PROFILE_REQUESTS", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", 5)) / 1000
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+METRICS_WORKER_LABEL = os.getenv("METRICS_WORKER_LABEL", "1") == "1"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds; stages range from sub-millisecond cache lookups to minute-long LLM retries
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+# ---------------- Metrics ----------------
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self, const=()):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key, const)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (+Inf last), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self, const=()):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        for key, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, list(const) + [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, const)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Collected:
+    """
+    A metric read at scrape time: func() returns a number, or
+    {label values tuple: number} when labelnames are given.
+    """
+
+    def __init__(self, name, help, func, labelnames=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self, const=()):
+        try:
+            values = self.func()
+        except Exception:
+            # A broken collector must not take /metrics down with it
+            return []
+        if not self.labelnames:
+            values = {(): values}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(values.items()):
+            if value is not None:
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key, const)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            # Re-registering (e.g. a second app in the same process) keeps the first
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, func, labelnames=()):
+        return self._add(Collected(name, help, func, labelnames, "gauge"))
+
+    def collected_counter(self, name, help, func, labelnames=()):
+        return self._add(Collected(name, help, func, labelnames, "counter"))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        # Read at scrape time: the registry is created before gunicorn forks
+        const = [("worker", os.getpid())] if METRICS_WORKER_LABEL else []
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(const))
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    "certify_stage_seconds", "Time spent in each pipeline stage, including model inference.", ("stage",))
+STAGE_ERRORS = metrics.counter(
+    "certify_stage_errors_total", "Pipeline stages that raised or reported an error.", ("stage",))
+REQUEST_SECONDS = metrics.histogram(
+    "certify_request_seconds", "HTTP request duration until the response is complete.",
+    ("method", "endpoint", "status"))
+
+_in_flight_requests = 0
+_in_flight_lock = threading.Lock()
+metrics.gauge("certify_requests_in_flight", "HTTP requests being handled by this worker.",
+              lambda: _in_flight_requests)
+
+
+def _cache_metric(field):
+    def collect():
+        from result_cache import cache_stats
+        return {(level,): stats[field] for level, stats in cache_stats().items()}
+    return collect
+
+
+metrics.collected_counter("certify_cache_hits_total", "Result cache hits (memory or disk).",
+                          _cache_metric("hits"), ("level",))
+metrics.collected_counter("certify_cache_misses_total", "Result cache misses.",
+                          _cache_metric("misses"), ("level",))
+metrics.gauge("certify_cache_hit_ratio", "Result cache hits over lookups since start.",
+              _cache_metric("hit_ratio"), ("level",))
+metrics.gauge("certify_cache_entries", "Entries held in the in-memory cache.",
+              _cache_metric("entries"), ("level",))
+
+
+# ---------------- Stage Timers ----------------
+class RequestTrace:
+    """Stage timings of one request and the threads currently working on it."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.threads = {threading.get_ident()}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + 1)
+
+    def server_timing(self):
+        with self._lock:
+            stages = list(self.stages.items())
+        entries = []
+        for name, (seconds, count) in stages:
+            desc = f';desc="{count} calls"' if count > 1 else ""
+            entries.append(f"{name}{desc};dur={seconds * 1000:.1f}")
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_current_trace = ContextVar("certify_request_trace", default=None)
+_profile_counter = itertools.count(1)
+
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block as pipeline stage `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
+
+
+def timed(name):
+    """Decorator form of stage() for plain (non-generator) functions."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_error(name):
+    """Counts an error a stage recovered from instead of raising."""
+    STAGE_ERRORS.inc(stage=name)
+
+
+def propagate(func):
+    """
+    Binds func to the current request, so stages it runs on a pool thread
+    show up in that request's Server-Timing (and profile).
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return func
+
+    @wraps(func)
+    def run(*args, **kwargs):
+        token = _current_trace.set(trace)
+        ident = threading.get_ident()
+        with trace._lock:
+            trace.threads.add(ident)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with trace._lock:
+                trace.threads.discard(ident)
+            _current_trace.reset(token)
+    return run
+
+
+# ---------------- Sampling Profiler ----------------
+class SamplingProfiler:
+    """Samples the stacks of a request's threads from a background thread."""
+
+    def __init__(self, trace, interval=PROFILE_INTERVAL):
+        self.trace = trace
+        self.interval = interval
+        self.samples = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.trace._lock:
+                threads = set(self.trace.threads)
+            frames = sys._current_frames()
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+
+
+def _wants_profile():
+    if not PROFILE_ENABLED:
+        return False
+    if request.args.get("profile") == "1" or request.headers.get("X-Profile") == "1":
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+# ---------------- Flask Integration ----------------
+def create_metrics_blueprint(registry=None):
+    """GET /metrics in the Prometheus text format."""
+    registry = registry or metrics
+    bp = Blueprint("metrics", __name__)
+
+    @bp.route("/metrics", methods=["GET"])
+    def prometheus_metrics():
+        return Response(registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+    return bp
+
+
+def instrument_app(app, service=None):
+    """
+    Adds request timing, Server-Timing headers, the opt-in profiler and the
+    /metrics route to a Flask app.
+    """
+    service = service or app.import_name
+
+    @app.before_request
+    def _start_trace():
+        global _in_flight_requests
+        trace = RequestTrace()
+        g.certify_trace = trace
+        g.certify_trace_token = _current_trace.set(trace)
+        g.certify_profiler = SamplingProfiler(trace).start() if _wants_profile() else None
+        with _in_flight_lock:
+            _in_flight_requests += 1
+
+    @app.after_request
+    def _finish_trace(response):
+        trace = g.pop("certify_trace", None)
+        if trace is None:
+            return response
+        response.headers["Server-Timing"] = trace.server_timing()
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        request_method = request.method
+        profiler = g.pop("certify_profiler", None)
+        profile_name = None
+        if profiler is not None:
+            # The per-process sequence number keeps same-second profiles apart
+            profile_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{service}-{os.getpid()}-" \
+                           f"{next(_profile_counter)}-{endpoint.strip('/').replace('/', '_') or 'root'}.folded"
+            response.headers["X-Profile"] = profile_name
+
+        def complete():
+            global _in_flight_requests
+            with _in_flight_lock:
+                _in_flight_requests -= 1
+            REQUEST_SECONDS.observe(time.perf_counter() - trace.started, method=request_method,
+                                    endpoint=endpoint, status=response.status_code)
+            if profiler is not None:
+                profiler.stop()
+                try:
+                    profiler.write(os.path.join(PROFILE_DIR, profile_name))
+                except OSError as e:
+                    logger.warning("Could not write profile %s: %s", profile_name, e)
+
+        if inspect.isgenerator(response.response):
+            # Streamed body, generated after this hook returns; finish once it is sent
+            response.call_on_close(complete)
+        else:
+            complete()
+        return response
+
+    @app.teardown_request
+    def _reset_trace(exc=None):
+        global _in_flight_requests
+        token = g.pop("certify_trace_token", None)
+        if token is not None:
+            try:
+                _current_trace.reset(token)
+            except ValueError:
+                # Teardown may run in a different context than before_request
+                pass
+        if g.pop("certify_trace", None) is not None:
+            # after_request never ran (unhandled error); still balance the gauge
+            with _in_flight_lock:
+                _in_flight_requests -= 1
+            profiler = g.pop("certify_profiler", None)
+            if profiler is not None:
+                profiler.stop()
+
+    app.register_blueprint(create_metrics_blueprint())
+    return app
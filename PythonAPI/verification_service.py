@@ -0,0 +1,150 @@
+import time
+_import_started = time.perf_counter()
+
+from flask import Flask, request, jsonify
+from flask_cors import CORS
+import os
+from certificate_index import VERIFY_DB, load_index, write_snapshot, delete_from_snapshot
+from model_registry import registry, create_ready_blueprint, finish_startup
+from tracing import instrument_app, metrics, stage
+
+# ---------------- Certificate Verification Service ----------------
+# Checks OCR output against the issued certificates in one index lookup,
+# instead of a second upload and a second OCR + LLM pass:
+#
+#   POST /verify               {"text": "<OCR text>"} and/or {"fields": {...}},
+#                              optional "organisation_id" / "organisation", "k"
+#                              -> best match, a score per field, other candidates
+#   POST /certificates         ingest (or update) issued certificates
+#   DELETE /certificates/<id>  remove one
+#   POST /certificates/reload  reload the index from VERIFY_DB
+#
+# Run with `python verification_service.py` (port 5002) or
+#   GUNICORN_BIND=0.0.0.0:5002 gunicorn -c gunicorn.conf.py verification_service:app
+# With several workers each holds its own index; ingests reach one worker
+# and the others see them after a reload, so run a single worker unless
+# VERIFY_DB is the Postgres database.
+
+app = Flask(__name__)
+CORS(app)
+instrument_app(app, "verify")
+
+# A verification with a score at or above this is reported as a match
+MATCH_THRESHOLD = float(os.getenv("VERIFY_MATCH_THRESHOLD", 0.8))
+# Field scores below this are listed as mismatched fields
+FIELD_THRESHOLD = float(os.getenv("VERIFY_FIELD_THRESHOLD", 0.7))
+
+# Loaded on first use, or before the workers fork with PRELOAD_MODELS=1
+registry.register("certificate_index", load_index)
+
+metrics.gauge("certify_verify_certificates", "Issued certificates in the verification index.",
+              lambda: len(registry.get("certificate_index")) if registry.is_ready() else None)
+
+
+def _persist_to_snapshot():
+    """Ingests are written back to a SQLite snapshot; the Postgres database is owned by the app."""
+    return not VERIFY_DB.startswith(("postgres://", "postgresql://"))
+
+
+def _describe(result):
+    return {
+        **result,
+        "mismatched_fields": sorted(field for field, score in result["field_scores"].items()
+                                    if score < FIELD_THRESHOLD),
+    }
+
+
+@app.route("/verify", methods=["POST"])
+def verify():
+    """
+    JSON body: "text" (OCR text of the certificate) and/or "fields"
+    (extracted fields, e.g. from /extract), plus optional "organisation_id",
+    "organisation" (name) and "k" (number of candidates, default 3).
+    Every score is in [0, 1]; "mismatched_fields" lists the fields scoring
+    below VERIFY_FIELD_THRESHOLD.
+    """
+    data = request.get_json(silent=True) or {}
+    text = data.get("text")
+    fields = data.get("fields")
+    if not text and not fields:
+        return jsonify({"error": "text or fields is required"}), 400
+    if fields is not None and not isinstance(fields, dict):
+        return jsonify({"error": "fields must be an object"}), 400
+    try:
+        k = int(data.get("k", 3))
+    except (TypeError, ValueError):
+        return jsonify({"error": "k must be an integer"}), 400
+
+    started = time.perf_counter()
+    with stage("verify_lookup"):
+        candidates = registry.get("certificate_index").search(
+            text=text, fields=fields, organisation_id=data.get("organisation_id"),
+            organisation=data.get("organisation"), k=max(k, 1),
+        )
+    best = candidates[0] if candidates else None
+    return jsonify({
+        "match": best is not None and best["score"] >= MATCH_THRESHOLD,
+        "best": _describe(best) if best else None,
+        "candidates": [_describe(candidate) for candidate in candidates[1:]],
+        "threshold": MATCH_THRESHOLD,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    })
+
+
+@app.route("/certificates", methods=["POST"])
+def ingest_certificates():
+    """
+    One certificate {"id", "name", "rollNo", "certificateId", "year", "grade",
+    "organisationId", ...} or {"certificates": [...]}; existing IDs are replaced.
+    """
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "JSON body required"}), 400
+    records = data.get("certificates", [data]) if isinstance(data, dict) else data
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        return jsonify({"error": "certificates must be objects"}), 400
+    try:
+        # Prisma IDs are integers; a string ID would never match DELETE /certificates/<id>
+        records = [{**record, "id": int(record["id"])} for record in records]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "every certificate needs an integer id"}), 400
+
+    index = registry.get("certificate_index")
+    for record in records:
+        index.add(record)
+    if _persist_to_snapshot():
+        try:
+            write_snapshot(records)
+        except Exception as e:
+            return jsonify({"ingested": len(records), "warning": f"Snapshot not updated: {e}"})
+    return jsonify({"ingested": len(records), "certificates": len(index)})
+
+
+@app.route("/certificates/<int:certificate_id>", methods=["DELETE"])
+def remove_certificate(certificate_id):
+    if not registry.get("certificate_index").remove(certificate_id):
+        return jsonify({"error": f"Unknown certificate {certificate_id}"}), 404
+    if _persist_to_snapshot():
+        delete_from_snapshot(certificate_id)
+    return jsonify({"removed": certificate_id})
+
+
+@app.route("/certificates/reload", methods=["POST"])
+def reload_certificates():
+    index = registry.get("certificate_index")
+    index.replace(load_index())
+    return jsonify(index.stats())
+
+
+@app.route("/certificates/stats", methods=["GET"])
+def certificate_stats():
+    return jsonify(registry.get("certificate_index").stats())
+
+
+app.register_blueprint(create_ready_blueprint())
+
+finish_startup(__name__, _import_started)
+
+# ---------------- Run Server ----------------
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5002, debug=os.getenv("FLASK_DEBUG", "0") == "1")
@@ -9,6 +9,9 @@ cloudinary.config({
   api_secret: process.env.CLOUDINARY_API_SECRET,
 });
 
+// Files per /extract-batch call
+const OCR_BATCH_FILES = Number(process.env.OCR_BATCH_FILES) || 16;
+
 export async function POST(request) {
   const session=await getSession();
   const id=session.user.id;
@@ -35,18 +38,50 @@ export async function POST(request) {
 
     const uploadResults = [];
 
-    for (const entry of entries) {
+    // OCR the archive in bounded batches; the Python service spreads each
+    // batch's pages over all cores and reports errors per file. Small batches
+    // keep every call well inside the HTTP timeouts for archives of thousands
+    // of certificates, and a failed batch only fails its own files.
+    const extracted = [];
+    for (let start = 0; start < entries.length; start += OCR_BATCH_FILES) {
+      const chunk = entries.slice(start, start + OCR_BATCH_FILES);
+      let batchError = null;
+      try {
+        const batchRes = await fetch("http://localhost:5001/extract-batch", {
+                                method: "POST",
+                                headers: { "Content-Type": "application/json" },
+                                body: JSON.stringify({
+                                  documents: chunk.map((entry) => ({
+                                    filename: entry.entryName,
+                                    b64: entry.getData().toString("base64"),
+                                  })),
+                                  organisation_id: org.id,
+                                }),
+                              });
+        const batch = await batchRes.json().catch(() => ({}));
+        if (batchRes.ok) {
+          extracted.push(...chunk.map((_, i) => batch.files?.[i]));
+          continue;
+        }
+        batchError = batch.error || `Extraction service returned ${batchRes.status}`;
+      } catch (err) {
+        batchError = `Extraction service unavailable: ${err.message}`;
+      }
+      console.log(`OCR batch of ${chunk.length} files failed:`, batchError);
+      extracted.push(...chunk.map(() => ({ error: batchError })));
+    }
+
+    for (const [index, entry] of entries.entries()) {
       const fileBuffer = entry.getData();
-      const base64Data = fileBuffer.toString("base64");
-      const res=await fetch("http://localhost:5001/extract", {
-                            method: "POST",
-                            headers: { "Content-Type": "application/json" },
-                            body: JSON.stringify({
-                              filename: entry.entryName,
-                              b64: base64Data,
-                            }),
-                          });
-      const fields=res.results[0].fields;
+      const result = extracted[index];
+      if (!result || result.error || !result.results?.length) {
+        uploadResults.push({
+          fileName: entry.entryName,
+          error: result?.error || "Extraction failed",
+        });
+        continue;
+      }
+      const fields=result.results[0].fields;
       fields.organisation_id=org.id;
 
       const finalFields={};
@@ -103,10 +138,21 @@ export async function POST(request) {
 
       finalFields.url=uploadResult.secure_url;
 
-      await prisma.certificate.create({
+      const certificate = await prisma.certificate.create({
         data:finalFields,
       });
 
+      // Keep the verification index in step; a failure here must not fail the upload
+      try {
+        await fetch("http://localhost:5002/certificates", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ ...certificate, organisation: org?.name }),
+        });
+      } catch (err) {
+        console.log(`Verification index not updated for ${entry.entryName}:`, err.message);
+      }
+
       uploadResults.push({
         fileName: entry.entryName,
         url: uploadResult.secure_url,
@@ -9,6 +9,7 @@ const OcrComparer = () => {
   const [status, setStatus] = useState("");
   const [comparisonResult, setComparisonResult] = useState(null);
   const [tamperingSummary, setTamperingSummary] = useState([]);
+  const [registryResult, setRegistryResult] = useState(null);
   const [error, setError] = useState(null);
 
   const [year, setYear] = useState("");
@@ -27,6 +28,7 @@ const OcrComparer = () => {
     setFormattedFields([null, null]);
     setComparisonResult(null);
     setTamperingSummary([]);
+    setRegistryResult(null);
     setError(null);
     setStatus("");
   };
@@ -46,9 +48,22 @@ const OcrComparer = () => {
     return data.results;
   };
 
+  // One index lookup against the issued certificates, tolerant of OCR errors
+  const verifyAgainstRegistry = async (text) => {
+    const res = await fetch("http://localhost:5002/verify", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ text }),
+    });
+
+    const data = await res.json();
+    if (!res.ok) throw new Error(data.error || "Registry verification failed");
+    return data;
+  };
+
   const readImageText = async () => {
-    if (!selectedImages[0] || !selectedImages[1]) {
-      alert("Please select both certificate images");
+    if (!selectedImages[0]) {
+      alert("Please select the certificate to verify");
       return;
     }
 
@@ -71,12 +86,31 @@ const OcrComparer = () => {
     setError(null);
     setComparisonResult(null);
     setTamperingSummary([]);
+    setRegistryResult(null);
 
     try {
       // ----------------- Step 1: Extract Text -----------------
       setStatus("Extracting text from first certificate...");
       const text1 = await extractTextFromApi(selectedImages[0], legacyType || "scanned");
 
+      setStatus("Checking against issued certificates...");
+      // The registry is an extra check; when it is down the comparison still runs
+      const registry = await verifyAgainstRegistry(text1).catch((err) => {
+        console.log("Registry verification unavailable:", err.message);
+        return null;
+      });
+      setRegistryResult(registry);
+
+      // Without a second upload the registry lookup is the whole check
+      if (!selectedImages[1]) {
+        if (!registry) {
+          throw new Error("Verification service unavailable; upload a second certificate to compare instead");
+        }
+        setOcrResults([text1, ""]);
+        setStatus("Completed");
+        return;
+      }
+
       setStatus("Extracting text from second certificate...");
       const text2 = await extractTextFromApi(selectedImages[1], legacyType || "scanned");
 
@@ -244,7 +278,9 @@ const OcrComparer = () => {
         {/* File Inputs */}
         {[0, 1].map((index) => (
           <div key={index} className="mb-6">
-            <label className="block font-semibold text-[#4e796b] mb-2">Upload Certificate {index + 1}</label>
+            <label className="block font-semibold text-[#4e796b] mb-2">
+              Upload Certificate {index + 1}{index === 1 && " (optional, for a side-by-side comparison)"}
+            </label>
             <input
               type="file"
               accept="image/*,.pdf"
@@ -273,6 +309,28 @@ const OcrComparer = () => {
         <p className="mt-4 font-bold text-[#4e796b]">Status: {status}</p>
         {error && <p className="text-red-600 mt-2">Error: {error}</p>}
 
+        {/* Registry Verification */}
+        {registryResult && (
+          <div className="mt-6">
+            <h2 className="text-lg font-bold">
+              Issued Certificate Match:{" "}
+              <span className={registryResult.match ? "text-green-600" : "text-red-600"}>
+                {registryResult.match ? "YES ✅" : "NO ❌"}
+                {registryResult.best && ` (Score: ${registryResult.best.score.toFixed(2)})`}
+              </span>
+            </h2>
+            {registryResult.best && (
+              <ul className="list-disc list-inside mt-2 text-[#4e796b]">
+                {Object.entries(registryResult.best.field_scores).map(([field, score]) => (
+                  <li key={field}>
+                    {field}: {registryResult.best.certificate[field]} {registryResult.best.mismatched_fields.includes(field) ? "❌" : "✅"} ({score.toFixed(2)})
+                  </li>
+                ))}
+              </ul>
+            )}
+          </div>
+        )}
+
         {/* Parsed Fields */}
         {formattedFields[0] && formattedFields[1] && (
           <div className="mt-6">